@@ -0,0 +1,73 @@
+"""
+Compare fixed pool sizes against the queue depth autoscaler on a
+synthetic trace of task arrivals.
+
+The trace holds a steady stream of short 'msg' tasks (one every
+'--msg-interval' seconds, each running for about a second), with
+'--spikes' bursts of '--spike-size' exports, each running for 20 to 40
+seconds. The trace is replayed by cadasta.workertoolbox.autoscale.simulate,
+reporting the pool's utilisation and the percentiles of the time tasks
+waited in the queue.
+
+Usage:
+
+    python benchmarks/bench_autoscale.py [--duration 3600] [--spikes 4]
+                                         [--spike-size 40] [--max 20]
+"""
+import argparse
+import random
+
+from cadasta.workertoolbox.autoscale import ScalingPolicy, simulate
+
+
+def synthetic_trace(duration, msg_interval, spikes, spike_size, seed=0):
+    rand = random.Random(seed)
+    trace = [
+        (rand.uniform(0, duration), rand.uniform(0.5, 1.5))
+        for _ in range(int(duration / msg_interval))
+    ]
+    for _ in range(spikes):
+        start = rand.uniform(0, duration * 0.9)
+        trace += [
+            (start + rand.uniform(0, 10), rand.uniform(20, 40))
+            for _ in range(spike_size)
+        ]
+    return sorted(trace)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--duration', type=float, default=3600)
+    parser.add_argument('--msg-interval', type=float, default=2)
+    parser.add_argument('--spikes', type=int, default=4)
+    parser.add_argument('--spike-size', type=int, default=40)
+    parser.add_argument('--min', type=int, default=2)
+    parser.add_argument('--max', type=int, default=20)
+    parser.add_argument('--target-wait', type=float, default=10)
+    parser.add_argument('--cooldown', type=float, default=30)
+    args = parser.parse_args()
+    trace = synthetic_trace(
+        args.duration, args.msg_interval, args.spikes, args.spike_size)
+    print('{} tasks over {:.0f}s'.format(len(trace), args.duration))
+
+    runs = [
+        ('fixed {}'.format(size), None, size)
+        for size in sorted(set([args.min, args.max // 2, args.max]))
+    ]
+    runs.append(('autoscaled', ScalingPolicy(
+        args.min, args.max, target_wait=args.target_wait,
+        cooldown=args.cooldown), None))
+
+    print('{:<12} {:>6} {:>6} {:>6} {:>9} {:>9} {:>9}'.format(
+        'pool', 'util', 'mean', 'max', 'p50 (s)', 'p95 (s)', 'p99 (s)'))
+    for label, policy, concurrency in runs:
+        report = simulate(policy, trace, concurrency=concurrency)
+        wait = report['wait']
+        print('{:<12} {:>6.1%} {:>6.1f} {:>6} {:>9.1f} {:>9.1f} {:>9.1f}'
+              .format(label, report['utilisation'],
+                      report['mean_concurrency'], report['max_concurrency'],
+                      wait['p50'], wait['p95'], wait['p99']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Compare the throughput of tiny 'msg' tasks executed one at a time against
+a BatchTask.
+
+Tasks are run by an in-process worker consuming from kombu's in-memory
+transport, storing results (including 'STARTED' states for individual
+tasks) in a temporary SQLite database. Each batch holds up to
+'--batch-size' tasks.
+
+Usage:
+
+    python benchmarks/bench_batches.py [--tasks 1000] [--batch-size 10 50]
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import celery.contrib.testing.tasks  # NOQA: registers celery.ping
+from celery import Celery
+from celery.contrib.testing.worker import start_worker
+from celery.result import ResultSet
+
+from cadasta.workertoolbox.batches import BatchTask
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.setup import setup_exchanges
+
+
+def make_app(url, batch_size):
+    app = Celery(set_as_current=False)
+    app.config_from_object(Config(
+        imports=(), broker_transport='memory',
+        broker_transport_options={'polling_interval': 0.01},
+        worker_prefetch_multiplier=batch_size or 4,
+        QUEUE_BATCH_OPTIONS={'msg': {'max_size': batch_size}},
+        result_backend='db+' + url))
+
+    @app.task(name='msg.send', shared=False)
+    def send(recipient):
+        return recipient
+
+    @app.task(base=BatchTask, name='msg.send_batch', shared=False)
+    def send_batch(requests):
+        return [request.args[0] for request in requests]
+
+    setup_exchanges(app)
+    with app.connection() as conn:
+        conn.SimpleQueue('msg').clear()
+    return app, send_batch if batch_size else send
+
+
+def run(url, tasks, batch_size):
+    app, task = make_app(url, batch_size)
+    # Consume each message once, ignoring the platform queue's copy
+    with start_worker(app, pool='solo', queues=['msg', 'celery'],
+                      perform_ping_check=False, loglevel='ERROR'):
+        start = time.time()
+        results = ResultSet([task.delay(i) for i in range(tasks)])
+        results.join(timeout=600, interval=0.05)
+        elapsed = time.time() - start
+    return tasks / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, nargs='+',
+                        default=[10, 50])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    directory = tempfile.mkdtemp()
+    try:
+        # Celery only creates its tables in the first database it connects to
+        url = 'sqlite:///' + os.path.join(directory, 'results.db')
+        print('{:<10} {:>12}'.format('batch', 'tasks/s'))
+        for batch_size in [0] + args.batch_size:
+            rate = run(url, args.tasks, batch_size)
+            print('{:<10} {:>12.1f}'.format(batch_size or 'none', rate))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
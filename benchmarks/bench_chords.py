@@ -0,0 +1,108 @@
+"""
+Count the broker messages sent to complete chords with each
+CHORD_UNLOCK_STRATEGY.
+
+Chords are run by an in-process worker consuming from kombu's in-memory
+transport, storing results in a temporary SQLite database. Each header task
+sleeps for '--task-ms' milliseconds, so that the 'poll' and 'backoff'
+strategies retry celery.chord_unlock while the header runs.
+
+Usage:
+
+    python benchmarks/bench_chords.py [--chords 3] [--size 4]
+                                      [--task-ms 500]
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+import celery.contrib.testing.tasks  # NOQA: registers celery.ping
+from celery import Celery, chord
+from celery.contrib.testing.worker import start_worker
+from celery.signals import before_task_publish
+
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.setup import setup_app
+
+STRATEGIES = ('poll', 'backoff', 'counter')
+
+
+def make_app(strategy, url):
+    app = Celery(set_as_current=False)
+    backend = 'db'
+    if strategy == 'counter':
+        backend = 'cadasta.workertoolbox.backends:ChordCounterDatabaseBackend'
+    app.config_from_object(Config(
+        imports=(), broker_transport='memory', CHORD_UNLOCK_STRATEGY=strategy,
+        broker_transport_options={'polling_interval': 0.01},
+        result_backend=backend + '+' + url))
+
+    @app.task(name='export.part', shared=False)
+    def part(i, delay):
+        time.sleep(delay)
+        return i
+
+    @app.task(name='export.total', shared=False)
+    def total(results):
+        return sum(results)
+
+    setup_app(app)
+    return app, part, total
+
+
+def run(strategy, chords, size, delay, directory):
+    # Celery only creates its tables in the first database it connects to
+    url = 'sqlite:///' + os.path.join(directory, 'results.db')
+    app, part, total = make_app(strategy, url)
+    sent = Counter()
+
+    def count(sender=None, **kwargs):
+        sent[sender] += 1
+
+    before_task_publish.connect(count, weak=False)
+    try:
+        # Consume each message once, ignoring the platform queue's copy
+        with start_worker(app, pool='solo', queues=['export', 'celery'],
+                          perform_ping_check=False, loglevel='ERROR'):
+            start = time.time()
+            results = [
+                chord(part.s(i, delay) for i in range(size))(total.s())
+                for _ in range(chords)
+            ]
+            for result in results:
+                result.get(timeout=60, interval=0.05)
+            elapsed = time.time() - start
+    finally:
+        before_task_publish.disconnect(count)
+    return sent, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--chords', type=int, default=3)
+    parser.add_argument('--size', type=int, default=4)
+    parser.add_argument('--task-ms', type=float, default=500)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('{:<8} {:>8} {:>8} {:>8} {:>8} {:>10}'.format(
+            'strategy', 'header', 'body', 'unlock', 'total', 'time (s)'))
+        for strategy in STRATEGIES:
+            sent, elapsed = run(
+                strategy, args.chords, args.size, args.task_ms / 1000.0,
+                directory)
+            print('{:<8} {:>8} {:>8} {:>8} {:>8} {:>10.2f}'.format(
+                strategy, sent['export.part'], sent['export.total'],
+                sent['celery.chord_unlock'], sum(sent.values()), elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Time building many Config objects from an environment of CELERY_* settings.
+
+The environment is populated with '--settings' typed settings (e.g.
+CELERY_RESULT_DB_POOL_SIZE, CELERY_QUEUES) plus as many undeclared ones,
+then '--number' configs are built: once with the environment's parsed
+snapshot cached across configs (as Config does) and once with the cache
+cleared before each config, parsing every value again.
+
+Usage:
+
+    python benchmarks/bench_config_env.py [--number 10000] [--settings 20]
+"""
+import argparse
+import os
+import time
+
+from cadasta.workertoolbox import conf
+from cadasta.workertoolbox.conf import SETTING_TYPES, Config
+
+VALUES = {
+    bool: 'False',
+    int: '7',
+    float: '1.5',
+    str: 'value',
+    dict: "{'export': {'concurrency': 2}}",
+    list: "['export', 'msg']",
+}
+# Settings whose values Config validates beyond their type
+SKIPPED = ('TUNING_PROFILE', 'CHORD_UNLOCK_STRATEGY', 'SERIALIZER_PROFILE',
+           'QUEUE_TUNING_PROFILES', 'QUEUE_LANES', 'QUEUE_BATCH_OPTIONS',
+           'PAYLOAD_STORE', 'PLATFORM_QUEUE_BINDINGS', 'LAZY_CONFIG',
+           'DECLARATION_CACHE_FILE', 'SETUP_SENTRY_LOGGING',
+           'SETUP_FILE_LOGGING', 'SETUP_TASK_METRICS', 'FOLLOWUPS_BY_REFERENCE')
+
+
+def populate_env(settings):
+    names = [name for name in sorted(SETTING_TYPES) if name not in SKIPPED]
+    for name in names[:settings]:
+        types = SETTING_TYPES[name]
+        types = types if isinstance(types, tuple) else (types,)
+        os.environ['CELERY_' + name] = VALUES[types[0]]
+    for i in range(settings):
+        os.environ['CELERY_UNDECLARED_{}'.format(i)] = str(i)
+
+
+def build(number, cached):
+    start = time.time()
+    for _ in range(number):
+        if not cached:
+            conf._env_snapshots.clear()
+        Config()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--settings', type=int, default=20)
+    args = parser.parse_args()
+    populate_env(args.settings)
+
+    print('{:<10} {:>12} {:>16}'.format('snapshot', 'total (s)', 'per config (us)'))
+    for cached in (False, True):
+        elapsed = build(args.number, cached)
+        print('{:<10} {:>12.3f} {:>16.1f}'.format(
+            'cached' if cached else 'parsed', elapsed,
+            elapsed / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare the startup cost of eager and lazy (LAZY_CONFIG) Config objects.
+
+Two measurements are made for each mode:
+
+* construct: mean time to build a Config in an already warm process
+* cold start: time for a fresh interpreter to import the toolbox, build a
+  Config and hand it to a Celery app (as a short-lived producer would)
+
+Usage:
+
+    python benchmarks/bench_config_startup.py [--number 2000] [--runs 5]
+"""
+import argparse
+import subprocess
+import sys
+import timeit
+
+COLD_START = """
+import time
+start = time.time()
+from celery import Celery
+from cadasta.workertoolbox.conf import Config
+app = Celery()
+app.config_from_object(Config(LAZY_CONFIG=%r))
+app.conf.broker_transport
+print(time.time() - start)
+"""
+
+
+def construct(lazy, number):
+    timer = timeit.Timer(
+        'Config(LAZY_CONFIG=%r)' % lazy,
+        setup='from cadasta.workertoolbox.conf import Config')
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def cold_start(lazy, runs):
+    times = [
+        float(subprocess.check_output(
+            [sys.executable, '-c', COLD_START % lazy]))
+        for _ in range(runs)
+    ]
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    print('{:<8} {:>16} {:>16}'.format('mode', 'construct (us)', 'cold (ms)'))
+    for lazy in (False, True):
+        print('{:<8} {:>16.1f} {:>16.1f}'.format(
+            'lazy' if lazy else 'eager',
+            construct(lazy, args.number) * 1e6,
+            cold_start(lazy, args.runs) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
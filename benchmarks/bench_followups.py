@@ -0,0 +1,99 @@
+"""
+Compare passing followups inline against FOLLOWUPS_BY_REFERENCE.
+
+Each hop decodes the received message, extracts its followups and publishes
+the next task with them to kombu's in-memory transport, as a task passing
+its followups on would. Followups are a chain of '--chain' signatures, each
+carrying '--kwargs-bytes' of keyword arguments. Referenced followups are
+stored in a local filesystem blob store.
+
+Usage:
+
+    python benchmarks/bench_followups.py [--hops 200] [--kwargs-bytes 2000]
+                                         [--chain 1 10 50]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+from celery import Celery
+from celery.signals import before_task_publish
+from kombu.utils.json import dumps, loads
+
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.setup import setup_exchanges
+from cadasta.workertoolbox.signals import disconnect_followups
+from cadasta.workertoolbox.utils import extract_followups
+
+
+def make_app(by_reference, directory):
+    app = Celery(set_as_current=False)
+    app.config_from_object(Config(
+        imports=(), broker_transport='memory',
+        FOLLOWUPS_BY_REFERENCE=by_reference,
+        FOLLOWUP_STORE='file://' + directory))
+    disconnect_followups()  # Only hops are measured, no task is run
+
+    @app.task(bind=True, name='export.hop', shared=False)
+    def hop(task):
+        pass
+
+    setup_exchanges(app)
+    return app, hop
+
+
+def run(by_reference, directory, hops, chain, kwargs_bytes):
+    app, hop = make_app(by_reference, directory)
+    callbacks = [
+        app.signature('export.step', kwargs={'geometry': 'x' * kwargs_bytes})
+        for _ in range(chain)
+    ]
+    sent = []
+
+    def capture(headers=None, body=None, **kwargs):
+        sent.append(dumps([headers, body]))
+
+    before_task_publish.connect(capture, weak=False)
+    try:
+        hop.apply_async(link=callbacks)
+        start = time.time()
+        for _ in range(hops):
+            headers, (args, kwargs, embed) = loads(sent[-1])
+            request = dict(headers, args=args, kwargs=kwargs, **embed)
+            hop.push_request(request)
+            try:
+                hop.apply_async(**extract_followups(hop))
+            finally:
+                hop.pop_request()
+        elapsed = time.time() - start
+    finally:
+        before_task_publish.disconnect(capture)
+    return len(sent[-1]), elapsed / hops * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--hops', type=int, default=200)
+    parser.add_argument('--kwargs-bytes', type=int, default=2000)
+    parser.add_argument('--chain', type=int, nargs='+', default=[1, 10, 50])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('{:>6} {:>14} {:>14} {:>16} {:>16}'.format(
+            'chain', 'inline (B)', 'by ref (B)', 'inline (us/hop)',
+            'by ref (us/hop)'))
+        for chain in args.chain:
+            inline_size, inline_time = run(
+                False, directory, args.hops, chain, args.kwargs_bytes)
+            ref_size, ref_time = run(
+                True, directory, args.hops, chain, args.kwargs_bytes)
+            print('{:>6} {:>14} {:>14} {:>16.1f} {:>16.1f}'.format(
+                chain, inline_size, ref_size, inline_time, ref_time))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Compare the latency of short 'msg' tasks, under a mixed load of long
+'export' tasks, with and without queue lanes.
+
+Tasks are run by an in-process worker consuming from kombu's in-memory
+transport. '--exports' export tasks, each sleeping for '--export-time'
+seconds, are sent alongside '--tasks' msg tasks at intervals of
+'--interval' seconds. A msg task's latency is the time from being sent to
+completing. Without lanes, the worker's (solo) pool executes both queues'
+tasks in turn; with lanes, each queue is executed by its own lane.
+
+Usage:
+
+    python benchmarks/bench_lanes.py [--tasks 200] [--exports 10]
+                                     [--export-time 0.5]
+"""
+import argparse
+import logging
+import time
+
+import celery.contrib.testing.tasks  # NOQA: registers celery.ping
+from celery import Celery
+from celery.contrib.testing.worker import start_worker
+
+from cadasta.workertoolbox.autoscale import percentile
+from cadasta.workertoolbox.conf import Config
+
+
+def make_app(lanes, export_concurrency):
+    app = Celery(set_as_current=False)
+    app.config_from_object(Config(
+        imports=(), broker_transport='memory',
+        broker_transport_options={'polling_interval': 0.01},
+        task_ignore_result=True,
+        QUEUE_LANES={
+            'msg': {'concurrency': 4},
+            'export': {'concurrency': export_concurrency},
+        } if lanes else {}))
+    latencies = []
+
+    @app.task(name='msg.send', shared=False)
+    def send(sent_at):
+        latencies.append(time.time() - sent_at)
+
+    @app.task(name='export.run', shared=False)
+    def export(seconds):
+        time.sleep(seconds)
+
+    with app.connection() as conn:
+        for queue in ('msg', 'export', 'celery'):
+            conn.SimpleQueue(queue).clear()
+    return app, send, export, latencies
+
+
+def run(args, lanes):
+    app, send, export, latencies = make_app(lanes, args.export_concurrency)
+    with start_worker(app, pool='solo', queues=['msg', 'export', 'celery'],
+                      perform_ping_check=False, loglevel='ERROR',
+                      shutdown_timeout=600):
+        exports = iter(range(args.exports))
+        every = max(args.tasks // max(args.exports, 1), 1)
+        for i in range(args.tasks):
+            if i % every == 0 and next(exports, None) is not None:
+                export.delay(args.export_time)
+            send.delay(time.time())
+            time.sleep(args.interval)
+        deadline = time.time() + 600
+        while len(latencies) < args.tasks and time.time() < deadline:
+            time.sleep(0.05)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tasks', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.01)
+    parser.add_argument('--exports', type=int, default=10)
+    parser.add_argument('--export-time', type=float, default=0.5)
+    parser.add_argument('--export-concurrency', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    print('{:<10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'lanes', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'max (ms)'))
+    for lanes in (False, True):
+        latencies = run(args, lanes)
+        print('{:<10} {:>9.0f} {:>9.0f} {:>9.0f} {:>9.0f}'.format(
+            'yes' if lanes else 'no',
+            *[1000 * percentile(latencies, q) for q in (0.5, 0.95, 0.99, 1)]
+        ))
+
+
+if __name__ == '__main__':
+    main()
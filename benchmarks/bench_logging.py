@@ -0,0 +1,97 @@
+"""
+Compare the latency of log calls writing to rotating log files directly
+against logging through a queue (QUEUE_LOGGING).
+
+As in a prefork worker, log calls are made from a forked child process.
+Files are written to a temporary directory and rolled over every
+'--max-bytes' bytes, with each rollover delayed by '--rollover-ms' to
+simulate slower (e.g. network) storage.
+
+Usage:
+
+    python benchmarks/bench_logging.py [--records 20000] [--max-bytes 1000000]
+                                       [--rollover-ms 50]
+"""
+import argparse
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from cadasta.workertoolbox.log import setup_queue_logging
+
+
+class SlowRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    rollover_delay = 0
+
+    def doRollover(self):
+        time.sleep(self.rollover_delay)
+        logging.handlers.RotatingFileHandler.doRollover(self)
+
+
+def make_logger(name, directory, max_bytes):
+    logger = logging.getLogger('bench_logging.' + name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = SlowRotatingFileHandler(
+        os.path.join(directory, name + '.log'),
+        maxBytes=max_bytes, backupCount=2)
+    handler.setFormatter(logging.Formatter(
+        '[%(asctime)s: %(levelname)s/%(processName)s %(message)s'))
+    logger.handlers = [handler]
+    return logger
+
+
+def timed(logger, records, conn):
+    latencies = []
+    for i in range(records):
+        start = time.time()
+        logger.info('Processed task %s of export %r', i, 'project-slug')
+        latencies.append(time.time() - start)
+    latencies.sort()
+    conn.send((
+        sum(latencies) / records * 1e6,
+        latencies[int(records * 0.99)] * 1e6,
+        latencies[-1] * 1e6,
+    ))
+
+
+def timed_in_child(logger, records):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    child = multiprocessing.Process(
+        target=timed, args=(logger, records, child_conn))
+    child.start()
+    result = parent_conn.recv()
+    child.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--max-bytes', type=int, default=1000000)
+    parser.add_argument('--rollover-ms', type=float, default=50)
+    args = parser.parse_args()
+    SlowRotatingFileHandler.rollover_delay = args.rollover_ms / 1000.0
+
+    directory = tempfile.mkdtemp()
+    try:
+        direct = make_logger('direct', directory, args.max_bytes)
+        queued = make_logger('queued', directory, args.max_bytes)
+        listener = setup_queue_logging(queued)
+
+        print('{:<8} {:>10} {:>10} {:>10}'.format(
+            'mode', 'mean (us)', 'p99 (us)', 'max (us)'))
+        for label, logger in (('direct', direct), ('queued', queued)):
+            print('{:<8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                label, *timed_in_child(logger, args.records)))
+        listener.stop()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
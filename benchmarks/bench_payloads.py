@@ -0,0 +1,81 @@
+"""
+Compare JSON task payloads against the payload offloading codec
+(PAYLOAD_STORE).
+
+Payloads are polygons of increasing numbers of random coordinates. For
+each, the bytes sent to the broker (base64 encoded twice, as by kombu's
+SQS transport, which encodes the payload within the message envelope and
+then the envelope, which isn't counted) and the rate at which payloads are encoded and decoded are
+reported. Offloaded payloads are written to a local filesystem blob store.
+
+Usage:
+
+    python benchmarks/bench_payloads.py [--repeat 20]
+                                        [--points 50 1000 10000 50000]
+"""
+import argparse
+import base64
+import random
+import shutil
+import tempfile
+import time
+
+from kombu.utils.json import dumps, loads
+
+from cadasta.workertoolbox.blobs import FileSystemBlobStore
+from cadasta.workertoolbox.serialization import (
+    SQS_MAX_SIZE, OffloadingCodec)
+
+
+def geometry(points):
+    rand = random.Random(points)
+    return {'type': 'Polygon', 'coordinates': [
+        [round(rand.uniform(-180, 180), 6), round(rand.uniform(-90, 90), 6)]
+        for _ in range(points)
+    ]}
+
+
+def timed(encode, decode, payload, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        data = encode(payload)
+        decode(data)
+    return repeat / (time.time() - start), len(
+        base64.b64encode(base64.b64encode(data)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--points', type=int, nargs='+',
+                        default=[50, 1000, 10000, 50000])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        codec = OffloadingCodec(FileSystemBlobStore(directory))
+
+        def encode_json(obj):
+            return dumps(obj).encode('utf-8')
+
+        def decode_json(data):
+            return loads(data.decode('utf-8'))
+
+        print('{:>8} {:>12}  {:>12} {:>12} {:>12}'.format(
+            'points', 'json (B)', 'offload (B)', 'json (/s)', 'offload (/s)'))
+        for points in args.points:
+            payload = geometry(points)
+            json_rate, json_size = timed(
+                encode_json, decode_json, payload, args.repeat)
+            offload_rate, offload_size = timed(
+                codec.encode, codec.decode, payload, args.repeat)
+            print('{:>8} {:>12}{} {:>12} {:>12.1f} {:>12.1f}'.format(
+                points, json_size, '*' if json_size > SQS_MAX_SIZE else ' ',
+                offload_size, json_rate, offload_rate))
+        print('* Exceeds the 256 KB SQS message size limit')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Compare publishing many tasks with 'apply_async' against 'publish_many'.
+
+Publish rate is measured against kombu's in-memory transport. The number of
+SQS API requests made is counted against a mocked SQS client.
+
+Usage:
+
+    python benchmarks/bench_publish.py [--tasks 5000]
+"""
+import argparse
+import time
+
+from celery import Celery
+from mock import patch, MagicMock
+
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.publish import publish_many
+from cadasta.workertoolbox.setup import setup_exchanges
+
+
+def make_app(**kwargs):
+    app = Celery(set_as_current=False)
+    app.config_from_object(Config(imports=(), **kwargs))
+    setup_exchanges(app)
+    return app
+
+
+def signatures(app, count):
+    return [
+        app.signature('{}.task'.format(('export', 'msg')[i % 2]), args=(i,))
+        for i in range(count)
+    ]
+
+
+def apply_each(app, sigs):
+    return [sig.apply_async() for sig in sigs]
+
+
+def timed(func, app, count):
+    sigs = signatures(app, count)
+    start = time.time()
+    func(app, sigs)
+    return count / (time.time() - start)
+
+
+def sqs_requests(func, count):
+    sqs = MagicMock()
+    sqs.send_message_batch.return_value = {}
+    with patch('kombu.transport.SQS.Channel.sqs', sqs):
+        app = make_app()
+        sqs.reset_mock()
+        func(app, signatures(app, count))
+    return sqs.send_message.call_count + sqs.send_message_batch.call_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tasks', type=int, default=5000)
+    args = parser.parse_args()
+
+    app = make_app(broker_url='memory://', broker_transport='memory')
+    print('{:<14} {:>16} {:>16}'.format(
+        'method', 'memory (msg/s)', 'SQS requests'))
+    for label, func in (('apply_async', apply_each),
+                        ('publish_many', publish_many)):
+        print('{:<14} {:>16.0f} {:>16}'.format(
+            label, timed(func, app, args.tasks),
+            sqs_requests(func, args.tasks)))
+
+
+if __name__ == '__main__':
+    main()
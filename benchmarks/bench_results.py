@@ -0,0 +1,98 @@
+"""
+Compare fetching the results of a large group one task id at a time
+against iter_task_meta's chunked queries.
+
+'--tasks' results are written to a temporary SQLite database, then read
+back through Celery's database result backend with a query per id (as
+GroupResult.get does) and with iter_task_meta, for each '--chunk-size'.
+The number of SELECT statements issued is reported alongside the time
+taken.
+
+Usage:
+
+    python benchmarks/bench_results.py [--tasks 5000]
+                                       [--chunk-size 100 500]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+from celery import Celery, states
+from celery.backends.database.models import Task
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.results import iter_task_meta
+
+
+def make_backend(url, tasks):
+    app = Celery(set_as_current=False)
+    app.config_from_object(Config(
+        imports=(), broker_transport='memory', result_backend='db+' + url))
+    backend = app.backend
+    session = backend.ResultSession()
+    engine = session.get_bind()
+    session.close()
+    with engine.begin() as conn:
+        conn.execute(Task.__table__.insert(), [{
+            'task_id': 'task-{}'.format(i),
+            'status': states.SUCCESS,
+            'result': {'row': i, 'path': '/exports/{}'.format(i)},
+            'date_done': datetime.utcnow(),
+        } for i in range(tasks)])
+    selects = []
+
+    def on_execute(conn, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            selects.append(statement)
+
+    # Unless forked, Celery's backend creates an engine per session
+    event.listen(Engine, 'before_cursor_execute', on_execute)
+    return backend, selects
+
+
+def run(label, fetch, selects):
+    del selects[:]
+    start = time.time()
+    count = sum(1 for _ in fetch())
+    elapsed = time.time() - start
+    print('{:<16} {:>8} {:>10} {:>10.3f} {:>12.0f}'.format(
+        label, count, len(selects), elapsed, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tasks', type=int, default=5000)
+    parser.add_argument('--chunk-size', type=int, nargs='+',
+                        default=[100, 500])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        url = 'sqlite:///' + os.path.join(directory, 'results.db')
+        backend, selects = make_backend(url, args.tasks)
+        task_ids = ['task-{}'.format(i) for i in range(args.tasks)]
+
+        def per_id():
+            for task_id in task_ids:
+                # Skip Celery's in-memory cache of completed results
+                backend._cache.clear()
+                yield backend.get_task_meta(task_id)
+
+        print('{:<16} {:>8} {:>10} {:>10} {:>12}'.format(
+            'method', 'results', 'queries', 'seconds', 'results/s'))
+        run('per id', per_id, selects)
+        for chunk_size in args.chunk_size:
+            run('chunks of {}'.format(chunk_size),
+                lambda: iter_task_meta(backend, task_ids, chunk_size),
+                selects)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure publish-side routing overhead of Config._route_task.
+
+Three variants are timed over a set of task names, both calling the route
+function directly and through Celery's router (as 'apply_async' does):
+
+* before: the previous behaviour, building a new Exchange per call
+* uncached: memoized exchange, routing cache disabled (ROUTE_CACHE_SIZE=0)
+* cached: memoized exchange and routing cache (the default)
+
+Usage:
+
+    python benchmarks/bench_routing.py [--calls 100000] [--names 50]
+"""
+import argparse
+import time
+
+from celery import Celery
+from kombu import Exchange
+
+from cadasta.workertoolbox.conf import Config
+
+
+class BeforeConfig(Config):
+    """ Reproduces routing prior to memoization """
+
+    def _route_task(self, name, args, kwargs, options, task=None, **kw):
+        return {
+            'routing_key': name.split('.')[0],
+            'exchange': Exchange(
+                self.task_default_exchange,
+                self.task_default_exchange_type),
+        }
+
+
+def bench(conf, names, calls):
+    app = Celery(set_as_current=False)
+    app.config_from_object(conf)
+    router = app.amqp.router
+    route_task = conf.task_routes
+    timings = {}
+
+    start = time.time()
+    for i in range(calls):
+        route_task(names[i % len(names)], (), {}, {})
+    timings['direct'] = (time.time() - start) / calls
+
+    start = time.time()
+    for i in range(calls):
+        router.route({}, names[i % len(names)])
+    timings['router'] = (time.time() - start) / calls
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--names', type=int, default=50)
+    args = parser.parse_args()
+
+    names = ['export.task_{}'.format(i) for i in range(args.names)]
+    variants = (
+        ('before', BeforeConfig(imports=())),
+        ('uncached', Config(imports=(), ROUTE_CACHE_SIZE=0)),
+        ('cached', Config(imports=())),
+    )
+    print('{:<10} {:>14} {:>14}'.format('variant', 'direct (us)', 'router (us)'))
+    for label, conf in variants:
+        timings = bench(conf, names, args.calls)
+        print('{:<10} {:>14.2f} {:>14.2f}'.format(
+            label, timings['direct'] * 1e6, timings['router'] * 1e6))
+    print('cache: {}'.format(variants[-1][1].route_cache_info()))
+
+
+if __name__ == '__main__':
+    main()
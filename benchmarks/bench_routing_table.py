@@ -0,0 +1,87 @@
+"""
+Compare resolving the destination queues of task names through kombu's
+virtual topic exchange against a compiled RoutingTable.
+
+A Config is built with '--queues' queues, whose platform queue is bound
+with a pattern per queue (e.g. 'queue_3.#'), plus '#'. For '--names' task
+names, spread across the queues, each method reports the time taken to
+resolve every name's queues: kombu matches each routing key against every
+binding of the exchange in turn, the table matches a batch of names in one
+pass over its trie.
+
+Usage:
+
+    python benchmarks/bench_routing_table.py [--queues 10 100 1000]
+                                             [--names 10000]
+"""
+import argparse
+import time
+
+from celery import Celery
+from kombu.transport.virtual.exchange import TopicExchange
+
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.routing import RoutingTable
+
+
+def make_config(queues):
+    names = ['queue_{}'.format(i) for i in range(queues)]
+    return Config(
+        imports=(), broker_transport='memory', QUEUES=names,
+        PLATFORM_QUEUE_BINDINGS=['{}.#'.format(q) for q in names] + ['#'])
+
+
+def kombu_resolve(app, names):
+    """ Queues of each task name, as a virtual transport routes them """
+    exchange = TopicExchange(None)
+    table = [
+        exchange.prepare_bind(queue.name, binding.exchange.name,
+                              binding.routing_key, None)
+        for queue in app.amqp.queues.values()
+        for binding in [queue] + list(queue.bindings)
+        if binding.exchange is not None
+    ]
+    router = app.amqp.router
+    return {
+        name: exchange.lookup(
+            table, None, router.route({}, name)['routing_key'], None)
+        for name in names
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--queues', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--names', type=int, default=10000)
+    args = parser.parse_args()
+
+    print('{:>7} {:>10} {:>12} {:>12} {:>12}'.format(
+        'queues', 'names', 'kombu (s)', 'build (s)', 'table (s)'))
+    for queues in args.queues:
+        conf = make_config(queues)
+        app = Celery(set_as_current=False)
+        app.config_from_object(conf)
+        names = [
+            'queue_{}.task_{}'.format(i % queues, i)
+            for i in range(args.names)
+        ]
+
+        start = time.time()
+        expected = kombu_resolve(app, names)
+        kombu_time = time.time() - start
+
+        start = time.time()
+        table = RoutingTable.from_app(app)
+        build_time = time.time() - start
+        start = time.time()
+        resolved = table.resolve(names)
+        table_time = time.time() - start
+
+        assert resolved == expected
+        print('{:>7} {:>10} {:>12.3f} {:>12.4f} {:>12.4f}'.format(
+            queues, args.names, kombu_time, build_time, table_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Compare Celery's default JSON serializer against the 'fast'
+SERIALIZER_PROFILE.
+
+Payloads are representative of export tasks: feature attribute records
+(with timestamps and UUIDs), a polygon's coordinates and a small message.
+The fast codec uses orjson when installed, otherwise the standard library's
+encoder and kombu's decoder.
+
+Usage:
+
+    python benchmarks/bench_serializers.py [--repeat 200] [--features 500]
+"""
+import argparse
+import datetime
+import random
+import time
+import uuid
+
+from kombu.utils.json import dumps, loads
+
+from cadasta.workertoolbox.serialization import json_codec
+
+
+def payloads(features):
+    rand = random.Random(features)
+    created = datetime.datetime(2018, 1, 1)
+    return [
+        ('features', [{
+            'id': uuid.UUID(int=rand.getrandbits(128)),
+            'name': 'Parcel {}'.format(i),
+            'area': rand.uniform(0, 1e4),
+            'tenure_type': rand.choice(['FH', 'LH', 'CU']),
+            'owners': ['Party {}'.format(rand.randint(0, 999))],
+            'surveyed': rand.random() > 0.5,
+            'notes': None,
+            'created': created + datetime.timedelta(seconds=i),
+        } for i in range(features)]),
+        ('geometry', {'type': 'Polygon', 'coordinates': [
+            [rand.uniform(-180, 180), rand.uniform(-90, 90)]
+            for _ in range(features * 10)
+        ]}),
+        ('message', {'project': 'abc123', 'user': 42, 'format': 'shp'}),
+    ]
+
+
+def timed(func, arg, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        result = func(arg)
+    return repeat / (time.time() - start), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--features', type=int, default=500)
+    args = parser.parse_args()
+    fast_dumps, fast_loads = json_codec()
+    print('Fast codec: {}'.format(fast_dumps.__module__))
+
+    print('{:<10} {:<8} {:>10} {:>12} {:>12}'.format(
+        'payload', 'codec', 'bytes', 'encode (/s)', 'decode (/s)'))
+    for name, payload in payloads(args.features):
+        for label, encode, decode in (('default', dumps, loads),
+                                      ('fast', fast_dumps, fast_loads)):
+            encode_rate, data = timed(encode, payload, args.repeat)
+            decode_rate, _ = timed(decode, data, args.repeat)
+            print('{:<10} {:<8} {:>10} {:>12.1f} {:>12.1f}'.format(
+                name, label, len(data), encode_rate, decode_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare consumer throughput of the TUNING_PROFILES.
+
+Messages are consumed from kombu's in-memory transport by a channel that,
+like the SQS channel, receives up to 'receive_batch_size' messages (as
+allowed by the consumer's prefetch limit) per request, with each request
+delayed by a simulated network round trip.
+
+Usage:
+
+    python benchmarks/bench_tuning.py [--messages 2000] [--rtt-ms 5]
+                                      [--task-ms 0] [--concurrency 4]
+"""
+import argparse
+import time
+
+from kombu import Connection, Consumer, Producer, Queue
+from kombu.five import Empty
+from kombu.transport import memory
+from kombu.utils import scheduling
+
+from cadasta.workertoolbox.conf import Config, TUNING_PROFILES
+
+
+class Channel(memory.Channel):
+    rtt = 0
+    receives = 0
+
+    def drain_events(self, timeout=None, callback=None):
+        if not self._consumers or not self.qos.can_consume():
+            raise Empty()
+        self._poll(self.cycle, callback, timeout=timeout)
+
+    def _reset_cycle(self):
+        self._cycle = scheduling.FairCycle(
+            self._get_bulk, self._active_queues, Empty)
+
+    def _get_bulk(self, queue, callback=None):
+        Channel.receives += 1
+        time.sleep(self.rtt)
+        limit = self.qos.can_consume_max_estimate() or 10
+        batch_size = self.connection.client.transport_options.get(
+            'receive_batch_size', 10)
+        messages = []
+        for i in range(max(min(limit, batch_size), 1)):
+            try:
+                messages.append(self._get(queue))
+            except Empty:
+                break
+        if not messages:
+            raise Empty()
+        for message in messages:
+            self.connection._deliver(message, queue)
+
+
+class Transport(memory.Transport):
+    Channel = Channel
+
+
+def run(profile, messages, rtt, task_time, concurrency):
+    conf = Config(imports=(), TUNING_PROFILE=profile)
+    queue = Queue('bench-tuning')
+    Channel.rtt, Channel.receives = rtt, 0
+    with Connection(
+            transport=Transport,
+            transport_options=conf.broker_transport_options) as conn:
+        channel = conn.channel()
+        queue(channel).declare()
+        channel.queue_purge(queue.name)
+        producer = Producer(channel, routing_key=queue.name)
+        for i in range(messages):
+            producer.publish({'i': i})
+
+        consumed = []
+
+        def on_message(body, message):
+            time.sleep(task_time)
+            message.ack()
+            consumed.append(body)
+
+        consumer = Consumer(channel, [queue], callbacks=[on_message])
+        consumer.qos(prefetch_count=(
+            conf.worker_prefetch_multiplier * concurrency))
+        start = time.time()
+        with consumer:
+            while len(consumed) < messages:
+                conn.drain_events(timeout=1)
+        return messages / (time.time() - start), Channel.receives
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--rtt-ms', type=float, default=5)
+    parser.add_argument('--task-ms', type=float, default=0)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    print('{:<14} {:>10} {:>10}'.format('profile', 'msg/s', 'receives'))
+    for profile in sorted(TUNING_PROFILES):
+        rate, receives = run(
+            profile, args.messages, args.rtt_ms / 1000.0,
+            args.task_ms / 1000.0, args.concurrency)
+        print('{:<14} {:>10.0f} {:>10}'.format(profile, rate, receives))
+
+
+if __name__ == '__main__':
+    main()
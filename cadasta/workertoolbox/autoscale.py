@@ -0,0 +1,299 @@
+import heapq
+import logging
+import math
+from collections import deque
+
+from celery.five import monotonic
+from celery.utils.threads import bgThread
+from celery.worker import state
+from celery.worker.autoscale import AUTOSCALE_KEEPALIVE, Autoscaler
+
+from . import lanes
+
+logger = logging.getLogger(__name__)
+
+
+def _pool_requests(requests):
+    """ Number of requests for the pool, leaving out those of lanes """
+    return sum(
+        1 for request in list(requests)
+        if not isinstance(request, lanes.LaneRequest))
+
+
+class ScalingPolicy(object):
+    """
+    Chooses a pool's concurrency from the depth of its queues and the
+    recent runtime of its tasks: enough processes for the tasks being
+    executed, plus enough to work through the messages waiting in the queues
+    within 'target_wait' seconds. Task runtime is estimated from the number
+    of active tasks and completions between samples (by Little's law), as
+    an exponentially weighted moving average with weight 'smoothing'.
+
+    The pool is grown as soon as more processes are needed, but only shrunk
+    once fewer have been needed for 'cooldown' seconds, so that it doesn't
+    flap between sizes with bursts of messages.
+    """
+
+    def __init__(self, min_concurrency, max_concurrency, target_wait=10.0,
+                 cooldown=30.0, smoothing=0.3):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_wait = target_wait
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.runtime = None
+        self._last_sample = None
+        self._shrink_since = None
+
+    def observe(self, now, active, completed):
+        """ Update the runtime estimate with a sample of the pool """
+        if self._last_sample is not None:
+            then, was_active, was_completed = self._last_sample
+            finished = completed - was_completed
+            if finished > 0 and now > then:
+                busy = (active + was_active) / 2.0 * (now - then)
+                runtime = busy / finished
+                if self.runtime is not None:
+                    runtime = (self.smoothing * runtime +
+                               (1 - self.smoothing) * self.runtime)
+                self.runtime = runtime
+        self._last_sample = (now, active, completed)
+
+    def desired(self, depth, active):
+        """ Concurrency needed for 'active' tasks and 'depth' messages """
+        if self.runtime is None:
+            backlog = depth  # Until tasks complete, a process per message
+        else:
+            backlog = int(math.ceil(depth * self.runtime / self.target_wait))
+        return max(self.min_concurrency,
+                   min(self.max_concurrency, active + backlog))
+
+    def decide(self, now, processes, depth, active, completed):
+        """
+        Concurrency that a pool of 'processes' should be scaled to, given
+        the number of messages waiting ('depth'), tasks being executed
+        ('active') and the total number of tasks 'completed'. A 'depth' of
+        None (unknown) keeps the pool's concurrency.
+        """
+        self.observe(now, active, completed)
+        if depth is None:
+            return processes
+        desired = self.desired(depth, active)
+        if desired >= processes:
+            self._shrink_since = None
+            return desired
+        if self._shrink_since is None:
+            self._shrink_since = now
+        if now - self._shrink_since < self.cooldown:
+            return processes
+        self._shrink_since = None
+        return desired
+
+
+class DepthSampler(bgThread):
+    """
+    Thread calling 'sample' every 'interval' seconds, so that requests to
+    the broker don't block the worker's event loop
+    """
+
+    def __init__(self, sample, interval):
+        super(DepthSampler, self).__init__()
+        self.sample = sample
+        self.interval = interval
+
+    def body(self):
+        self.sample()
+        self._is_shutdown.wait(self.interval)
+
+
+class QueueDepthAutoscaler(Autoscaler):
+    """
+    Celery autoscaler (see 'worker_autoscaler') sizing the pool with a
+    ScalingPolicy, rather than by the number of reserved tasks. The depth
+    of the queues consumed by the worker is sampled from the broker (e.g.
+    SQS's ApproximateNumberOfMessages) every 'sample_interval' seconds by a
+    DepthSampler thread, and scaling decisions use the last sample. Run the
+    worker with '--autoscale=max,min'.
+    """
+
+    def __init__(self, pool, max_concurrency, min_concurrency=0,
+                 worker=None, keepalive=AUTOSCALE_KEEPALIVE, mutex=None):
+        conf = worker.app.conf
+        self.policy = ScalingPolicy(
+            min_concurrency, max_concurrency,
+            target_wait=getattr(conf, 'AUTOSCALE_TARGET_WAIT', 10.0),
+            cooldown=getattr(conf, 'AUTOSCALE_COOLDOWN', keepalive))
+        self.sample_interval = getattr(
+            conf, 'AUTOSCALE_SAMPLE_INTERVAL', 1.0)
+        self._connection = None
+        self._depth = None
+        self._sampler = None
+        super(QueueDepthAutoscaler, self).__init__(
+            pool, max_concurrency, min_concurrency, worker=worker,
+            keepalive=keepalive, mutex=mutex)
+
+    # Bounds are held by the policy, so that 'update' also applies to it
+    @property
+    def max_concurrency(self):
+        return self.policy.max_concurrency
+
+    @max_concurrency.setter
+    def max_concurrency(self, value):
+        self.policy.max_concurrency = value
+
+    @property
+    def min_concurrency(self):
+        return self.policy.min_concurrency
+
+    @min_concurrency.setter
+    def min_concurrency(self, value):
+        self.policy.min_concurrency = value
+
+    def _sample_depth(self):
+        """ Number of messages waiting in the consumed queues """
+        consumer = self.worker.consumer
+        task_consumer = getattr(consumer, 'task_consumer', None)
+        if task_consumer is None:
+            return None  # Not yet consuming
+        if self._connection is None:
+            self._connection = consumer.app.connection_for_read()
+        channel = self._connection.default_channel
+        return sum(
+            channel.queue_declare(queue=queue.name, passive=True).message_count
+            for queue in task_consumer.queues
+        )
+
+    def sample(self):
+        """
+        Sample the depth of the consumed queues for queue_depth, returning
+        it, or None if the broker can't be reached. Called by the sampler.
+        """
+        try:
+            self._depth = self._sample_depth()
+        except Exception as exc:
+            logger.warning("Unable to sample queue depth: %r", exc)
+            self._depth = None
+            if self._connection is not None:
+                self._connection.release()
+                self._connection = None
+        return self._depth
+
+    def queue_depth(self):
+        """
+        Messages waiting in the broker's queues, as last sampled, or
+        reserved by the worker, or None until sampled or if the broker
+        can't be reached. Starts the sampler on first use.
+        """
+        if self._sampler is None:
+            self._sampler = DepthSampler(self.sample, self.sample_interval)
+            self._sampler.start()
+        depth = self._depth
+        if depth is None:
+            return None
+        return depth + _pool_requests(state.reserved_requests) - self.active
+
+    @property
+    def active(self):
+        return _pool_requests(state.active_requests)
+
+    @property
+    def completed(self):
+        return (
+            state.all_total_count[0] - lanes.total_count[0] - self.active)
+
+    def _maybe_scale(self, req=None):
+        procs = self.processes
+        now = monotonic()
+        target = self.policy.decide(
+            now, procs, self.queue_depth(), self.active, self.completed)
+        if target > procs:
+            self.scale_up(target - procs)
+            return True
+        if target < procs:
+            self._shrink(procs - target)
+            return True
+
+    def stop(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+        super(QueueDepthAutoscaler, self).stop()
+
+    def info(self):
+        info = super(QueueDepthAutoscaler, self).info()
+        info.update(depth=self._depth, runtime=self.policy.runtime)
+        return info
+
+
+def percentile(values, q):
+    """ Value at quantile 'q' of sorted 'values' (nearest rank) """
+    if not values:
+        return None
+    rank = int(math.ceil(q * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+def simulate(policy, trace, interval=1.0, concurrency=None):
+    """
+    Replay a trace of (arrival time, runtime) tasks, sorted by arrival,
+    through a pool scaled by 'policy' every 'interval' seconds (or of a
+    fixed 'concurrency', without a policy). Reports the pool's utilisation
+    (process time spent executing tasks), its mean and maximum concurrency,
+    and percentiles of the time that tasks waited to be executed.
+    """
+    if concurrency is None:
+        concurrency = policy.min_concurrency
+    arrivals = deque(trace)
+    waiting = deque()
+    running = []  # Heap of finish times
+    waits = []
+    completed = 0
+    busy = provisioned = 0.0
+    peak = concurrency
+    now = 0.0
+
+    def start(at):
+        while waiting and len(running) < concurrency:
+            arrival, runtime = waiting.popleft()
+            waits.append(at - arrival)
+            heapq.heappush(running, at + runtime)
+
+    while arrivals or waiting or running:
+        tick = now + interval
+        while True:
+            next_arrival = arrivals[0][0] if arrivals else float('inf')
+            next_finish = running[0] if running else float('inf')
+            at = min(next_arrival, next_finish)
+            if at > tick:
+                break
+            busy += len(running) * (at - now)
+            now = at
+            if next_finish <= next_arrival:
+                heapq.heappop(running)
+                completed += 1
+            else:
+                waiting.append(arrivals.popleft())
+            start(now)
+        busy += len(running) * (tick - now)
+        provisioned += concurrency * interval
+        now = tick
+        if policy is not None:
+            concurrency = policy.decide(
+                now, concurrency, len(waiting), len(running), completed)
+            peak = max(peak, concurrency)
+            start(now)
+
+    waits.sort()
+    return {
+        'tasks': len(waits),
+        'duration': now,
+        'utilisation': busy / provisioned if provisioned else 0.0,
+        'mean_concurrency': provisioned / now if now else 0.0,
+        'max_concurrency': peak,
+        'wait': {
+            'p50': percentile(waits, 0.5),
+            'p95': percentile(waits, 0.95),
+            'p99': percentile(waits, 0.99),
+            'max': waits[-1] if waits else None,
+        },
+    }
@@ -0,0 +1,356 @@
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import sqlalchemy as sa
+from celery import states
+from celery.backends.database import DatabaseBackend, session_cleanup
+from celery.backends.database.models import Task
+from celery.backends.database.session import ResultModelBase
+from celery.canvas import maybe_signature
+from celery.exceptions import ChordError
+from celery.result import GroupResult, allow_join_result, result_from_tuple
+from kombu.utils.compat import register_after_fork
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+BUFFERED_STATES = frozenset([states.STARTED, states.SUCCESS])
+# Value of ChordCounter.remaining once the chord body has been applied
+CHORD_APPLIED = -1
+
+
+def _after_fork_reset_backend(backend):
+    backend._reset()
+
+
+def build_upsert(table, rows, dialect_name):
+    """
+    Build a single multi-row statement that inserts the provided rows,
+    replacing any existing rows with the same 'task_id'. PostgreSQL uses
+    'INSERT ... ON CONFLICT DO UPDATE', other dialects (e.g. the SQLite
+    stand-in used for testing) use 'INSERT OR REPLACE'.
+    """
+    if dialect_name == 'postgresql':
+        stmt = postgresql.insert(table).values(rows)
+        return stmt.on_conflict_do_update(
+            index_elements=[table.c.task_id],
+            set_={k: stmt.excluded[k] for k in rows[0] if k != 'task_id'})
+    return table.insert().prefix_with('OR REPLACE').values(rows)
+
+
+class ChordCounter(ResultModelBase):
+    """ Number of header tasks of a chord yet to complete """
+    __tablename__ = 'cadasta_chordcounter'
+
+    group_id = sa.Column(sa.String(155), primary_key=True)
+    remaining = sa.Column(sa.Integer, nullable=False)
+
+
+class ChordCounterMixin(object):
+    """
+    With the 'counter' CHORD_UNLOCK_STRATEGY, a chord's body is applied by
+    the last of its header tasks to complete, rather than by a
+    celery.chord_unlock task polling the header's results. Each header task
+    decrements a row of the 'cadasta_chordcounter' table, created with the
+    size of the chord by whichever finishes first. As header tasks may all
+    complete before the producer saves the chord's group, both the producer
+    and the last header task attempt to apply the body, and whichever
+    atomically claims the completed counter does so.
+    """
+
+    @property
+    def counts_chords(self):
+        strategy = getattr(self.app.conf, 'CHORD_UNLOCK_STRATEGY', None)
+        return strategy == 'counter'
+
+    def apply_chord(self, header_result, body, **kwargs):
+        if not self.counts_chords:
+            return super(ChordCounterMixin, self).apply_chord(
+                header_result, body, **kwargs)
+        self.ensure_chords_allowed()
+        header_result.save(backend=self)
+        self._apply_chord_body(header_result.id, body)
+
+    def on_chord_part_return(self, request, state, result, **kwargs):
+        if not self.counts_chords:
+            return super(ChordCounterMixin, self).on_chord_part_return(
+                request, state, result, **kwargs)
+        group_id = request.group
+        if not group_id:
+            return
+        # Results must be visible to whichever header task completes last
+        flush = getattr(self, 'flush', None)
+        if flush is not None:
+            flush()
+        try:
+            remaining = self._decrement_chord(
+                group_id, request.chord['chord_size'])
+        except IntegrityError:
+            # Another header task created the counter first
+            remaining = self._decrement_chord(
+                group_id, request.chord['chord_size'])
+        if remaining == 0 and self.restore_group(group_id) is not None:
+            self._apply_chord_body(group_id, request.chord)
+
+    def _chord_session(self):
+        session = self.ResultSession()
+        if not getattr(self, '_chord_table_created', False):
+            # Celery only creates its models' tables for the first backend
+            # to connect, which may not have imported this module
+            ChordCounter.__table__.create(session.get_bind(), checkfirst=True)
+            self._chord_table_created = True
+        return session
+
+    def _decrement_chord(self, group_id, size):
+        """ Decrement a chord's counter, returning the remaining count """
+        table = ChordCounter.__table__
+        row = table.c.group_id == group_id
+        session = self._chord_session()
+        with session_cleanup(session):
+            updated = session.execute(table.update().where(row).values(
+                remaining=table.c.remaining - 1)).rowcount
+            if not updated:
+                session.execute(table.insert().values(
+                    group_id=group_id, remaining=size - 1))
+            remaining = session.execute(
+                sa.select([table.c.remaining]).where(row)).scalar()
+            session.commit()
+            return remaining
+
+    def _claim_chord(self, group_id):
+        """ Mark a completed chord as applied, if no one else has """
+        table = ChordCounter.__table__
+        session = self._chord_session()
+        with session_cleanup(session):
+            claimed = session.execute(table.update().where(
+                (table.c.group_id == group_id) & (table.c.remaining == 0)
+            ).values(remaining=CHORD_APPLIED)).rowcount
+            session.commit()
+            return bool(claimed)
+
+    def _delete_chord(self, group_id):
+        table = ChordCounter.__table__
+        session = self._chord_session()
+        with session_cleanup(session):
+            session.execute(
+                table.delete().where(table.c.group_id == group_id))
+            session.commit()
+
+    def _apply_chord_body(self, group_id, body):
+        """ Mirrors Celery's chord_unlock, once the chord is complete """
+        if not self._claim_chord(group_id):
+            return
+        callback = maybe_signature(body, app=self.app)
+        # Bind the restored results to this backend's app
+        deps = GroupResult(group_id, [
+            result_from_tuple(r.as_tuple(), app=self.app)
+            for r in self.restore_group(group_id).results
+        ], app=self.app)
+        try:
+            with allow_join_result():
+                ret = deps.join(timeout=3.0, propagate=True)
+        except Exception as exc:
+            culprit = next((
+                r for r in deps.results
+                if r.state in states.PROPAGATE_STATES), None)
+            reason = repr(exc)
+            if culprit is not None:
+                reason = 'Dependency {0.id} raised {1!r}'.format(culprit, exc)
+            logger.exception('Chord %r raised: %r', group_id, reason)
+            self.chord_error_from_stack(callback, ChordError(reason))
+        else:
+            try:
+                callback.delay(ret)
+            except Exception as exc:
+                logger.exception('Chord %r raised: %r', group_id, exc)
+                self.chord_error_from_stack(
+                    callback, ChordError('Callback error: {0!r}'.format(exc)))
+        finally:
+            deps.delete()
+            self._delete_chord(group_id)
+
+
+class ChordCounterDatabaseBackend(ChordCounterMixin, DatabaseBackend):
+    """ SQLAlchemy result backend supporting the 'counter' strategy """
+
+
+class BufferedDatabaseBackend(ChordCounterMixin, DatabaseBackend):
+    """
+    SQLAlchemy result backend that keeps a bounded connection pool and
+    buffers STARTED and SUCCESS states in memory. Buffered states are
+    coalesced per task and written in batched multi-row upserts once either
+    'buffer_size' results are pending or 'flush_interval' seconds have
+    passed. All other states are written immediately. Once closed, states
+    are written as they're stored. Buffered states are lost should the
+    process be killed (e.g. by SIGKILL) before they're flushed, although
+    their tasks may already have been acknowledged.
+    """
+
+    def __init__(self, buffer_size=None, flush_interval=None, pool_size=None,
+                 max_overflow=None, **kwargs):
+        super(BufferedDatabaseBackend, self).__init__(**kwargs)
+        conf = self.app.conf
+
+        def option(value, setting, default):
+            # An explicit 0 (e.g. no overflow) is kept
+            return getattr(conf, setting, default) if value is None else value
+        self.buffer_size = option(
+            buffer_size, 'RESULT_BUFFER_MAX_SIZE', 100)
+        self.flush_interval = option(
+            flush_interval, 'RESULT_BUFFER_FLUSH_INTERVAL', 1.0)
+        self.pool_size = option(pool_size, 'RESULT_DB_POOL_SIZE', 5)
+        self.max_overflow = option(
+            max_overflow, 'RESULT_DB_MAX_OVERFLOW', 10)
+        self._reset()
+        register_after_fork(self, _after_fork_reset_backend)
+        atexit.register(self.close)
+
+    def _reset(self):
+        """ Drop state that must not be shared with a parent process """
+        self._engine = None
+        self._session_factory = None
+        self._buffer = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._engine_lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+
+    @property
+    def engine(self):
+        # The flusher thread may also be creating the engine
+        with self._engine_lock:
+            if self._engine is None:
+                options = dict(self.engine_options)
+                options.setdefault('poolclass', QueuePool)
+                options.setdefault('pool_size', self.pool_size)
+                options.setdefault('max_overflow', self.max_overflow)
+                if self.url.startswith('sqlite'):
+                    # Pooled connections are shared with the flusher thread
+                    options.setdefault(
+                        'connect_args', {'check_same_thread': False})
+                engine = create_engine(self.url, **options)
+                ResultModelBase.metadata.create_all(engine)
+                self._session_factory = sessionmaker(bind=engine)
+                self._engine = engine
+        return self._engine
+
+    def ResultSession(self):
+        self.engine  # Ensure engine and session factory are ready
+        return self._session_factory()
+
+    @property
+    def pending(self):
+        """ Number of results waiting to be flushed """
+        return len(self._buffer)
+
+    def _store_result(self, task_id, result, state, traceback=None,
+                      request=None, **kwargs):
+        if state not in BUFFERED_STATES:
+            # Wait for any in-flight flush so that it can't overwrite the
+            # state we're about to write
+            with self._flush_lock:
+                with self._lock:
+                    self._buffer.pop(task_id, None)
+                return super(BufferedDatabaseBackend, self)._store_result(
+                    task_id, result, state, traceback, **kwargs)
+
+        with self._lock:
+            self._buffer.pop(task_id, None)
+            self._buffer[task_id] = {
+                'task_id': task_id,
+                'status': state,
+                'result': result,
+                'traceback': traceback,
+                'date_done': datetime.utcnow(),
+            }
+            # Once closed (or without an interval), no flusher will run
+            should_flush = (
+                len(self._buffer) >= self.buffer_size or
+                not self.flush_interval or self._stopped.is_set())
+        if should_flush:
+            self.flush()
+        else:
+            self._ensure_flusher()
+        return result
+
+    def _get_task_meta_for(self, task_id):
+        with self._lock:
+            row = self._buffer.get(task_id)
+        if row is None:
+            return super(BufferedDatabaseBackend, self)._get_task_meta_for(
+                task_id)
+        return self.meta_from_decoded(dict(row))
+
+    def buffered_meta(self, task_ids):
+        """ Results of 'task_ids' waiting to be flushed, keyed by id """
+        with self._lock:
+            return {
+                task_id: dict(self._buffer[task_id])
+                for task_id in task_ids if task_id in self._buffer
+            }
+
+    def flush(self):
+        """
+        Write all buffered results to the database. Returns the number of
+        rows written. Should the write fail, the results are returned to the
+        buffer and the error is raised.
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self._buffer.values())
+                self._buffer.clear()
+            if not rows:
+                return 0
+            table = Task.__table__
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(
+                        build_upsert(table, rows, self.engine.dialect.name))
+            except Exception:
+                with self._lock:
+                    for row in rows:
+                        self._buffer.setdefault(row['task_id'], row)
+                raise
+            return len(rows)
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Failed to flush buffered task results")
+
+    def _ensure_flusher(self):
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(
+                target=self._flush_periodically,
+                name='result-buffer-flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            self._flush_quietly()
+
+    def close(self):
+        """ Stop the background flusher and write any buffered results """
+        self._stopped.set()
+        self._flush_quietly()
+
+    def __reduce__(self, args=(), kwargs={}):
+        kwargs.update({
+            'buffer_size': self.buffer_size,
+            'flush_interval': self.flush_interval,
+            'pool_size': self.pool_size,
+            'max_overflow': self.max_overflow,
+        })
+        return super(BufferedDatabaseBackend, self).__reduce__(args, kwargs)
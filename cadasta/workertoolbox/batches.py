@@ -0,0 +1,251 @@
+import logging
+import threading
+import traceback
+
+from celery import Task
+from celery.utils.functional import noop
+from celery.worker.request import Request
+from celery.worker.strategy import proto1_to_proto2
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRequest(object):
+    """
+    Picklable summary of a task message executed as part of a batch,
+    providing the attributes of a task request used by result backends.
+    """
+
+    def __init__(self, id, name, args=(), kwargs=None, delivery_info=None,
+                 hostname=None, reply_to=None, correlation_id=None,
+                 root_id=None, parent_id=None, group=None, chord=None,
+                 callbacks=None, errbacks=None):
+        self.id = id
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.delivery_info = delivery_info or {}
+        self.hostname = hostname
+        self.reply_to = reply_to
+        self.correlation_id = correlation_id
+        self.root_id = root_id
+        self.parent_id = parent_id
+        self.group = group
+        self.chord = chord
+        self.callbacks = callbacks
+        self.errbacks = errbacks
+
+    @classmethod
+    def from_request(cls, request):
+        args, kwargs, embed = request._payload
+        embed = embed or {}
+        return cls(
+            request.id, request.name, args, kwargs,
+            delivery_info=request.delivery_info, hostname=request.hostname,
+            reply_to=request.reply_to,
+            correlation_id=request.correlation_id, root_id=request.root_id,
+            parent_id=request.parent_id,
+            group=request.request_dict.get('group'),
+            chord=embed.get('chord'), callbacks=embed.get('callbacks'),
+            errbacks=embed.get('errbacks'))
+
+    def __repr__(self):
+        return '<BatchRequest: {0.name}[{0.id}]>'.format(self)
+
+
+def task_queue(app, name):
+    """ Name of the queue that the app's router sends a task to """
+    route = app.amqp.router.route({}, name)
+    queue = route.get('queue')
+    return queue.name if queue is not None else route.get('routing_key')
+
+
+def batch_options(task, app):
+    """
+    Maximum size of, and seconds to wait for, a task's batches: the task's
+    own 'max_batch_size' and 'max_batch_wait' (if set), otherwise those of
+    its queue in QUEUE_BATCH_OPTIONS, otherwise BATCH_MAX_SIZE and
+    BATCH_MAX_WAIT.
+    """
+    conf = app.conf
+    options = {
+        'max_size': getattr(conf, 'BATCH_MAX_SIZE', 10),
+        'max_wait': getattr(conf, 'BATCH_MAX_WAIT', 0.1),
+    }
+    queue_options = getattr(conf, 'QUEUE_BATCH_OPTIONS', None) or {}
+    options.update(queue_options.get(task_queue(app, task.name), {}))
+    if task.max_batch_size is not None:
+        options['max_size'] = task.max_batch_size
+    if task.max_batch_wait is not None:
+        options['max_wait'] = task.max_batch_wait
+    return options['max_size'], options['max_wait']
+
+
+class BatchBuffer(object):
+    """
+    Requests received by a worker for a BatchTask, sent to the pool as a
+    batch once 'max_size' have been received or the first has waited
+    'max_wait' seconds. As the broker delivers no more unacknowledged
+    messages than the consumer's prefetch count, a batch is also sent once
+    that many requests are held.
+    """
+
+    def __init__(self, task, consumer, max_size, max_wait):
+        self.task = task
+        self.consumer = consumer
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._requests = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._requests)
+
+    @property
+    def flush_size(self):
+        prefetch = self.consumer.qos.value  # 0 is unlimited
+        return min(self.max_size, prefetch) if prefetch else self.max_size
+
+    def add(self, request):
+        with self._lock:
+            self._requests.append(request)
+            full = len(self._requests) >= self.flush_size
+            if not full and self._timer is None:
+                self._timer = self.consumer.timer.call_after(
+                    self.max_wait, self.flush)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """ Send held requests to the pool, returning the number sent """
+        with self._lock:
+            requests, self._requests = self._requests, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        requests = [r for r in requests if not r.revoked()]
+        if requests:
+            self.task.apply_batch(requests, self.consumer.pool)
+        return len(requests)
+
+
+def batch_strategy(task, app, consumer, **kwargs):
+    """
+    Worker strategy holding a BatchTask's messages in a BatchBuffer, rather
+    than sending each to the pool.
+    """
+    hostname = consumer.hostname
+    eventer = consumer.event_dispatcher
+    connection_errors = consumer.connection_errors
+    max_size, max_wait = batch_options(task, app)
+    buffer = BatchBuffer(task, consumer, max_size, max_wait)
+
+    def task_message_handler(message, body, ack, reject, callbacks,
+                             **kwargs):
+        if body is None:
+            body, headers, decoded, utc = (
+                message.body, message.headers, False,
+                app.uses_utc_timezone())
+        else:
+            body, headers, decoded, utc = proto1_to_proto2(message, body)
+        buffer.add(Request(
+            message, on_ack=ack, on_reject=reject, app=app,
+            hostname=hostname, eventer=eventer, task=task,
+            connection_errors=connection_errors, body=body, headers=headers,
+            decoded=decoded, utc=utc))
+
+    return task_message_handler
+
+
+def _execute_batch(task, requests):
+    return task.execute_batch(requests)
+
+
+class BatchTask(Task):
+    """
+    Base class of tasks whose invocations are executed in batches by the
+    worker, saving a pool round trip (and result backend 'STARTED' write)
+    per message. The task's function is called with a list of BatchRequest
+    objects (holding each invocation's 'args' and 'kwargs') and must return
+    a list of their results, in the same order. A result that is an
+    exception instance marks that invocation as failed, while an exception
+    raised by the function fails the whole batch:
+
+        @app.task(base=BatchTask, name='msg.send')
+        def send(requests):
+            return [deliver(*r.args, **r.kwargs) for r in requests]
+
+    Messages of a batch are acknowledged together: once the batch is
+    accepted by the pool or, with 'acks_late', once it has been executed.
+    Called directly (or eagerly), the function receives a batch of one.
+
+    Batched invocations aren't traced by Celery, so no task_prerun,
+    task_postrun, task_success, task_failure or task_retry signals (nor
+    task events) are sent for them, and features relying on those (task
+    metrics and profiling, followups passed by reference) don't apply.
+    """
+    Strategy = 'cadasta.workertoolbox.batches:batch_strategy'
+
+    # Override the app's BATCH_MAX_SIZE and BATCH_MAX_WAIT for this task
+    max_batch_size = None
+    max_batch_wait = None
+
+    def __call__(self, *args, **kwargs):
+        request = BatchRequest(self.request.id, self.name, args, kwargs)
+        result, = self.run([request])
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def apply_batch(self, requests, pool):
+        """ Execute worker requests as a batch in the provided pool """
+        acks_late = self.acks_late
+
+        def acknowledge(*args):
+            for request in requests:
+                request.acknowledge()
+
+        return pool.apply_async(
+            _execute_batch,
+            args=(self, [BatchRequest.from_request(r) for r in requests]),
+            accept_callback=noop if acks_late else acknowledge,
+            callback=acknowledge if acks_late else noop,
+            error_callback=acknowledge,
+            soft_timeout=self.soft_time_limit, timeout=self.time_limit)
+
+    def execute_batch(self, requests):
+        """
+        Run the task's function with a batch of requests, storing the result
+        of each. Returns the number of requests that failed.
+        """
+        tb = None
+        try:
+            results = list(self.run(requests))
+            if len(results) != len(requests):
+                raise ValueError(
+                    "Batch of %d request(s) returned %d result(s)" % (
+                        len(requests), len(results)))
+        except Exception as exc:
+            logger.exception("Batch of %d %s task(s) failed",
+                             len(requests), self.name)
+            tb = traceback.format_exc()
+            results = [exc] * len(requests)
+
+        failed = 0
+        for request, result in zip(requests, results):
+            if isinstance(result, Exception):
+                failed += 1
+                self.backend.mark_as_failure(
+                    request.id, result, tb, request=request,
+                    store_result=(not self.ignore_result or
+                                  self.store_errors_even_if_ignored))
+            else:
+                self.backend.mark_as_done(
+                    request.id, result, request=request,
+                    store_result=not self.ignore_result)
+                for callback in request.callbacks or ():
+                    self.app.signature(callback).apply_async(
+                        (result,), parent_id=request.id,
+                        root_id=request.root_id or request.id)
+        return failed
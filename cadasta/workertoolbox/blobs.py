@@ -0,0 +1,157 @@
+import abc
+import errno
+import logging
+import os
+import re
+import tempfile
+import time
+
+from celery import bootsteps
+from celery.utils.threads import bgThread
+from kombu.five import with_metaclass
+from kombu.utils.imports import symbol_by_name
+
+logger = logging.getLogger(__name__)
+
+# Keys are used as file names, so are limited to a safe set of characters
+KEY_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+@with_metaclass(abc.ABCMeta)
+class BlobStore(object):
+    """
+    Storage of opaque byte strings by key, used to keep large data out of
+    broker messages. Subclasses implement 'put', 'get' and 'delete', and
+    'purge' unless the storage expires blobs itself.
+    """
+
+    @abc.abstractmethod
+    def put(self, key, data):
+        """ Store 'data' at 'key', replacing any data stored there """
+
+    @abc.abstractmethod
+    def get(self, key):
+        """ Return the data stored at 'key', raising KeyError if missing """
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """ Delete the data stored at 'key', if any """
+
+    def purge(self, max_age):
+        """ Delete blobs stored over 'max_age' seconds ago, returning count """
+        return 0
+
+
+class FileSystemBlobStore(BlobStore):
+    """
+    Stores each blob as a file within 'path'. Only suitable for workers and
+    producers sharing a filesystem (e.g. tests or a single host).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key):
+        if not KEY_RE.match(key):
+            raise ValueError("Invalid blob key %r" % key)
+        return os.path.join(self.path, key)
+
+    def put(self, key, data):
+        # Write atomically, so that readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, self._path(key))
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def purge(self, max_age):
+        # Blobs written again (e.g. identical payloads) are kept longer, as
+        # each put replaces the file. Includes leftover temporary files.
+        cutoff = time.time() - max_age
+        purged = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    purged += 1
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return purged
+
+
+def blob_store_from_url(url):
+    """
+    Build a blob store from a 'file:///path/to/dir' URL or the import path
+    of a BlobStore subclass (e.g. 'app.blobs:S3BlobStore'), which is
+    instantiated without arguments.
+    """
+    if url.startswith('file://'):
+        return FileSystemBlobStore(url[len('file://'):])
+    return symbol_by_name(url)()
+
+
+class BlobPurger(bgThread):
+    """ Thread purging blobs older than 'max_age' every 'interval' seconds """
+
+    def __init__(self, blob_store, max_age, interval):
+        super(BlobPurger, self).__init__()
+        self.blob_store = blob_store
+        self.max_age = max_age
+        self.interval = interval
+
+    def body(self):
+        try:
+            purged = self.blob_store.purge(self.max_age)
+        except Exception:
+            logger.warning("Unable to purge blobs", exc_info=True)
+        else:
+            if purged:
+                logger.info("Purged %d blob(s)", purged)
+        self._is_shutdown.wait(self.interval)
+
+
+class PayloadPurge(bootsteps.StartStopStep):
+    """
+    Worker bootstep purging payloads offloaded to the PAYLOAD_STORE over
+    PAYLOAD_TTL seconds ago, from a BlobPurger thread, every tenth of the
+    TTL (at most hourly).
+    """
+
+    def __init__(self, w, **kwargs):
+        conf = w.app.conf
+        self.blob_store = conf.PAYLOAD_CODEC.blob_store
+        self.max_age = conf.PAYLOAD_TTL
+        self.purger = None
+        super(PayloadPurge, self).__init__(w, **kwargs)
+
+    def start(self, w):
+        self.purger = BlobPurger(
+            self.blob_store, self.max_age, min(self.max_age / 10.0, 3600))
+        self.purger.start()
+
+    def stop(self, w):
+        if self.purger is not None:
+            self.purger.stop()
+            self.purger = None
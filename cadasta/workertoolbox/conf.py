@@ -1,18 +1,145 @@
 from ast import literal_eval
+from copy import deepcopy
 from os import environ as env
 import pprint
 import logging
 import logging.config
+import threading
+from fnmatch import fnmatchcase
 
-from kombu import Exchange, Queue
-from raven import Client
-from raven.contrib.celery import register_signal, register_logger_signal
+from kombu import Exchange, Queue, binding
+from kombu.five import PY3
 
 # Ensure signals are imported before app starts
 from .signals import *  # NOQA
+from .signals import connect_followups
 from . import DEFAULT_QUEUES
+from .setup import chord_unlock_retries
+from .utils import LRUCache
 
 
+BUFFERED_RESULT_BACKEND = (
+    'cadasta.workertoolbox.backends:BufferedDatabaseBackend')
+CHORD_COUNTER_RESULT_BACKEND = (
+    'cadasta.workertoolbox.backends:ChordCounterDatabaseBackend')
+QUEUE_DEPTH_AUTOSCALER = (
+    'cadasta.workertoolbox.autoscale:QueueDepthAutoscaler')
+# How a chord's body is applied once its header tasks have completed
+CHORD_UNLOCK_STRATEGIES = ('poll', 'backoff', 'counter')
+# Timers sampling the stacks of profiled tasks, selected with PROFILE_CLOCK.
+# Python 2 doesn't resume waits in select or poll (e.g. time.sleep, or
+# socket operations with a timeout) interrupted by samples, which the wall
+# clock delivers while tasks wait, so it's only available on Python 3.
+PROFILE_CLOCKS = ('cpu', 'wall') if PY3 else ('cpu',)
+# Codecs used for task and result messages, selected with SERIALIZER_PROFILE
+SERIALIZER_PROFILES = ('default', 'fast')
+TUNED_SQS_TRANSPORT = 'cadasta.workertoolbox.transport:SQSTransport'
+
+# Coordinated consumer settings, selected with TUNING_PROFILE
+TUNING_PROFILES = {
+    # Short tasks: reserve one message at a time so that idle processes
+    # aren't starved by messages prefetched by busy ones
+    'latency': {
+        'worker_prefetch_multiplier': 1,
+        'visibility_timeout': 30,
+        'receive_batch_size': 1,
+    },
+    # Many short tasks: amortize each ReceiveMessage call over a full batch
+    'throughput': {
+        'worker_prefetch_multiplier': 8,
+        'visibility_timeout': 120,
+        'receive_batch_size': 10,
+    },
+    # Tasks running for minutes or hours: avoid redelivery while running
+    'long_running': {
+        'worker_prefetch_multiplier': 1,
+        'visibility_timeout': 60 * 60 * 2,  # 2 hrs
+        'receive_batch_size': 1,
+    },
+}
+
+NUMBER = (int, float)
+# Types of internal settings, by name. Environment variables of settings
+# accepting a string are used as is, others are evaluated as a Python literal
+# (as are those of undeclared settings with a non-string default) and must
+# evaluate to one of the setting's types.
+SETTING_TYPES = {
+    'LAZY_CONFIG': bool,
+    'QUEUE_PREFIX': str,
+    'TUNING_PROFILE': str,
+    'QUEUE_TUNING_PROFILES': dict,
+    'QUEUE_LOGGING': bool,
+    'LOG_QUEUE_SIZE': int,
+    'SETUP_FILE_LOGGING': bool,
+    'SENTRY_SAMPLE_RATE': NUMBER,
+    'SENTRY_RATE_LIMIT': int,
+    'SENTRY_RATE_LIMIT_PERIOD': NUMBER,
+    'SENTRY_QUEUE_SIZE': int,
+    'SETUP_SENTRY_LOGGING': bool,
+    'RESULT_DB_USER': str,
+    'RESULT_DB_PASS': str,
+    'RESULT_DB_HOST': str,
+    'RESULT_DB_NAME': str,
+    'RESULT_DB_PORT': str,
+    'RESULT_DB_POOL_SIZE': int,
+    'RESULT_DB_MAX_OVERFLOW': int,
+    'PRODUCER_WARM_CONNECTIONS': int,
+    'RESULT_BUFFER_MAX_SIZE': int,
+    'RESULT_BUFFER_FLUSH_INTERVAL': NUMBER,
+    'RESULT_EXPIRY_POLICY': dict,
+    'RESULT_PURGE_INTERVAL': NUMBER,
+    'RESULT_PURGE_BATCH_SIZE': int,
+    'RESULT_FETCH_CHUNK_SIZE': int,
+    'CHORD_UNLOCK_STRATEGY': str,
+    'RESULT_BACKEND_BUFFERED': bool,
+    'ROUTE_CACHE_SIZE': int,
+    'QUEUES': (list, tuple),
+    'PLATFORM_QUEUE_NAME': str,
+    'PLATFORM_QUEUE_BINDINGS': (list, tuple),
+    'PLATFORM_EXCLUDED_TASKS': (list, tuple),
+    'DECLARATION_CACHE_FILE': str,
+    'DECLARATION_CACHE_TTL': NUMBER,
+    'DECLARATION_CONCURRENCY': int,
+    'QUEUE_LANES': dict,
+    'AUTOSCALE_BY_QUEUE_DEPTH': bool,
+    'AUTOSCALE_TARGET_WAIT': NUMBER,
+    'AUTOSCALE_COOLDOWN': NUMBER,
+    'AUTOSCALE_SAMPLE_INTERVAL': NUMBER,
+    'SETUP_TASK_METRICS': bool,
+    'METRICS_QUEUE_SIZE': int,
+    'SETUP_TASK_PROFILING': bool,
+    'PROFILE_SAMPLE_RATE': NUMBER,
+    'PROFILE_SLOW_THRESHOLD': NUMBER,
+    'PROFILE_INTERVAL': NUMBER,
+    'PROFILE_CLOCK': str,
+    'PROFILE_DIR': str,
+    'PROFILE_MAX_FILES': int,
+    'PROFILE_MAX_BYTES': int,
+    'CHORD_UNLOCK_BACKOFF_BASE': NUMBER,
+    'CHORD_UNLOCK_BACKOFF_FACTOR': NUMBER,
+    'CHORD_UNLOCK_BACKOFF_MAX': NUMBER,
+    'CHORD_UNLOCK_MAX_RETRIES': (int, type(None)),
+    'BATCH_MAX_SIZE': int,
+    'BATCH_MAX_WAIT': NUMBER,
+    'QUEUE_BATCH_OPTIONS': dict,
+    'FOLLOWUP_STORE': str,
+    'FOLLOWUP_CACHE_SIZE': int,
+    'FOLLOWUPS_BY_REFERENCE': bool,
+    'DEDUP_STORE': str,
+    'DEDUP_CLAIM_TTL': NUMBER,
+    'DEDUP_DONE_TTL': NUMBER,
+    'TASK_HEARTBEAT_INTERVAL': NUMBER,
+    'SERIALIZER_PROFILE': str,
+    'PAYLOAD_STORE': str,
+    'PAYLOAD_COMPRESS_THRESHOLD': int,
+    'PAYLOAD_MAX_SIZE': int,
+    'PAYLOAD_TTL': NUMBER,
+}
+# Number of parsed environments kept, by prefix and environment
+ENV_CACHE_SIZE = 16
+# Env variables set by Celery itself, not assigned to configs
+CELERY_ENV_SETTINGS = ('log_level', 'log_file')
+
 DEFAULT_LOGGING_FMT = '[%(asctime)s: %(levelname)s/%(processName)s %(message)s'
 DEFAULT_LOGGING_CONFIG = {
     'version': 1,
@@ -56,6 +183,92 @@ DEFAULT_LOGGING_CONFIG = {
 }
 
 
+class _EnvSnapshot(object):
+    """
+    Env variables matching a prefix (keyed without it), whose values are
+    parsed once per setting, however many configs are built from them.
+    """
+
+    def __init__(self, prefix, environ, decode=None):
+        self.prefix = prefix
+        self.environ = environ
+        prefix_len = len(prefix)
+        self.values = {}
+        for k, v in environ:
+            if decode is not None:
+                k, v = decode(k), decode(v)
+            if k.startswith(prefix):
+                self.values[k[prefix_len:]] = v
+        # Settings assigned to configs, unless they're otherwise set
+        self.unclaimed = [
+            (k.lower(), k.upper(), v) for k, v in self.values.items()
+            if k.lower() not in CELERY_ENV_SETTINGS
+        ]
+        self._parsed = {}
+
+    def __contains__(self, keyword):
+        return keyword.upper() in self.values
+
+    def parse(self, keyword, default):
+        """ Value of the env variable of a setting, cast to its type """
+        key = keyword.upper()
+        types = SETTING_TYPES.get(key)
+        if types is None:
+            should_eval = not isinstance(default, str)
+        else:
+            types = types if isinstance(types, tuple) else (types,)
+            should_eval = str not in types
+        try:
+            value = self._parsed[key, should_eval]
+        except KeyError:
+            value = self._parsed[key, should_eval] = self._cast(
+                key, types, should_eval)
+        # Keep configs from sharing (and mutating) cached values
+        if not isinstance(value, (str, int, float, type(None))):
+            value = deepcopy(value)
+        return value
+
+    def _cast(self, key, types, should_eval):
+        env_key, env_val = self.prefix + key, self.values[key]
+        if not should_eval:
+            return env_val
+        expected = ' or '.join(t.__name__ for t in types or ())
+        try:
+            value = literal_eval(env_val)
+        except (ValueError, SyntaxError):
+            raise ValueError("Unable to cast %s=%r to %s" % (
+                env_key, env_val, expected or 'a Python literal'))
+        # Booleans are ints, but aren't accepted as numbers
+        if types is not None and (not isinstance(value, types) or (
+                isinstance(value, bool) and bool not in types)):
+            raise ValueError("Expected %s to be %s, got %r (%s)" % (
+                env_key, expected, value, type(value).__name__))
+        return value
+
+
+_env_snapshots = LRUCache(ENV_CACHE_SIZE)
+
+
+def env_snapshot(prefix):
+    """
+    Env variables matching 'prefix', cached by the hash of the environment
+    so that they're only scanned (and parsed) again once it changes.
+    """
+    # The encoded environment (if any) is hashed without decoding it, then
+    # decoded as os.environ does when building a snapshot
+    data = getattr(env, '_data', None)
+    if data is None:
+        environ, decode = frozenset(env.items()), None
+    else:
+        environ, decode = frozenset(data.items()), env.decodevalue
+    key = (prefix, hash(environ))
+    snapshot = _env_snapshots.get(key)
+    if snapshot is None or snapshot.environ != environ:
+        snapshot = _env_snapshots[key] = _EnvSnapshot(
+            prefix, environ, decode)
+    return snapshot
+
+
 class Config:
     def __init__(self, **kw):
         """
@@ -68,10 +281,25 @@ class Config:
         for k, v in kw.items():
             setattr(self, k, v)
 
+        # Snapshot matching env variables, parsed once per environment
+        self._env = env_snapshot(self.ENV_PREFIX)
+        self._pending = {}
+        self._pending_lock = threading.RLock()
+        self.set('LAZY_CONFIG', False)
+
         # Configure Broker
         self.set('QUEUE_PREFIX', 'dev')
         self.set('broker_transport', 'sqs')
-        self.set('broker_transport_options', {
+        self.set('TUNING_PROFILE', '')
+        self.set('QUEUE_TUNING_PROFILES', {})
+        tuning = self._tuning_options()
+        if 'worker_prefetch_multiplier' in tuning:
+            self.set(
+                'worker_prefetch_multiplier',
+                tuning.pop('worker_prefetch_multiplier'))
+        if tuning and self.broker_transport == 'sqs':
+            self.broker_transport = TUNED_SQS_TRANSPORT
+        self.defer('broker_transport_options', lambda: dict({
                 'region': 'us-west-2',
                 'queue_name_prefix': '{}-'.format(self.QUEUE_PREFIX),
 
@@ -84,13 +312,19 @@ class Config:
                 'interval_start': 0,
                 # Ensure error is raised if cannot connect to SQS twice
                 'max_retries': 1,
-            })
+            }, **tuning))
 
         # Setup Logging
         self.set('task_track_started', True)
+        self.set('QUEUE_LOGGING', False)
+        self.set('LOG_QUEUE_SIZE', 10000)
         if self.set('SETUP_FILE_LOGGING', False):
             self.setup_file_logging()
 
+        self.set('SENTRY_SAMPLE_RATE', 1.0)
+        self.set('SENTRY_RATE_LIMIT', 0)
+        self.set('SENTRY_RATE_LIMIT_PERIOD', 60)
+        self.set('SENTRY_QUEUE_SIZE', 100)
         if self.set('SETUP_SENTRY_LOGGING', bool(env.get('SENTRY_DSN'))):
             assert env.get('SENTRY_DSN'), (
                 'Required env variable for Sentry logging is not set')
@@ -102,8 +336,27 @@ class Config:
         self.set('RESULT_DB_HOST', 'localhost')
         self.set('RESULT_DB_NAME', 'cadasta')
         self.set('RESULT_DB_PORT', '5432')
-        self.set('result_backend', (
-            'db+postgresql://{0.RESULT_DB_USER}:{0.RESULT_DB_PASS}@'
+        self.set('RESULT_DB_POOL_SIZE', 5)
+        self.set('RESULT_DB_MAX_OVERFLOW', 10)
+        self.set('PRODUCER_WARM_CONNECTIONS', 1)
+        self.set('RESULT_BUFFER_MAX_SIZE', 100)
+        self.set('RESULT_BUFFER_FLUSH_INTERVAL', 1.0)
+        self.set('RESULT_EXPIRY_POLICY', {})
+        self.set('RESULT_PURGE_INTERVAL', 0)  # Disabled
+        self.set('RESULT_PURGE_BATCH_SIZE', 1000)
+        self.set('RESULT_FETCH_CHUNK_SIZE', 500)
+        self.set('CHORD_UNLOCK_STRATEGY', 'poll')
+        if self.CHORD_UNLOCK_STRATEGY not in CHORD_UNLOCK_STRATEGIES:
+            raise ValueError(
+                "Unknown CHORD_UNLOCK_STRATEGY %r, expected one of %r" % (
+                    self.CHORD_UNLOCK_STRATEGY, CHORD_UNLOCK_STRATEGIES))
+        backend = 'db'
+        if self.set('RESULT_BACKEND_BUFFERED', False):
+            backend = BUFFERED_RESULT_BACKEND
+        elif self.CHORD_UNLOCK_STRATEGY == 'counter':
+            backend = CHORD_COUNTER_RESULT_BACKEND
+        self.set('result_backend', backend + (
+            '+postgresql://{0.RESULT_DB_USER}:{0.RESULT_DB_PASS}@'
             '{0.RESULT_DB_HOST}:{0.RESULT_DB_PORT}/{0.RESULT_DB_NAME}'))
         try:
             self.result_backend = self.result_backend.format(self)
@@ -116,29 +369,112 @@ class Config:
         self.set('task_default_exchange', 'task_exchange')
         self.set('task_default_exchange_type', 'topic')
         self.set('task_routes', self._route_task, from_env=False)
+        self.set('ROUTE_CACHE_SIZE', 1024)
+        self._exchange = None
+        self._route_cache = LRUCache(self.ROUTE_CACHE_SIZE)
 
         # Configure Queues
-        self.set('QUEUES', DEFAULT_QUEUES)
-        self.set('PLATFORM_QUEUE_NAME', 'platform.fifo')
-        if not hasattr(self, 'task_queues'):
-            self.task_queues = self._generate_queues(
-                self.QUEUES, self._default_exchange_obj,
-                self.PLATFORM_QUEUE_NAME)
+        self.defer('QUEUES', lambda: DEFAULT_QUEUES)
+        self.defer('PLATFORM_QUEUE_NAME', lambda: 'platform.fifo')
+        if not self.set('PLATFORM_QUEUE_BINDINGS', ('#',)):
+            raise ValueError(
+                "PLATFORM_QUEUE_BINDINGS requires at least one routing key "
+                "pattern")
+        self.set('PLATFORM_EXCLUDED_TASKS', ())
+        self.defer('task_queues', lambda: self._generate_queues(
+            self.QUEUES, self._default_exchange_obj,
+            self.PLATFORM_QUEUE_NAME, self.PLATFORM_QUEUE_BINDINGS),
+            from_env=False)
+        self.set('DECLARATION_CACHE_FILE', '')
+        self.set('DECLARATION_CACHE_TTL', 60 * 60)  # 1 hr
+        self.set('DECLARATION_CONCURRENCY', 1)  # Serial
+        self.set('QUEUE_LANES', {})
+
+        # Configure Autoscaling
+        if self.set('AUTOSCALE_BY_QUEUE_DEPTH', False):
+            self.set('worker_autoscaler', QUEUE_DEPTH_AUTOSCALER)
+        self.set('AUTOSCALE_TARGET_WAIT', 10.0)
+        self.set('AUTOSCALE_COOLDOWN', 30.0)
+        self.set('AUTOSCALE_SAMPLE_INTERVAL', 1.0)
+
+        # Setup Task Metrics
+        self.set('METRICS_QUEUE_SIZE', 10000)
+        if self.set('SETUP_TASK_METRICS', False):
+            self.setup_task_metrics()
+
+        # Setup Task Profiling
+        self.set('PROFILE_SAMPLE_RATE', 0.01)
+        self.set('PROFILE_SLOW_THRESHOLD', 0)  # Disabled
+        self.set('PROFILE_INTERVAL', 0.01)  # seconds
+        self.set('PROFILE_CLOCK', 'cpu')
+        if self.PROFILE_CLOCK not in PROFILE_CLOCKS:
+            raise ValueError(
+                "Unknown PROFILE_CLOCK %r, expected one of %r" % (
+                    self.PROFILE_CLOCK, PROFILE_CLOCKS))
+        self.set('PROFILE_DIR', '')  # A directory of the temp dir
+        self.set('PROFILE_MAX_FILES', 100)
+        self.set('PROFILE_MAX_BYTES', 10 * 1024 * 1024)  # 10 MB
+        if self.set('SETUP_TASK_PROFILING', False):
+            self.setup_task_profiling()
 
         # Configure Tasks
-        self.set('imports', ('app.tasks',))
-        self.set('CHORD_UNLOCK_MAX_RETRIES', 60 * 60 * 6)  # 6 hrs
+        self.defer('imports', lambda: ('app.tasks',))
+        self.set('CHORD_UNLOCK_BACKOFF_BASE', 1)
+        self.set('CHORD_UNLOCK_BACKOFF_FACTOR', 2)
+        self.set('CHORD_UNLOCK_BACKOFF_MAX', 60)
+        self.defer('CHORD_UNLOCK_MAX_RETRIES', self._chord_unlock_max_retries)
+        self.set('BATCH_MAX_SIZE', 10)
+        self.set('BATCH_MAX_WAIT', 0.1)  # seconds
+        self.set('QUEUE_BATCH_OPTIONS', {})
+        self.set('FOLLOWUP_STORE', '')
+        self.set('FOLLOWUP_CACHE_SIZE', 128)
+        if self.set('FOLLOWUPS_BY_REFERENCE', False):
+            connect_followups()
+        self.set('DEDUP_STORE', '')
+        self.set('DEDUP_CLAIM_TTL', 60)  # seconds
+        self.set('DEDUP_DONE_TTL', 60 * 60 * 24)  # 1 day
+        self.set('TASK_HEARTBEAT_INTERVAL', 0)  # Disabled
+
+        # Configure Serialization
+        self.set('SERIALIZER_PROFILE', 'default')
+        if self.SERIALIZER_PROFILE not in SERIALIZER_PROFILES:
+            raise ValueError(
+                "Unknown SERIALIZER_PROFILE %r, expected one of %r" % (
+                    self.SERIALIZER_PROFILE, SERIALIZER_PROFILES))
+        self.set('PAYLOAD_STORE', '')
+        self.set('PAYLOAD_COMPRESS_THRESHOLD', 16 * 1024)  # 16 KB
+        self.set('PAYLOAD_MAX_SIZE', 136 * 1024)  # 136 KB
+        self.set('PAYLOAD_TTL', 60 * 60 * 24 * 7)  # 1 week
+        if self.PAYLOAD_STORE:
+            self.setup_payload_offloading()
+        if self.SERIALIZER_PROFILE == 'fast':
+            self.setup_fast_serializer()
 
         # Assign any other matching env variables to object
-        for k, v in env.items():
-            if not k.startswith(self.ENV_PREFIX):
-                continue
-            key = k.split(self.ENV_PREFIX, 1)[1].lower()
-            if hasattr(self, key.lower()) or hasattr(self, key.upper()):
-                continue
-            if key in ('log_level', 'log_file'):  # Ignore Celery-set env vars
-                continue
-            setattr(self, key, v)
+        for key, upper, v in self._env.unclaimed:
+            if not (self._is_set(key) or self._is_set(upper)):
+                setattr(self, key, v)
+
+        if not self.LAZY_CONFIG:
+            # Later calls to 'set' should read the live environment
+            self._env = None
+
+    def __getattr__(self, name):
+        """ Resolve deferred settings of a lazy config on first access """
+        pending = self.__dict__.get('_pending')
+        if pending:
+            with self._pending_lock:
+                if name in self.__dict__:  # Resolved by another thread
+                    return self.__dict__[name]
+                if name in pending:
+                    return pending.pop(name)()
+        raise AttributeError(
+            "%r object has no attribute %r" % (self.__class__.__name__, name))
+
+    def __dir__(self):
+        return sorted(
+            set(dir(self.__class__)) | set(self.__dict__) |
+            set(self.__dict__.get('_pending', ())))
 
     def __repr__(self):
         attr_str = pprint.pformat(self.to_dict())
@@ -156,61 +492,242 @@ class Config:
         """
         Set value on self if not already set. If unset, attempt to
         retrieve from environment variable of same name (unless disabled
-        via 'from_env'). If 'default' value is not a string, evaluate
+        via 'from_env'). Unless the setting's type in SETTING_TYPES (or,
+        for undeclared settings, its 'default' value) is a string, evaluate
         environment variable as a Python type. If no env variables are
         found, fallback to 'default' value.
         """
-        env_key = '{}{}'.format(self.ENV_PREFIX, keyword.upper())
-        if hasattr(self, keyword):
+        if self._is_set(keyword):
             return getattr(self, keyword)
         value = default
-        if from_env and (env_key in env):
-            env_val = env.get(env_key)
-            should_eval = not isinstance(default, str)
-            try:
-                value = literal_eval(env_val) if should_eval else env_val
-            except (ValueError, SyntaxError):
-                raise ValueError("Unable to cast %r to %r" % (
-                    env_val, type.__name__))
+        if from_env:
+            environ = self._env
+            if environ is None:
+                # Once constructed, eager configs read the live environment
+                environ = env_snapshot(self.ENV_PREFIX)
+            if keyword in environ:
+                value = environ.parse(keyword, default)
         setattr(self, keyword, value)
         return getattr(self, keyword)
 
+    def defer(self, keyword, factory, from_env=True):
+        """
+        Equivalent to 'set', however the default value is produced by
+        calling 'factory'. If 'LAZY_CONFIG' is enabled, neither the factory
+        nor the environment variable is evaluated until the setting is first
+        accessed, after which the value is memoized on self.
+        """
+        if self._is_set(keyword):
+            return
+
+        def resolve():
+            return self.set(keyword, factory(), from_env)
+
+        if self.LAZY_CONFIG:
+            self._pending[keyword] = resolve
+        else:
+            resolve()
+
+    def _is_set(self, keyword):
+        """ Check for a setting without resolving it """
+        return (keyword in self.__dict__ or keyword in self._pending or
+                hasattr(self.__class__, keyword))
+
     def setup_file_logging(self, config=DEFAULT_LOGGING_CONFIG):
         self.set('worker_hijack_root_logger', False)
         logging.config.dictConfig(config)
+        if self.QUEUE_LOGGING:
+            # Imported here to keep multiprocessing out of other processes
+            from .log import setup_queue_logging
+            self._log_listener = setup_queue_logging(
+                queue_size=self.LOG_QUEUE_SIZE)
 
     def setup_sentry_logging(self, sentry_client=None, level=logging.ERROR):
-        self._sentry_client = (
-            sentry_client or
-            Client(**{k: v for k, v in {
-                'dsn': env['SENTRY_DSN'],
-                'name': env.get('SENTRY_NAME'),
-                'environment': env.get('SENTRY_ENVIRONMENT'),
-                'release': env.get('SENTRY_RELEASE'),
-            }.items() if v})
-        )
+        # Imported here to keep raven out of processes not using Sentry
+        from raven import Client
+        from raven.contrib.celery import register_signal, \
+            register_logger_signal
+
+        options = {k: v for k, v in {
+            'dsn': env['SENTRY_DSN'],
+            'name': env.get('SENTRY_NAME'),
+            'environment': env.get('SENTRY_ENVIRONMENT'),
+            'release': env.get('SENTRY_RELEASE'),
+        }.items() if v}
+        if self.SENTRY_SAMPLE_RATE != 1:
+            options['sample_rate'] = self.SENTRY_SAMPLE_RATE
+        if not sentry_client and self.SENTRY_RATE_LIMIT:
+            from .sentry import RateLimitedClient
+            sentry_client = RateLimitedClient(
+                rate_limit=self.SENTRY_RATE_LIMIT,
+                rate_period=self.SENTRY_RATE_LIMIT_PERIOD,
+                queue_size=self.SENTRY_QUEUE_SIZE,
+                **options)
+        self._sentry_client = sentry_client or Client(**options)
         register_logger_signal(self._sentry_client, loglevel=level)
         register_signal(self._sentry_client)
 
+    def setup_task_metrics(self, task_metrics=None):
+        """
+        Collect per-queue and per-task latency histograms and outcome
+        counts, available as 'TASK_METRICS'. In a worker, metrics of its
+        pool processes are aggregated by its main process.
+        """
+        from .metrics import TaskMetrics
+        from .signals import connect_task_metrics
+        self.TASK_METRICS = task_metrics or TaskMetrics(
+            queues=['celery'] + list(self.QUEUES),
+            queue_size=self.METRICS_QUEUE_SIZE)
+        connect_task_metrics(self.TASK_METRICS)
+        return self.TASK_METRICS
+
+    def setup_task_profiling(self, task_profiler=None):
+        """
+        Profile a sample of tasks, and slow tasks, writing their sampled
+        stacks to PROFILE_DIR, available as 'TASK_PROFILER'.
+        """
+        from .profiling import ProfileRing, TaskProfiler
+        from .signals import connect_task_profiler
+        self.TASK_PROFILER = task_profiler or TaskProfiler(
+            ProfileRing(self.PROFILE_DIR, self.PROFILE_MAX_FILES,
+                        self.PROFILE_MAX_BYTES),
+            sample_rate=self.PROFILE_SAMPLE_RATE,
+            slow_threshold=self.PROFILE_SLOW_THRESHOLD,
+            interval=self.PROFILE_INTERVAL, clock=self.PROFILE_CLOCK)
+        connect_task_profiler(self.TASK_PROFILER)
+        return self.TASK_PROFILER
+
+    def setup_payload_offloading(self, blob_store=None):
+        """
+        Serialize tasks with a codec compressing large payloads and moving
+        those still too large for the broker to a blob store, available as
+        'PAYLOAD_CODEC'.
+        """
+        from .blobs import blob_store_from_url
+        from .serialization import (
+            OffloadingCodec, OFFLOAD_SERIALIZER, json_codec)
+        options = {}
+        if self.SERIALIZER_PROFILE == 'fast':
+            options['dumps'], options['loads'] = json_codec()
+        codec = OffloadingCodec(
+            blob_store or blob_store_from_url(self.PAYLOAD_STORE),
+            compress_threshold=self.PAYLOAD_COMPRESS_THRESHOLD,
+            max_size=self.PAYLOAD_MAX_SIZE, **options)
+        codec.register()
+        self.PAYLOAD_CODEC = codec
+        self.set('task_serializer', OFFLOAD_SERIALIZER)
+        self.set('accept_content', ['json', OFFLOAD_SERIALIZER])
+        return codec
+
+    def setup_fast_serializer(self):
+        """
+        Serialize tasks and results with the fastest available JSON codec.
+        Messages remain JSON, readable by consumers using Celery's default
+        serializer (e.g. of the platform queue).
+        """
+        from .serialization import FAST_SERIALIZER, register_fast_serializer
+        register_fast_serializer()
+        self.set('task_serializer', FAST_SERIALIZER)
+        self.set('result_serializer', FAST_SERIALIZER)
+        self.set('accept_content', ['json'])
+
+    def _chord_unlock_max_retries(self):
+        """ Number of chord_unlock retries spanning 6 hours """
+        duration = 60 * 60 * 6
+        if self.CHORD_UNLOCK_STRATEGY != 'backoff':
+            return duration  # Polled every second
+        return chord_unlock_retries(
+            duration, self.CHORD_UNLOCK_BACKOFF_BASE,
+            self.CHORD_UNLOCK_BACKOFF_FACTOR, self.CHORD_UNLOCK_BACKOFF_MAX)
+
+    def _tuning_options(self):
+        """
+        Settings of the selected TUNING_PROFILE, with a 'queue_options'
+        transport option holding those of QUEUE_TUNING_PROFILES.
+        """
+        def profile(name):
+            try:
+                return TUNING_PROFILES[name]
+            except KeyError:
+                raise ValueError("Unknown tuning profile %r, expected one of "
+                                 "%r" % (name, sorted(TUNING_PROFILES)))
+
+        options = {}
+        if self.TUNING_PROFILE:
+            options.update(profile(self.TUNING_PROFILE))
+        if self.QUEUE_TUNING_PROFILES:
+            # Prefetching applies to the worker as a whole
+            options['queue_options'] = {
+                queue: {
+                    k: v for k, v in profile(name).items()
+                    if k != 'worker_prefetch_multiplier'
+                }
+                for queue, name in self.QUEUE_TUNING_PROFILES.items()
+            }
+        return options
+
     @property
     def _default_exchange_obj(self):
-        return Exchange(
-            self.task_default_exchange,
-            self.task_default_exchange_type)
+        """ Exchange object, rebuilt only if the exchange settings change """
+        settings = (
+            self.task_default_exchange, self.task_default_exchange_type)
+        exchange = self._exchange
+        if exchange is None or (exchange.name, exchange.type) != settings:
+            exchange = self._exchange = Exchange(*settings)
+            self._route_cache.clear()  # Cached routes hold the old exchange
+        return exchange
 
     @staticmethod
-    def _generate_queues(queues, exchange, platform_queue):
-        """ Queues known by this worker """
+    def _generate_queues(queues, exchange, platform_queue,
+                         platform_bindings=('#',)):
+        """
+        Queues known by this worker. The platform queue is bound to the
+        exchange with each of the 'platform_bindings' routing key patterns.
+        """
+        platform_bindings = list(platform_bindings)
+        bindings = []
+        if len(platform_bindings) > 1:
+            # Bound copies of queues with bindings lose their exchange, and
+            # so the binding of their routing key
+            bindings = [
+                binding(exchange, routing_key=pattern)
+                for pattern in platform_bindings
+            ]
         return set([
             Queue('celery', exchange, routing_key='celery'),
-            Queue(platform_queue, exchange, routing_key='#'),
+            Queue(platform_queue, exchange, routing_key=platform_bindings[0],
+                  bindings=bindings),
         ] + [
             Queue(q_name, exchange, routing_key=q_name)
             for q_name in queues
         ])
 
     def _route_task(self, name, args, kwargs, options, task=None, **kw):
+        route = self._route_cache.get(name)
+        if route is None:
+            route = self._route_cache[name] = self._build_route(name)
+        # Celery merges publish options into the returned route
+        return dict(route)
+
+    def _build_route(self, name):
+        routing_key = name.split('.')[0]
+        excluded = any(
+            fnmatchcase(name, pattern)
+            for pattern in self.PLATFORM_EXCLUDED_TASKS)
+        if excluded and (routing_key == 'celery' or
+                         routing_key in self.QUEUES):
+            # Published to the queue through the broker's default exchange,
+            # bypassing the platform queue's bindings
+            return {
+                'queue': routing_key,
+                'exchange': '',
+                'routing_key': routing_key,
+            }
         return {
-            'routing_key': name.split('.')[0],
+            'routing_key': routing_key,
             'exchange': self._default_exchange_obj
         }
+
+    def route_cache_info(self):
+        """ Report on the effectiveness of the task routing cache """
+        return self._route_cache.info()
@@ -0,0 +1,478 @@
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from celery import Task, bootsteps, states
+from celery.exceptions import Ignore, Reject, Retry
+from celery.utils.nodenames import gethostname
+from celery.worker import state
+from kombu.utils.compat import register_after_fork
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+RUNNING = 'running'
+DONE = 'done'
+
+# Maximum number of entries of a ChangeMessageVisibilityBatch call
+SQS_MAX_BATCH_SIZE = 10
+
+
+class ClaimStore(object):
+    """
+    Shared record of claimed task ids. A claim is held by an 'owner' (the
+    worker's host name) until it expires, while its task is RUNNING, and
+    then kept once the task is DONE so that redelivered messages can be
+    recognised. Expired claims may be taken over.
+    """
+
+    def claim(self, task_id, owner, now, expires):
+        """ Claim 'task_id' until 'expires', returning whether claimed """
+        raise NotImplementedError()
+
+    def extend(self, task_ids, owner, expires):
+        """ Extend running claims held by 'owner', returning how many """
+        raise NotImplementedError()
+
+    def finish(self, task_id, owner, expires):
+        """ Mark a claim as DONE, to be remembered until 'expires' """
+        raise NotImplementedError()
+
+    def release(self, task_id, owner):
+        """ Drop a claim, so that the task may be claimed again """
+        raise NotImplementedError()
+
+    def purge(self, now):
+        """ Drop expired claims, returning how many """
+        raise NotImplementedError()
+
+    def status(self, task_id):
+        """ Status of the claim on 'task_id' (RUNNING or DONE), if any """
+        raise NotImplementedError()
+
+
+class MemoryClaimStore(ClaimStore):
+    """
+    Claims held in the memory of the current process. Only suitable for
+    tests, or workers executing tasks in a single process (e.g. with the
+    'solo' pool).
+    """
+
+    def __init__(self):
+        self.claims = {}
+        self._lock = threading.Lock()
+
+    def claim(self, task_id, owner, now, expires):
+        with self._lock:
+            held = self.claims.get(task_id)
+            if held is not None and held[2] >= now:
+                return False
+            self.claims[task_id] = [owner, RUNNING, expires]
+            return True
+
+    def extend(self, task_ids, owner, expires):
+        extended = 0
+        with self._lock:
+            for task_id in task_ids:
+                held = self.claims.get(task_id)
+                if held is not None and held[:2] == [owner, RUNNING]:
+                    held[2] = expires
+                    extended += 1
+        return extended
+
+    def finish(self, task_id, owner, expires):
+        with self._lock:
+            held = self.claims.get(task_id)
+            if held is not None and held[0] == owner:
+                held[1:] = [DONE, expires]
+
+    def release(self, task_id, owner):
+        with self._lock:
+            held = self.claims.get(task_id)
+            if held is not None and held[0] == owner:
+                del self.claims[task_id]
+
+    def purge(self, now):
+        with self._lock:
+            expired = [
+                task_id for task_id, held in self.claims.items()
+                if held[2] < now
+            ]
+            for task_id in expired:
+                del self.claims[task_id]
+        return len(expired)
+
+    def status(self, task_id):
+        with self._lock:
+            held = self.claims.get(task_id)
+            return held[1] if held is not None else None
+
+
+metadata = sa.MetaData()
+
+claims_table = sa.Table(
+    'cadasta_task_claims', metadata,
+    sa.Column('task_id', sa.String(155), primary_key=True),
+    sa.Column('owner', sa.String(255), nullable=False),
+    sa.Column('status', sa.String(16), nullable=False),
+    sa.Column('expires', sa.DateTime, nullable=False, index=True),
+)
+
+
+def _after_fork_dispose_engine(store):
+    store.engine.dispose()
+
+
+class DatabaseClaimStore(ClaimStore):
+    """
+    Claims held as rows of a database table (e.g. in the result database),
+    created on first use. A claim is made by inserting its row or, should
+    the row's claim have expired, by taking it over with a conditional
+    update, so that only one worker can succeed.
+    """
+
+    def __init__(self, url, **engine_options):
+        self.engine = sa.create_engine(url, **engine_options)
+        self._table_ready = False
+        register_after_fork(self, _after_fork_dispose_engine)
+
+    def _connect(self):
+        if not self._table_ready:
+            claims_table.create(self.engine, checkfirst=True)
+            self._table_ready = True
+        return self.engine.begin()
+
+    def claim(self, task_id, owner, now, expires):
+        table = claims_table
+        try:
+            with self._connect() as conn:
+                conn.execute(table.insert().values(
+                    task_id=task_id, owner=owner, status=RUNNING,
+                    expires=expires))
+            return True
+        except IntegrityError:
+            pass
+        with self._connect() as conn:
+            taken = conn.execute(table.update().where(sa.and_(
+                table.c.task_id == task_id, table.c.expires < now,
+            )).values(owner=owner, status=RUNNING, expires=expires))
+            return taken.rowcount == 1
+
+    def extend(self, task_ids, owner, expires):
+        table = claims_table
+        with self._connect() as conn:
+            return conn.execute(table.update().where(sa.and_(
+                table.c.task_id.in_(task_ids), table.c.owner == owner,
+                table.c.status == RUNNING,
+            )).values(expires=expires)).rowcount
+
+    def finish(self, task_id, owner, expires):
+        table = claims_table
+        with self._connect() as conn:
+            conn.execute(table.update().where(sa.and_(
+                table.c.task_id == task_id, table.c.owner == owner,
+            )).values(status=DONE, expires=expires))
+
+    def release(self, task_id, owner):
+        table = claims_table
+        with self._connect() as conn:
+            conn.execute(table.delete().where(sa.and_(
+                table.c.task_id == task_id, table.c.owner == owner)))
+
+    def purge(self, now):
+        with self._connect() as conn:
+            return conn.execute(claims_table.delete().where(
+                claims_table.c.expires < now)).rowcount
+
+    def status(self, task_id):
+        table = claims_table
+        with self._connect() as conn:
+            return conn.execute(sa.select([table.c.status]).where(
+                table.c.task_id == task_id)).scalar()
+
+
+def claim_store_from_url(url, backend=None):
+    """
+    Build a claim store from 'memory', a SQLAlchemy database URL or, if
+    empty, the URL of a database result 'backend'.
+    """
+    if url == 'memory':
+        return MemoryClaimStore()
+    if not url:
+        url = getattr(backend, 'url', None)
+        if not url or not hasattr(backend, 'ResultSession'):
+            raise ValueError(
+                "DEDUP_STORE is required unless results are stored in a "
+                "database")
+    return DatabaseClaimStore(url)
+
+
+class Deduplicator(object):
+    """
+    Claims task ids in a ClaimStore before their execution, so that a
+    message delivered more than once is only executed once. Claims last
+    'claim_ttl' seconds unless extended (see TaskHeartbeat), and ids of
+    completed tasks are remembered for 'done_ttl' seconds. Counts outcomes
+    in 'counters'.
+    """
+
+    def __init__(self, store, claim_ttl=60, done_ttl=60 * 60 * 24):
+        self.store = store
+        self.claim_ttl = claim_ttl
+        self.done_ttl = done_ttl
+        self.counters = Counter()
+
+    def _expires(self, ttl, now=None):
+        return (now or datetime.utcnow()) + timedelta(seconds=ttl)
+
+    def claim(self, task_id, owner):
+        """
+        Claim a task id for execution, returning False for duplicates.
+        Should the store fail, the task is executed regardless.
+        """
+        now = datetime.utcnow()
+        try:
+            claimed = self.store.claim(
+                task_id, owner, now, self._expires(self.claim_ttl, now))
+        except Exception:
+            logger.warning(
+                "Unable to claim task %s, executing it regardless",
+                task_id, exc_info=True)
+            self.counters['errors'] += 1
+            return True
+        self.counters['claimed' if claimed else 'duplicates'] += 1
+        return claimed
+
+    def is_done(self, task_id):
+        """
+        Whether a task id is claimed by a completed task, rather than by a
+        running one (or by none, should its claim have expired). Counts
+        duplicates that aren't as 'deferred'.
+        """
+        try:
+            done = self.store.status(task_id) == DONE
+        except Exception:
+            logger.warning("Unable to check task %s", task_id, exc_info=True)
+            self.counters['errors'] += 1
+            done = False
+        if not done:
+            self.counters['deferred'] += 1
+        return done
+
+    def extend(self, task_ids, owner):
+        extended = self.store.extend(
+            task_ids, owner, self._expires(self.claim_ttl))
+        self.counters['extended'] += extended
+        return extended
+
+    def finish(self, task_id, owner):
+        try:
+            self.store.finish(task_id, owner, self._expires(self.done_ttl))
+        except Exception:
+            logger.warning("Unable to mark task %s as done", task_id,
+                           exc_info=True)
+            self.counters['errors'] += 1
+        else:
+            self.counters['finished'] += 1
+
+    def release(self, task_id, owner):
+        try:
+            self.store.release(task_id, owner)
+        except Exception:
+            logger.warning("Unable to release task %s", task_id,
+                           exc_info=True)
+            self.counters['errors'] += 1
+        else:
+            self.counters['released'] += 1
+
+    def purge(self):
+        return self.store.purge(datetime.utcnow())
+
+    def stats(self):
+        """ Counts of claimed, duplicate, finished and released tasks """
+        stats = dict.fromkeys(
+            ('claimed', 'duplicates', 'deferred', 'finished', 'released',
+             'extended', 'errors'), 0)
+        stats.update(self.counters)
+        return stats
+
+
+def get_deduplicator(app):
+    """ Return the app's Deduplicator, creating it on first use """
+    deduplicator = getattr(app, '_deduplicator', None)
+    if deduplicator is None:
+        conf = app.conf
+        store = claim_store_from_url(
+            getattr(conf, 'DEDUP_STORE', ''), app.backend)
+        deduplicator = app._deduplicator = Deduplicator(
+            store, claim_ttl=getattr(conf, 'DEDUP_CLAIM_TTL', 60),
+            done_ttl=getattr(conf, 'DEDUP_DONE_TTL', 60 * 60 * 24))
+    return deduplicator
+
+
+class DedupTask(Task):
+    """
+    Task base class skipping messages whose task id was already claimed,
+    i.e. redeliveries of a message still being executed, or of a completed
+    task. Messages of completed tasks are acknowledged without storing a
+    result, while those of running tasks are rejected without being
+    requeued, so that SQS delivers them again once their visibility timeout
+    lapses (should the running task be lost, the next delivery executes
+    it). The claim is released should the task be retried or its message
+    rejected, so that the next delivery is executed.
+
+    The STARTED state is only stored once the task is claimed, as it would
+    otherwise overwrite the result of the task's first delivery.
+    """
+    track_started = False
+    #: Store the STARTED state once claimed, defaults to task_track_started
+    track_started_once_claimed = None
+
+    def __call__(self, *args, **kwargs):
+        request = self.request
+        if request.called_directly or request.is_eager:
+            return super(DedupTask, self).__call__(*args, **kwargs)
+
+        deduplicator = get_deduplicator(self.app)
+        # Pool processes don't know the worker's node name
+        task_id, owner = request.id, gethostname()
+        if not deduplicator.claim(task_id, owner):
+            if deduplicator.is_done(task_id):
+                logger.info("Skipped duplicate delivery of %s[%s]",
+                            self.name, task_id)
+                raise Ignore()
+            logger.info("Deferred duplicate delivery of running %s[%s]",
+                        self.name, task_id)
+            raise Reject(requeue=False)
+        track_started = self.track_started_once_claimed
+        if track_started is None:
+            track_started = self.app.conf.task_track_started
+        if track_started and not self.ignore_result:
+            self.backend.store_result(
+                task_id, {'pid': os.getpid(), 'hostname': owner},
+                states.STARTED, request=request)
+        try:
+            result = super(DedupTask, self).__call__(*args, **kwargs)
+        except (Retry, Reject):
+            deduplicator.release(task_id, owner)
+            raise
+        except Exception:
+            deduplicator.finish(task_id, owner)
+            raise
+        deduplicator.finish(task_id, owner)
+        return result
+
+
+def _visibility(message):
+    """
+    Queue URL and visibility timeout of a message received from SQS, as
+    well as its receipt handle, or None for other messages
+    """
+    delivery_info = message.delivery_info or {}
+    sqs_message = delivery_info.get('sqs_message')
+    if sqs_message is None:
+        return None
+    channel = message.channel
+    # Per-queue timeouts of the toolbox's SQS transport
+    queue_option = getattr(channel, '_queue_option', None)
+    timeout = None
+    if queue_option is not None:
+        timeout = queue_option(
+            delivery_info.get('routing_key'), 'visibility_timeout')
+    return (delivery_info['sqs_queue'],
+            int(timeout or channel.visibility_timeout),
+            sqs_message['ReceiptHandle'])
+
+
+def extend_visibility(messages):
+    """
+    Reset the visibility timeout of messages received from SQS, so that
+    they aren't delivered again while their tasks run, with one
+    ChangeMessageVisibilityBatch call per queue and 10 messages. Returns
+    how many were extended.
+    """
+    batches = OrderedDict()
+    for message in messages:
+        visibility = _visibility(message)
+        if visibility is not None:
+            queue_url, timeout, receipt = visibility
+            entries = batches.setdefault((message.channel, queue_url), [])
+            entries.append({
+                'Id': str(len(entries)), 'ReceiptHandle': receipt,
+                'VisibilityTimeout': timeout,
+            })
+    extended = 0
+    for (channel, queue_url), entries in batches.items():
+        for i in range(0, len(entries), SQS_MAX_BATCH_SIZE):
+            batch = entries[i:i + SQS_MAX_BATCH_SIZE]
+            try:
+                resp = channel.sqs.change_message_visibility_batch(
+                    QueueUrl=queue_url, Entries=batch)
+            except Exception:
+                logger.warning("Unable to extend visibility of %d messages "
+                               "of %s", len(batch), queue_url, exc_info=True)
+                continue
+            failed = resp.get('Failed') or []
+            if failed:
+                logger.warning("Unable to extend visibility of %d messages "
+                               "of %s: %r", len(failed), queue_url, failed)
+            extended += len(batch) - len(failed)
+    return extended
+
+
+class TaskHeartbeat(bootsteps.StartStopStep):
+    """
+    Consumer bootstep that, every TASK_HEARTBEAT_INTERVAL seconds, resets
+    the visibility timeout of the SQS messages of active tasks and extends
+    the claims of active DedupTasks. Expired claims are purged every
+    DEDUP_CLAIM_TTL seconds.
+    """
+    requires = ('celery.worker.consumer.tasks:Tasks',)
+
+    def __init__(self, c, **kwargs):
+        conf = c.app.conf
+        self.interval = getattr(conf, 'TASK_HEARTBEAT_INTERVAL', 0)
+        self.purge_interval = getattr(conf, 'DEDUP_CLAIM_TTL', 60)
+        self.timers = []
+        super(TaskHeartbeat, self).__init__(c, **kwargs)
+
+    def start(self, c):
+        self.timers = [
+            c.timer.call_repeatedly(self.interval, self.beat, (c,)),
+            c.timer.call_repeatedly(self.purge_interval, self.purge, (c,)),
+        ]
+
+    def stop(self, c):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
+
+    def _deduplicator(self, c):
+        """ The app's Deduplicator, if any DedupTask is registered """
+        if any(isinstance(task, DedupTask) for task in c.app.tasks.values()):
+            return get_deduplicator(c.app)
+
+    def beat(self, c):
+        requests = list(state.active_requests)
+        extend_visibility(request.message for request in requests)
+        task_ids = [
+            request.id for request in requests
+            if isinstance(request.task, DedupTask)
+        ]
+        if task_ids:
+            try:
+                self._deduplicator(c).extend(task_ids, gethostname())
+            except Exception:
+                logger.warning("Unable to extend task claims", exc_info=True)
+
+    def purge(self, c):
+        deduplicator = self._deduplicator(c)
+        if deduplicator is None:
+            return
+        try:
+            deduplicator.purge()
+        except Exception:
+            logger.warning("Unable to purge task claims", exc_info=True)
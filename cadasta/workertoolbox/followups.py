@@ -0,0 +1,161 @@
+from uuid import uuid4
+
+from celery import current_task, signature
+from kombu.utils.json import dumps, loads
+
+from .blobs import blob_store_from_url
+from .utils import LRUCache
+
+# Message header referencing stored followups
+FOLLOWUPS_HEADER = 'cadasta_followups'
+# Request attribute holding the key of followups passed on to another task
+FORWARDED = 'cadasta_followups_forwarded'
+KEY_PREFIX = 'followups-'
+
+
+class FollowupStore(object):
+    """
+    Stores a task's followups (callbacks and errbacks) once, so that only a
+    key referencing them needs to be sent with each subsequent message.
+    Followups are saved to the provided BlobStore or, by default, as a group
+    in the app's result backend. Loaded followups are held in a
+    least-recently-used cache of 'cache_size' entries. Followups are deleted
+    once applied, unless passed on to another task.
+    """
+
+    def __init__(self, app, blob_store=None, cache_size=128):
+        self.app = app
+        self.blob_store = blob_store
+        self._cache = LRUCache(cache_size)
+
+    def save(self, followups):
+        key = KEY_PREFIX + uuid4().hex
+        if self.blob_store is not None:
+            self.blob_store.put(key, dumps(followups).encode('utf-8'))
+        else:
+            self.app.backend.save_group(key, followups)
+        self._cache[key] = followups
+        return key
+
+    def load(self, key):
+        followups = self._cache.get(key)
+        if followups is None:
+            if self.blob_store is not None:
+                followups = loads(self.blob_store.get(key).decode('utf-8'))
+            else:
+                followups = self.app.backend.restore_group(key, cache=False)
+                if followups is None:
+                    raise KeyError(key)
+            self._cache[key] = followups
+        return followups
+
+    def delete(self, key):
+        if self.blob_store is not None:
+            self.blob_store.delete(key)
+        else:
+            self.app.backend.delete_group(key)
+        self._cache.pop(key)
+
+
+def get_followup_store(app):
+    """ Return the app's FollowupStore, creating it on first use """
+    store = getattr(app, '_followup_store', None)
+    if store is None:
+        conf = app.conf
+        url = getattr(conf, 'FOLLOWUP_STORE', '')
+        store = app._followup_store = FollowupStore(
+            app, blob_store=blob_store_from_url(url) if url else None,
+            cache_size=getattr(conf, 'FOLLOWUP_CACHE_SIZE', 128))
+    return store
+
+
+def followups_key(request):
+    """ Key of the followups referenced by a task request, if any """
+    key = getattr(request, FOLLOWUPS_HEADER, None)
+    if key is None:
+        # Eagerly applied tasks keep custom headers apart
+        key = (getattr(request, 'headers', None) or {}).get(FOLLOWUPS_HEADER)
+    return key
+
+
+def forward_followups(task, callbacks, errbacks):
+    """
+    Return options passing a task's followups on by reference. Followups
+    already held by reference are forwarded without being loaded.
+    """
+    request = task.request
+    key = followups_key(request)
+    if callbacks or errbacks:
+        store = get_followup_store(task.app)
+        followups = {
+            'link': list(callbacks or ()),
+            'link_error': list(errbacks or ()),
+        }
+        if key is not None:
+            for option, followup in store.load(key).items():
+                followups[option].extend(followup)
+        key = store.save(followups)
+    elif key is None:
+        return {'link': None, 'link_error': None}
+    setattr(request, FORWARDED, key)
+    return {'headers': {FOLLOWUPS_HEADER: key}}
+
+
+def on_before_task_publish(body=None, headers=None, **kwargs):
+    """
+    Keep the followups referenced by a task on the messages republishing it
+    with its own id (i.e. its retries), as Celery doesn't copy custom
+    headers onto them
+    """
+    if headers is None or FOLLOWUPS_HEADER in headers:
+        return
+    task_id = headers.get('id')
+    if task_id is None and isinstance(body, dict):  # Protocol 1
+        task_id = body.get('id')
+    task = current_task
+    if not task or task_id is None or task.request.id != task_id:
+        return
+    key = followups_key(task.request)
+    if key is not None:
+        headers[FOLLOWUPS_HEADER] = key
+
+
+def _delete_unless_forwarded(store, request, key):
+    # Followups merged into new ones (or applied) are no longer referenced
+    if getattr(request, FORWARDED, None) != key:
+        store.delete(key)
+
+
+def on_task_success(sender=None, result=None, **kwargs):
+    """
+    Apply callbacks referenced by a task that didn't forward them, deleting
+    the followups unless the task passed them on unchanged
+    """
+    request = sender.request
+    key = followups_key(request)
+    if key is None:
+        return
+    store = get_followup_store(sender.app)
+    if getattr(request, FORWARDED, None) is None:
+        for callback in store.load(key)['link']:
+            signature(callback, app=sender.app).apply_async(
+                (result,), parent_id=request.id,
+                root_id=request.root_id or request.id)
+    _delete_unless_forwarded(store, request, key)
+
+
+def on_task_failure(sender=None, exception=None, traceback=None, **kwargs):
+    """
+    Apply errbacks referenced by a failed task, deleting the followups
+    unless the task passed them on unchanged
+    """
+    request = sender.request
+    key = followups_key(request)
+    if key is None:
+        return
+    store = get_followup_store(sender.app)
+    errbacks = store.load(key)['link_error']
+    if errbacks:
+        request.errbacks = errbacks
+        sender.backend._call_task_errbacks(request, exception, traceback)
+    _delete_unless_forwarded(store, request, key)
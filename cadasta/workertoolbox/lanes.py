@@ -0,0 +1,165 @@
+import logging
+from multiprocessing.pool import ThreadPool
+
+from celery import bootsteps
+from celery.worker import state
+from celery.worker.request import Request
+from celery.worker.strategy import proto1_to_proto2
+from kombu import Consumer
+from vine import promise
+
+logger = logging.getLogger(__name__)
+
+# Tasks accepted by lanes, which are also counted by state.all_total_count
+total_count = [0]
+
+
+def lane_options(app):
+    """
+    Concurrency and prefetch count of each lane in QUEUE_LANES, keyed by
+    queue name. Prefetch defaults to the lane's concurrency multiplied by
+    'worker_prefetch_multiplier'.
+    """
+    multiplier = app.conf.worker_prefetch_multiplier
+    lanes = {}
+    queue_lanes = getattr(app.conf, 'QUEUE_LANES', None) or {}
+    for name, options in queue_lanes.items():
+        concurrency = options.get('concurrency', 1)
+        lanes[name] = {
+            'concurrency': concurrency,
+            'prefetch': options.get('prefetch') or concurrency * multiplier,
+        }
+    return lanes
+
+
+class LaneRequest(Request):
+    """ Request of a task executed by a lane rather than the worker's pool """
+    __slots__ = ()
+
+
+class Lane(object):
+    """
+    Consumes a single queue on its own channel, whose prefetch count limits
+    the lane's unacknowledged messages, and executes its tasks in a pool of
+    'concurrency' threads of the worker's main process. Messages are
+    acknowledged by the worker's consumer, as are those of its pool, and
+    requests are registered with the worker's state (e.g. to be reported as
+    active, and have their visibility extended by the TaskHeartbeat). As
+    threads can't be interrupted, time limits aren't enforced.
+    """
+
+    def __init__(self, consumer, queue, concurrency=1, prefetch=1):
+        self.consumer = consumer
+        self.app = consumer.app
+        self.queue = queue
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        self.pool = None
+        self.channel = None
+        self.task_consumer = None
+
+    def __repr__(self):
+        return '<Lane: {0.queue.name} concurrency={0.concurrency} ' \
+            'prefetch={0.prefetch}>'.format(self)
+
+    def start(self, connection):
+        if self.pool is None:
+            self.pool = ThreadPool(self.concurrency)
+        self.channel = connection.channel()
+        self.channel.basic_qos(0, self.prefetch, False)
+        self.task_consumer = Consumer(
+            self.channel, queues=[self.queue], on_message=self.on_message,
+            accept=self.app.conf.accept_content)
+        self.task_consumer.consume()
+        logger.info("Started %r", self)
+        conf = self.app.conf
+        if conf.task_time_limit or conf.task_soft_time_limit:
+            logger.warning("Time limits aren't enforced by %r", self)
+
+    def on_message(self, message):
+        c, headers = self.consumer, message.headers
+        if 'task' in headers:
+            body, decoded, utc = (
+                message.body, False, self.app.uses_utc_timezone())
+        else:
+            body, headers, decoded, utc = proto1_to_proto2(
+                message, message.payload)
+        task = self.app.tasks.get(headers['task'])
+        if task is None:
+            logger.error("Received unregistered task %r on %r",
+                         headers['task'], self)
+            message.reject_log_error(logger, c.connection_errors)
+            return
+        request = LaneRequest(
+            message, app=self.app, task=task, hostname=c.hostname,
+            eventer=c.event_dispatcher, connection_errors=c.connection_errors,
+            on_ack=promise(c.call_soon, (message.ack_log_error,)),
+            on_reject=promise(c.call_soon, (message.reject_log_error,)),
+            body=body, headers=headers, decoded=decoded, utc=utc)
+        state.task_reserved(request)
+        self.pool.apply_async(self.execute, (request,))
+
+    @staticmethod
+    def execute(request):
+        state.task_accepted(request)
+        total_count[0] += 1
+        try:
+            request.execute()
+        except Exception:
+            logger.exception("Failed to execute %s", request)
+            request.reject()
+        finally:
+            state.task_ready(request)
+
+    def stop(self):
+        """ Stop consuming, leaving running tasks to complete """
+        if self.task_consumer is not None:
+            self.task_consumer.cancel()
+            self.task_consumer = None
+
+    def shutdown(self):
+        """ Wait for running tasks to complete and close the channel """
+        self.stop()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            # Send acknowledgements left by the final tasks
+            self.consumer.perform_pending_operations()
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+
+class LaneStep(bootsteps.StartStopStep):
+    """
+    Consumer bootstep running a Lane for each of QUEUE_LANES consumed by the
+    worker, so that tasks of one queue can't hold up those of another. Lane
+    queues are no longer consumed by the worker's pool.
+    """
+    requires = ('celery.worker.consumer.tasks:Tasks',)
+
+    def __init__(self, c, **kwargs):
+        self.lanes = []
+        queues = c.app.amqp.queues
+        consumed = list(queues.consume_from)
+        lanes = lane_options(c.app)
+        names = [name for name in sorted(lanes) if name in consumed]
+        if names:
+            queues.select(consumed)  # All queues are consumed by default
+        for name in names:
+            queues.deselect(name)
+            self.lanes.append(Lane(c, queues[name], **lanes[name]))
+        super(LaneStep, self).__init__(c, **kwargs)
+
+    def start(self, c):
+        for lane in self.lanes:
+            lane.start(c.connection)
+
+    def stop(self, c):
+        for lane in self.lanes:
+            lane.stop()
+
+    def shutdown(self, c):
+        for lane in self.lanes:
+            lane.shutdown()
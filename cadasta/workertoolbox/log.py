@@ -0,0 +1,118 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+
+from kombu.five import Empty, Full
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 100
+
+_formatter = logging.Formatter()
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler putting records on a queue without blocking, for a
+    QueueListener to pass on to the handlers doing the actual I/O. Records
+    are made picklable (by merging their message arguments and rendering
+    any exception) so that a multiprocessing queue may be used. Records
+    arriving while the queue is full are dropped and counted.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Thread passing records from a queue to 'handlers', taking up to
+    'batch_size' records from the queue at a time.
+    """
+
+    _sentinel = None
+
+    def __init__(self, queue, handlers, batch_size=DEFAULT_BATCH_SIZE):
+        self.queue = queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._monitor, name='QueueListener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Handle all queued records and stop the listener thread """
+        # Forked children share the queue but not the thread
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def _batch(self):
+        """ Block for a record, then take any others already queued """
+        batch = [self.queue.get()]
+        while batch[-1] is not self._sentinel and (
+                len(batch) < self.batch_size):
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _monitor(self):
+        while True:
+            batch = self._batch()
+            for record in batch:
+                if record is self._sentinel:
+                    return
+                self.handle(record)
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def setup_queue_logging(logger=None, queue_size=DEFAULT_QUEUE_SIZE,
+                        batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Move the handlers of 'logger' (the root logger by default) behind a
+    QueueHandler, with a QueueListener thread doing their I/O. As the
+    queue is a multiprocessing queue, processes forked afterwards (e.g.
+    Celery's prefork pool) log through the listener of this process, which
+    is then the only writer of any log files. Returns the listener.
+    """
+    logger = logger or logging.getLogger()
+    queue = multiprocessing.Queue(queue_size)
+    listener = QueueListener(queue, logger.handlers[:], batch_size)
+    logger.handlers = [QueueHandler(queue)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,162 @@
+import logging
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+from celery.backends.database import DatabaseBackend, session_cleanup
+from celery.backends.database.models import Task, TaskSet
+from celery.utils.time import maybe_timedelta
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+PURGE_TASK_NAME = 'celery.purge_expired_results'
+# Entry replacing the 'celery.backend_cleanup' task that Celery's beat
+# schedules, which deletes all expired rows in a single statement
+PURGE_SCHEDULE_ENTRY = 'celery.backend_cleanup'
+
+# Indexes supporting expiry (and state) lookups. Being attached to Celery's
+# tables, they are also created alongside the tables of new databases.
+RESULT_INDEXES = (
+    sa.Index('ix_celery_taskmeta_status', Task.status),
+    sa.Index('ix_celery_taskmeta_date_done', Task.date_done),
+    sa.Index('ix_celery_tasksetmeta_date_done', TaskSet.date_done),
+)
+
+
+def _index_names(engine, table):
+    return {index['name'] for index in sa.inspect(engine).get_indexes(table)}
+
+
+def _concurrent_index(index):
+    """
+    Copy of an index, on a copy of its table, built without locking writes
+    to the table on PostgreSQL (CREATE INDEX CONCURRENTLY)
+    """
+    table = index.table.tometadata(sa.MetaData())
+    index = next(i for i in table.indexes if i.name == index.name)
+    index.dialect_kwargs['postgresql_concurrently'] = True
+    return index
+
+
+def ensure_result_indexes(backend):
+    """
+    Create any of RESULT_INDEXES missing from the backend's tables,
+    returning the names of those created. Meant to be run once against
+    existing databases (new ones are created with the indexes), as on
+    PostgreSQL indexes are built concurrently, outside of a transaction.
+    """
+    session = backend.ResultSession()
+    with session_cleanup(session):
+        engine = session.get_bind()
+    # CREATE INDEX CONCURRENTLY can't run within a transaction
+    options = ({'isolation_level': 'AUTOCOMMIT'}
+               if engine.dialect.name == 'postgresql' else {})
+    created = []
+    for index in RESULT_INDEXES:
+        if index.name in _index_names(engine, index.table.name):
+            continue
+        try:
+            with engine.connect() as conn:
+                _concurrent_index(index).create(
+                    conn.execution_options(**options))
+        except DBAPIError:
+            # Another worker may have created it concurrently
+            if index.name not in _index_names(engine, index.table.name):
+                raise
+        else:
+            created.append(index.name)
+    if created:
+        logger.info("Created result indexes: %s", ', '.join(created))
+    return created
+
+
+def _purge_rows(session, table, criteria, batch_size):
+    """
+    Delete rows matching 'criteria', at most 'batch_size' per transaction,
+    so that locks are only briefly held. Returns the number deleted.
+    """
+    batch = sa.select([table.c.id]).where(criteria).limit(batch_size)
+    purged = 0
+    while True:
+        deleted = session.execute(
+            table.delete().where(table.c.id.in_(batch))).rowcount
+        session.commit()
+        purged += deleted
+        if deleted < batch_size:
+            return purged
+
+
+def purge_expired_results(backend, expires, policy=None, batch_size=1000,
+                          now=None):
+    """
+    Delete task results completed more than 'expires' (a timedelta or
+    number of seconds) ago, and likewise group results. 'policy' maps task
+    states to their own expiry, where None keeps results of that state
+    indefinitely. An 'expires' of None only purges states in 'policy'.
+    Returns a report of the number of rows purged and seconds taken.
+    """
+    policy = policy or {}
+    now = now or datetime.utcnow()
+    start = time.time()
+    task, group = Task.__table__, TaskSet.__table__
+
+    criteria = [
+        (task, (task.c.status == state) &
+         (task.c.date_done < now - maybe_timedelta(state_expires)))
+        for state, state_expires in sorted(policy.items())
+        if state_expires is not None
+    ]
+    if expires is not None:
+        cutoff = now - maybe_timedelta(expires)
+        where = task.c.date_done < cutoff
+        if policy:
+            where &= ~task.c.status.in_(list(policy))
+        criteria += [(task, where), (group, group.c.date_done < cutoff)]
+
+    report = {'tasks': 0, 'groups': 0}
+    session = backend.ResultSession()
+    with session_cleanup(session):
+        for table, where in criteria:
+            report['tasks' if table is task else 'groups'] += _purge_rows(
+                session, table, where, batch_size)
+    report['seconds'] = time.time() - start
+    logger.info(
+        "Purged %(tasks)d expired task result(s) and %(groups)d group "
+        "result(s) in %(seconds).3fs", report)
+    return report
+
+
+def register_purge_task(app, interval):
+    """
+    Register a task purging the app's expired results (see
+    purge_expired_results), scheduled by beat every 'interval' seconds.
+    """
+    if PURGE_TASK_NAME not in app.tasks:
+        @app.task(name=PURGE_TASK_NAME, shared=False)
+        def purge_expired_results_task():
+            conf = app.conf
+            return purge_expired_results(
+                app.backend, conf.result_expires,
+                policy=getattr(conf, 'RESULT_EXPIRY_POLICY', None),
+                batch_size=getattr(conf, 'RESULT_PURGE_BATCH_SIZE', 1000))
+
+    app.conf.beat_schedule[PURGE_SCHEDULE_ENTRY] = {
+        'task': PURGE_TASK_NAME,
+        'schedule': interval,
+        'options': {'expires': interval},
+    }
+    return app.tasks[PURGE_TASK_NAME]
+
+
+def setup_result_maintenance(app):
+    """
+    Register the task purging the expired results of a SQLAlchemy result
+    backend. Indexes supporting it are created along with the backend's
+    tables, or by ensure_result_indexes for existing tables.
+    """
+    if not isinstance(app.backend, DatabaseBackend):
+        logger.warning(
+            "Not purging results of non-database backend %r", app.backend)
+        return None
+    return register_purge_task(app, app.conf.RESULT_PURGE_INTERVAL)
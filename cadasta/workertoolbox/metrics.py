@@ -0,0 +1,312 @@
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+
+from kombu.five import Full
+
+# Upper bounds (in seconds) of latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+    300, 600, 1800, 3600,
+)
+# Series beyond this many task names are tracked under OTHER
+MAX_TASK_NAMES = 500
+OTHER = '__other__'
+# Observations of forked processes awaiting their aggregating process
+DEFAULT_QUEUE_SIZE = 10000
+
+PUBLISH_HEADER = 'published_at'
+
+
+class Histogram(object):
+    """
+    Fixed-memory latency histogram. Observations only increment counters,
+    so no lock is taken; under heavy thread contention an occasional
+    observation may be lost, which is acceptable for monitoring.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ Estimate quantile as the upper bound of its bucket """
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts[:-1]):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i]
+        return float('inf')
+
+    def snapshot(self):
+        cumulative, seen = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            cumulative.append((bound, seen))
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': cumulative,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Series(object):
+    """ Latencies and counters for a single queue or task name """
+
+    COUNTERS = ('published', 'succeeded', 'failed', 'retried')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.wait = Histogram(buckets)
+        self.runtime = Histogram(buckets)
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def incr(self, counter):
+        self.counters[counter] += 1
+
+    def snapshot(self):
+        return dict(
+            self.counters,
+            wait=self.wait.snapshot(),
+            runtime=self.runtime.snapshot())
+
+
+class TaskMetrics(object):
+    """
+    Collects per-queue and per-task-name queue wait time, execution time and
+    outcome counts from Celery task signals. Queue wait time is measured
+    from a timestamp header added to messages when they are published.
+    Routing keys that aren't among the provided 'queues', and task names
+    beyond MAX_TASK_NAMES, are tracked under OTHER.
+
+    Signals are handled in the process running tasks, which is a pool
+    process under Celery's prefork pool. Once listen() is called (as when
+    the worker starts), processes forked afterwards send their observations
+    to the listening process, whose snapshot() then covers all of them.
+    """
+
+    def __init__(self, queues=(), buckets=DEFAULT_BUCKETS,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        self.buckets = buckets
+        self.queues = {name: Series(buckets) for name in queues}
+        self.queues[OTHER] = Series(buckets)
+        self.tasks = {}
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._started = {}
+        self._queue = None
+        self._listener = None
+        self._listener_pid = None
+
+    def _series(self, task_name, routing_key):
+        queue = self.queues.get(routing_key) or self.queues[OTHER]
+        task = self.tasks.get(task_name)
+        if task is None:
+            if len(self.tasks) < MAX_TASK_NAMES:
+                task = self.tasks.setdefault(task_name, Series(self.buckets))
+            else:
+                task = self.tasks.setdefault(OTHER, Series(self.buckets))
+        return queue, task
+
+    def _record(self, task_name, routing_key, counter, value=None):
+        """
+        Record an observation of a histogram ('wait' or 'runtime') or an
+        increment of a counter, sending it to the listening process (if
+        any) from other processes
+        """
+        if self._queue is not None and os.getpid() != self._listener_pid:
+            try:
+                self._queue.put_nowait(
+                    (task_name, routing_key, counter, value))
+            except Full:
+                self.dropped += 1
+            return
+        self._apply(task_name, routing_key, counter, value)
+
+    def _apply(self, task_name, routing_key, counter, value):
+        for series in self._series(task_name, routing_key):
+            if value is None:
+                series.incr(counter)
+            else:
+                getattr(series, counter).observe(value)
+
+    def listen(self):
+        """
+        Aggregate the observations of processes forked afterwards (e.g.
+        Celery's prefork pool) in this process, where a listener thread
+        reads them from a multiprocessing queue. Observations are dropped
+        while the queue is full, as are those not yet sent by a process
+        when it exits. Returns the listener thread.
+        """
+        if self._listener is None:
+            self._queue = multiprocessing.Queue(self.queue_size)
+            self._listener_pid = os.getpid()
+            self._listener = threading.Thread(
+                target=self._listen, args=(self._queue,),
+                name='task-metrics-listener')
+            self._listener.daemon = True
+            self._listener.start()
+        return self._listener
+
+    def _listen(self, queue):
+        while True:
+            observation = queue.get()
+            if observation is None:
+                return
+            self._apply(*observation)
+
+    def stop(self):
+        """ Stop the listener thread, once it applied sent observations """
+        listener, queue = self._listener, self._queue
+        if listener is None:
+            return
+        self._queue = self._listener = None
+        queue.put(None)
+        listener.join()
+
+    @staticmethod
+    def _routing_key(task):
+        delivery_info = getattr(task.request, 'delivery_info', None) or {}
+        return delivery_info.get('routing_key')
+
+    def on_worker_init(self, **kwargs):
+        self.listen()
+
+    def on_before_task_publish(self, sender=None, routing_key=None,
+                               headers=None, **kwargs):
+        if headers is not None:
+            headers[PUBLISH_HEADER] = time.time()
+        self._record(sender, routing_key, 'published')
+
+    def on_task_prerun(self, task_id=None, task=None, **kwargs):
+        now = self._started[task_id] = time.time()
+        published_at = getattr(task.request, PUBLISH_HEADER, None)
+        if published_at is None:
+            return
+        self._record(
+            task.name, self._routing_key(task), 'wait',
+            max(now - published_at, 0))
+
+    def on_task_postrun(self, task_id=None, task=None, state=None, **kwargs):
+        started = self._started.pop(task_id, None)
+        routing_key = self._routing_key(task)
+        if started is not None:
+            self._record(
+                task.name, routing_key, 'runtime', time.time() - started)
+        if state == 'SUCCESS':
+            self._record(task.name, routing_key, 'succeeded')
+
+    def on_task_retry(self, sender=None, request=None, **kwargs):
+        routing_key = (getattr(request, 'delivery_info', None) or {}).get(
+            'routing_key')
+        self._record(sender.name, routing_key, 'retried')
+
+    def on_task_failure(self, sender=None, **kwargs):
+        self._record(sender.name, self._routing_key(sender), 'failed')
+
+    def snapshot(self):
+        """ Return current metrics as a dict of plain Python types """
+        return {
+            'queue': {k: v.snapshot() for k, v in list(self.queues.items())},
+            'task': {k: v.snapshot() for k, v in list(self.tasks.items())},
+        }
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def prometheus_text(snapshot, prefix='cadasta_task'):
+    """ Render a TaskMetrics snapshot in the Prometheus text format """
+    lines = []
+    for histogram in ('wait', 'runtime'):
+        metric = '{}_{}_seconds'.format(prefix, histogram)
+        lines.append('# TYPE {} histogram'.format(metric))
+        for kind, series in sorted(snapshot.items()):
+            for name, values in sorted(series.items()):
+                labels = '{}="{}"'.format(kind, name)
+                hist = values[histogram]
+                for bound, count in hist['buckets']:
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        metric, labels, _format_bound(bound), count))
+                lines.append('{}_sum{{{}}} {!r}'.format(
+                    metric, labels, hist['sum']))
+                lines.append('{}_count{{{}}} {}'.format(
+                    metric, labels, hist['count']))
+    for counter in Series.COUNTERS:
+        metric = '{}_{}_total'.format(prefix, counter)
+        lines.append('# TYPE {} counter'.format(metric))
+        for kind, series in sorted(snapshot.items()):
+            for name, values in sorted(series.items()):
+                lines.append('{}{{{}="{}"}} {}'.format(
+                    metric, kind, name, values[counter]))
+    return '\n'.join(lines) + '\n'
+
+
+def statsd_lines(snapshot, prefix='cadasta.tasks'):
+    """
+    Render a TaskMetrics snapshot as statsd gauges: counters, plus count
+    and p50/p95/p99 (in milliseconds) of each histogram.
+    """
+    lines = []
+    for kind, series in sorted(snapshot.items()):
+        for name, values in sorted(series.items()):
+            path = '{}.{}.{}'.format(prefix, kind, name.replace('.', '_'))
+            for counter in Series.COUNTERS:
+                lines.append('{}.{}:{}|g'.format(
+                    path, counter, values[counter]))
+            for histogram in ('wait', 'runtime'):
+                hist = values[histogram]
+                lines.append('{}.{}.count:{}|g'.format(
+                    path, histogram, hist['count']))
+                for q in ('p50', 'p95', 'p99'):
+                    if hist[q] is not None:
+                        lines.append('{}.{}.{}:{:g}|g'.format(
+                            path, histogram, q, hist[q] * 1000))
+    return lines
+
+
+class StatsdExporter(object):
+    """ Sends TaskMetrics snapshots to a statsd server over UDP """
+
+    MAX_DATAGRAM = 1432
+
+    def __init__(self, metrics, host='localhost', port=8125,
+                 prefix='cadasta.tasks'):
+        self.metrics = metrics
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def export(self):
+        """ Send the current snapshot, returning the number of datagrams """
+        datagram, sent = '', 0
+        for line in statsd_lines(self.metrics.snapshot(), self.prefix):
+            if datagram and len(datagram) + len(line) + 1 > self.MAX_DATAGRAM:
+                self._send(datagram)
+                datagram, sent = '', sent + 1
+            datagram = '{}\n{}'.format(datagram, line) if datagram else line
+        if datagram:
+            self._send(datagram)
+            sent += 1
+        return sent
+
+    def _send(self, datagram):
+        self._socket.sendto(datagram.encode('utf-8'), self.address)
+
+    def close(self):
+        self._socket.close()
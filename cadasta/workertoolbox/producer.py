@@ -0,0 +1,203 @@
+import logging
+import os
+import weakref
+from functools import partial
+
+from celery.backends.database import DatabaseBackend
+from celery.backends.database.session import SessionManager
+from kombu import pools
+from kombu.utils.compat import register_after_fork
+from sqlalchemy.pool import QueuePool
+
+from .backends import BufferedDatabaseBackend
+from .setup import setup_app
+
+logger = logging.getLogger(__name__)
+
+
+def _after_fork_reset_pools(producer_pools):
+    producer_pools.reset()
+
+
+def _register_after_fork(obj, func):
+    """
+    Call func(obj) in the children of this process. On Python 3.7+ this
+    covers every os.fork (e.g. of a gunicorn or uWSGI master), otherwise
+    only processes started by multiprocessing.
+    """
+    register_at_fork = getattr(os, 'register_at_fork', None)
+    if register_at_fork is None:
+        register_after_fork(obj, func)
+        return
+    ref = weakref.ref(obj)
+
+    def after_in_child():
+        obj = ref()
+        if obj is not None:
+            func(obj)
+    register_at_fork(after_in_child=after_in_child)
+
+
+def _resource_stats(resource):
+    """ Utilisation of a kombu connection or producer pool """
+    in_use = len(resource._dirty)
+    return {
+        'limit': resource.limit,
+        'in_use': in_use,
+        'utilisation': float(in_use) / resource.limit if resource.limit else 0,
+    }
+
+
+def _engine_pool_stats(pool):
+    """
+    Utilisation of a SQLAlchemy QueuePool, None for other pools. The
+    utilisation of an unbounded QueuePool (of size 0) is None.
+    """
+    if not isinstance(pool, QueuePool):
+        return None
+    size, in_use = pool.size(), pool.checkedout()
+    return {
+        'size': size,
+        'idle': pool.checkedin(),
+        'in_use': in_use,
+        'overflow': max(pool.overflow(), 0),
+        'max_overflow': pool._max_overflow,
+        'utilisation': float(in_use) / size if size > 0 else None,
+    }
+
+
+class ProducerPools(object):
+    """
+    Bounded broker connection, producer and result database connection
+    pools of an app run only as a task producer (e.g. by a web process).
+    Broker pools hold up to 'broker_pool_limit' connections (and as many
+    producers). Results of a database backend are read through a QueuePool
+    of RESULT_DB_POOL_SIZE connections, plus up to RESULT_DB_MAX_OVERFLOW
+    more, rather than through a new connection per query, as Celery does
+    outside of its workers. The pools are dropped in forked children,
+    which open their own connections when first used (or warmed), rather
+    than sharing their parent's.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.warmed = 0
+        self._pool_backend()
+        _register_after_fork(self, _after_fork_reset_pools)
+
+    def _pool_backend(self):
+        backend = self.app.backend
+        self.sessions = None
+        if isinstance(backend, BufferedDatabaseBackend):
+            return  # Already pools its connections
+        if not isinstance(backend, DatabaseBackend):
+            return
+        conf = self.app.conf
+        options = backend.engine_options
+        options.setdefault('poolclass', QueuePool)
+        options.setdefault('pool_size', conf.RESULT_DB_POOL_SIZE)
+        options.setdefault('max_overflow', conf.RESULT_DB_MAX_OVERFLOW)
+        if backend.url.startswith('sqlite'):
+            # Pooled connections are shared by the process's threads
+            options.setdefault('connect_args', {'check_same_thread': False})
+        self._bind_sessions(backend)
+
+    def _bind_sessions(self, backend):
+        # Celery only caches (and so pools) the engines of forked workers
+        self.sessions = SessionManager()
+        self.sessions.forked = True
+        backend.ResultSession = partial(
+            type(backend).ResultSession, backend,
+            session_manager=self.sessions)
+
+    @property
+    def engine(self):
+        """ Engine of the result database, if results are stored in one """
+        backend = self.app.backend
+        if isinstance(backend, BufferedDatabaseBackend):
+            return backend.engine
+        if self.sessions is None:
+            return None
+        return self.sessions.get_engine(backend.url, **backend.engine_options)
+
+    def warm(self, connections=None):
+        """
+        Open 'connections' (default: PRODUCER_WARM_CONNECTIONS) broker and
+        result database connections, returning them to their pools, so that
+        the first tasks published don't wait for them. Returns the number
+        of connections warmed.
+        """
+        if connections is None:
+            connections = self.app.conf.PRODUCER_WARM_CONNECTIONS
+        producer_pool = self.app.producer_pool
+        connections = min(connections, producer_pool.limit or connections)
+        producers = []
+        try:
+            for _ in range(connections):
+                producer = producer_pool.acquire(block=True)
+                producers.append(producer)
+                producer.connection.ensure_connection()
+        finally:
+            for producer in producers:
+                producer.release()
+
+        engine = self.engine
+        if engine is not None:
+            if self.sessions is not None:
+                self.sessions.prepare_models(engine)
+            db_connections = []
+            try:
+                for _ in range(min(connections, engine.pool.size())):
+                    db_connections.append(engine.connect())
+            finally:
+                for conn in db_connections:
+                    conn.close()
+        self.warmed = connections
+        logger.info("Warmed %d producer connection(s)", connections)
+        return connections
+
+    def stats(self):
+        """ Utilisation of the broker and result database pools """
+        stats = {
+            'pid': self.pid,
+            'warmed': self.warmed,
+            'broker': _resource_stats(self.app.pool),
+            'producers': _resource_stats(self.app.producer_pool),
+            'result_backend': None,
+        }
+        engine = self.engine
+        if engine is not None:
+            stats['result_backend'] = _engine_pool_stats(engine.pool)
+        return stats
+
+    def reset(self):
+        """
+        Drop the pools inherited from a parent process, without closing
+        connections the parent still uses.
+        """
+        pools.connections.clear()
+        pools.producers.clear()
+        self.app._after_fork()  # Drops the app's pools, sends on_after_fork
+        backend = self.app.backend
+        if isinstance(backend, BufferedDatabaseBackend):
+            backend._reset()
+        elif self.sessions is not None:
+            self._bind_sessions(backend)
+        self.pid = os.getpid()
+        self.warmed = 0
+
+
+def setup_producer(app, warm=True):
+    """
+    Set up an app run only as a task producer (e.g. by the platform's web
+    processes): run setup_app(app) and manage its connections with bounded,
+    fork-safe ProducerPools, warmed unless 'warm' is False. The pools are
+    returned and kept as 'app.producer_pools'.
+    """
+    setup_app(app)
+    producer_pools = ProducerPools(app)
+    if warm:
+        producer_pools.warm()
+    app.producer_pools = producer_pools
+    return producer_pools
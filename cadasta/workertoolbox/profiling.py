@@ -0,0 +1,201 @@
+import logging
+import os
+import random
+import re
+import signal
+import tempfile
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Timers of the stack sampler, selected with PROFILE_CLOCK: CPU time spent
+# by the process, or wall-clock time (also sampling tasks waiting on I/O)
+CLOCKS = {
+    'cpu': ('ITIMER_PROF', 'SIGPROF'),
+    'wall': ('ITIMER_REAL', 'SIGALRM'),
+}
+# Frames beyond this depth are left out of sampled stacks
+MAX_STACK_DEPTH = 128
+PROFILE_SUFFIX = '.collapsed'
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'cadasta-profiles')
+UNSAFE_CHARS = re.compile(r'[^\w.-]')
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(code.co_filename, code.co_name)
+
+
+class StackSampler(object):
+    """
+    Statistical profiler counting the stacks of the main thread, sampled
+    every 'interval' seconds of the selected 'clock' by a signal handler,
+    so that nothing is traced between samples. As signal handlers may only
+    be installed from the main thread, start() returns False elsewhere (as
+    on platforms without interval timers).
+    """
+
+    def __init__(self, interval=0.01, clock='cpu'):
+        self.interval = interval
+        self.timer, self.signal = CLOCKS[clock]
+        self.stacks = Counter()
+        self._previous_handler = None
+        self.running = False
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """ Start sampling, returning whether the sampler was started """
+        timer = getattr(signal, self.timer, None)
+        signum = getattr(signal, self.signal, None)
+        if timer is None or signum is None:
+            return False
+        try:
+            self._previous_handler = signal.signal(signum, self._sample)
+        except ValueError:  # Not the main thread
+            return False
+        # Restart system calls interrupted by samples (e.g. sleep or recv),
+        # as Python 3 does itself, rather than failing with EINTR
+        signal.siginterrupt(signum, False)
+        self.stacks.clear()
+        signal.setitimer(timer, self.interval, self.interval)
+        self.running = True
+        return True
+
+    def stop(self):
+        """ Stop sampling, returning the number of samples taken """
+        if self.running:
+            signal.setitimer(getattr(signal, self.timer), 0)
+            signal.signal(
+                getattr(signal, self.signal), self._previous_handler)
+            self.running = False
+        return sum(self.stacks.values())
+
+    def collapsed(self):
+        """ Sampled stacks in the collapsed format read by flamegraph.pl """
+        return ''.join(
+            '{} {}\n'.format(stack, count)
+            for stack, count in sorted(self.stacks.items()))
+
+
+class ProfileRing(object):
+    """
+    Directory of profiles holding up to 'max_files' files and 'max_bytes'
+    bytes, the oldest profiles being removed to make room for new ones.
+    Profiles are named after their task, the time they were written and
+    their task id. Several processes (e.g. of a prefork pool) may share a
+    directory, which defaults to a 'cadasta-profiles' directory of the
+    system's temporary directory.
+    """
+
+    def __init__(self, directory=None, max_files=100,
+                 max_bytes=10 * 1024 * 1024):
+        self.directory = directory or DEFAULT_DIRECTORY
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+
+    def write(self, task_name, task_id, content):
+        """ Atomically write a profile, returning its path """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # Created by another process
+                pass
+        name = '{}.{:.6f}.{}{}'.format(
+            UNSAFE_CHARS.sub('_', task_name), time.time(),
+            UNSAFE_CHARS.sub('_', task_id or ''), PROFILE_SUFFIX)
+        path = os.path.join(self.directory, name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+        self.prune()
+        return path
+
+    def profiles(self):
+        """ Paths and sizes of profiles, from oldest to newest """
+        profiles = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(PROFILE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:  # Removed by another process
+                continue
+            profiles.append((stat.st_mtime, path, stat.st_size))
+        return [(path, size) for _, path, size in sorted(profiles)]
+
+    def prune(self):
+        """ Remove the oldest profiles beyond the budget """
+        profiles = self.profiles()
+        total = sum(size for _, size in profiles)
+        removed = 0
+        for path, size in profiles:
+            if (len(profiles) - removed <= self.max_files and
+                    total <= self.max_bytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:  # Removed by another process
+                pass
+            removed += 1
+            total -= size
+        return removed
+
+
+class TaskProfiler(object):
+    """
+    Profiles a fraction ('sample_rate') of tasks, and any task running for
+    'slow_threshold' seconds or more, with a StackSampler, writing their
+    sampled stacks to a ProfileRing. With a 'slow_threshold', every task is
+    sampled, but only profiles of sampled or slow tasks are written. Only
+    tasks run in a process's main thread (as with the prefork and solo
+    pools) are profiled, one at a time.
+    """
+
+    def __init__(self, ring, sample_rate=0.0, slow_threshold=0,
+                 interval=0.01, clock='cpu'):
+        self.ring = ring
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.sampler = StackSampler(interval, clock)
+        self.written = 0
+        self._task_id = None
+        self._started = None
+        self._sampled = False
+
+    def on_task_prerun(self, task_id=None, task=None, **kwargs):
+        if self._task_id is not None:
+            return  # Already profiling a task
+        sampled = random.random() < self.sample_rate
+        if not (sampled or self.slow_threshold) or not self.sampler.start():
+            return
+        self._task_id, self._sampled = task_id, sampled
+        self._started = time.time()
+
+    def on_task_postrun(self, task_id=None, task=None, **kwargs):
+        if task_id is None or task_id != self._task_id:
+            return
+        runtime = time.time() - self._started
+        self._task_id = None
+        samples = self.sampler.stop()
+        slow = bool(self.slow_threshold) and runtime >= self.slow_threshold
+        if not (self._sampled or slow) or not samples:
+            return
+        try:
+            path = self.ring.write(
+                task.name, task_id, self.sampler.collapsed())
+        except (IOError, OSError):
+            logger.exception("Failed to write profile of task %s", task_id)
+            return
+        self.written += 1
+        logger.info(
+            "Profiled task %s[%s] (%.3fs, %d samples) to %s",
+            task.name, task_id, runtime, samples, path)
@@ -0,0 +1,117 @@
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from kombu.transport.SQS import AsyncMessage, Channel as SQSChannel
+from kombu.utils.json import dumps
+
+# Limits of the SQS SendMessageBatch action
+SQS_MAX_BATCH_SIZE = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+
+
+def _sqs_batch_entry(queue, message, entry_id):
+    """
+    Build a SendMessageBatch entry matching what kombu's SQS channel sends
+    for a single message.
+    """
+    entry = {
+        'Id': str(entry_id),
+        'MessageBody': AsyncMessage().encode(dumps(message)),
+    }
+    if queue.endswith('.fifo'):
+        properties = message['properties']
+        entry['MessageGroupId'] = properties.get('MessageGroupId', 'default')
+        entry['MessageDeduplicationId'] = properties.get(
+            'MessageDeduplicationId', str(uuid.uuid4()))
+    return entry
+
+
+class SQSBatcher(object):
+    """
+    Collects messages put on an SQS channel, sending them per queue with
+    SendMessageBatch in chunks of up to 'batch_size' messages.
+    """
+
+    def __init__(self, channel, batch_size=SQS_MAX_BATCH_SIZE):
+        self.channel = channel
+        self.batch_size = min(batch_size, SQS_MAX_BATCH_SIZE)
+        self._pending = OrderedDict()
+        self.requests = 0
+
+    def put(self, queue, message, **kwargs):
+        entries = self._pending.setdefault(queue, [])
+        entries.append(message)
+        if len(entries) >= self.batch_size:
+            self.flush(queue)
+
+    def flush(self, queue=None):
+        """ Send pending messages for the queue (or all queues) """
+        queues = list(self._pending) if queue is None else [queue]
+        for q in queues:
+            messages = self._pending.pop(q, [])
+            chunk, size = [], 0
+            for i, message in enumerate(messages):
+                entry = _sqs_batch_entry(q, message, i)
+                entry_size = len(entry['MessageBody'])
+                if chunk and size + entry_size > SQS_MAX_BATCH_BYTES:
+                    self._send(q, chunk, messages)
+                    chunk, size = [], 0
+                chunk.append(entry)
+                size += entry_size
+            if chunk:
+                self._send(q, chunk, messages)
+
+    def _send(self, queue, entries, messages):
+        channel = self.channel
+        response = channel.sqs.send_message_batch(
+            QueueUrl=channel._new_queue(queue), Entries=entries)
+        self.requests += 1
+        # Retry failed entries individually, raising on any further failure
+        for failed in response.get('Failed', []):
+            type(channel)._put(channel, queue, messages[int(failed['Id'])])
+
+
+@contextmanager
+def batched_sends(channel, batch_size=SQS_MAX_BATCH_SIZE):
+    """
+    Context manager within which messages published on an SQS channel are
+    sent with SendMessageBatch. Other transports are left untouched. Yields
+    the SQSBatcher in use, or None.
+    """
+    if not isinstance(channel, SQSChannel):
+        yield None
+        return
+    batcher = SQSBatcher(channel, batch_size)
+    channel._put = batcher.put
+    try:
+        yield batcher
+    finally:
+        del channel._put
+        batcher.flush()
+
+
+def publish_many(app, signatures, batch_size=SQS_MAX_BATCH_SIZE):
+    """
+    Publish many task signatures over a single producer. Signatures are
+    grouped by the routing key chosen by the app's task router and each
+    group is published in turn. On the SQS transport, messages are sent in
+    SendMessageBatch chunks of up to 'batch_size' messages. Returns the
+    AsyncResult of each signature, in the order provided.
+    """
+    signatures = list(signatures)
+    route = app.amqp.router.route
+    groups = OrderedDict()
+    for i, sig in enumerate(signatures):
+        options = route(dict(sig.options), sig.task, sig.args, sig.kwargs)
+        groups.setdefault(options.get('routing_key'), []).append(i)
+
+    results = [None] * len(signatures)
+    with app.producer_or_acquire() as producer:
+        with batched_sends(producer.channel, batch_size) as batcher:
+            for indexes in groups.values():
+                for i in indexes:
+                    results[i] = signatures[i].apply_async(producer=producer)
+                if batcher is not None:
+                    batcher.flush()
+    return results
@@ -0,0 +1,82 @@
+from celery import states
+from celery.backends.database import DatabaseBackend, session_cleanup
+from celery.backends.database.models import Task
+
+# Fewer than SQLite's default limit of 999 bound parameters per statement
+DEFAULT_CHUNK_SIZE = 500
+
+TASK_COLUMNS = (
+    Task.task_id, Task.status, Task.result, Task.traceback, Task.date_done)
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_task_meta(backend, task_ids, chunk_size=None):
+    """
+    Stream the (task_id, meta) of each of 'task_ids' from a result backend,
+    in the order provided. Database backends are queried for 'chunk_size'
+    ids at a time (defaulting to RESULT_FETCH_CHUNK_SIZE) with a single
+    'IN' query per chunk, over one session, rather than with a query per
+    id. Only one chunk of results is held in memory at a time. Tasks
+    without a stored result are reported as PENDING, as by
+    backend.get_task_meta. Other backends are queried one id at a time.
+    """
+    if not isinstance(backend, DatabaseBackend):
+        for task_id in task_ids:
+            yield task_id, backend.get_task_meta(task_id)
+        return
+
+    chunk_size = chunk_size or getattr(
+        backend.app.conf, 'RESULT_FETCH_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    # Buffered results not yet written take precedence, as they're newer
+    buffered = getattr(backend, 'buffered_meta', None)
+    session = backend.ResultSession()
+    with session_cleanup(session):
+        for chunk in _chunks(task_ids, chunk_size):
+            query = session.query(*TASK_COLUMNS).filter(
+                Task.task_id.in_(set(chunk)))
+            rows = {
+                row.task_id: {
+                    'task_id': row.task_id,
+                    'status': row.status,
+                    'result': row.result,
+                    'traceback': row.traceback,
+                    'date_done': row.date_done,
+                }
+                for row in query
+            }
+            if buffered is not None:
+                rows.update(buffered(chunk))
+            for task_id in chunk:
+                meta = rows.get(task_id)
+                if meta is None:
+                    meta = {
+                        'task_id': task_id,
+                        'status': states.PENDING,
+                        'result': None,
+                        'traceback': None,
+                        'date_done': None,
+                    }
+                # Copied, as an id may be repeated within a chunk
+                yield task_id, backend.meta_from_decoded(dict(meta))
+
+
+def iter_results(result_set, chunk_size=None):
+    """
+    Stream the (task_id, state, result) of each result of a GroupResult or
+    ResultSet, in order, fetched with iter_task_meta. A failed task's
+    result is its exception.
+    """
+    task_ids = (result.id for result in result_set.results)
+    for task_id, meta in iter_task_meta(
+            result_set.backend, task_ids, chunk_size):
+        yield task_id, meta['status'], meta['result']
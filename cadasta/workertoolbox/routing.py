@@ -0,0 +1,239 @@
+import re
+from collections import defaultdict
+
+from kombu.transport.virtual.exchange import TopicExchange
+
+WILDCARDS = ('*', '#')
+
+# States of a match, once past the words matched by a trie node: exactly at
+# the node, or having matched a '#' (any words, so far) or a '*' (any words,
+# the last of which was empty or not).
+AT, HASH, STAR, STAR_EMPTY = range(4)
+
+
+class _Node(object):
+    __slots__ = ('children', 'star', 'hash', 'queues')
+
+    def __init__(self):
+        self.children = {}
+        self.star = self.hash = None
+        self.queues = set()
+
+
+def _step(states, word):
+    """ States of a match of the next 'word' of a routing key """
+    stepped = set()
+    for node, state in states:
+        if state != STAR_EMPTY:
+            child = node.children.get(word)
+            if child is not None:
+                stepped.add((child, AT))
+            if node.star is not None:
+                stepped.add((node.star, STAR if word else STAR_EMPTY))
+            if node.hash is not None:
+                stepped.add((node.hash, HASH))
+        if state == HASH:
+            stepped.add((node, HASH))
+        elif state in (STAR, STAR_EMPTY):
+            stepped.add((node, STAR if word else STAR_EMPTY))
+    return frozenset(stepped)
+
+
+class TopicTrie(object):
+    """
+    Binding patterns of a topic exchange, compiled into a trie of their
+    words. Patterns are matched as kombu's virtual transports (e.g. SQS)
+    match them: a '#' word matches one or more words, which may be empty,
+    and a '*' word matches one or more words, the last of which isn't
+    empty. The (rare) patterns with words mixing wildcards with other
+    characters are matched with kombu's regular expressions.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.expressions = []
+
+    def add(self, pattern, queue):
+        words = pattern.split('.')
+        if any(w != c and c in w for w in words for c in WILDCARDS):
+            regex = TopicExchange(None).key_to_pattern(pattern)
+            try:
+                self.expressions.append((re.compile(regex, re.U), queue))
+            except re.error:
+                raise ValueError("Invalid binding pattern %r" % pattern)
+            return
+        node = self.root
+        for word in words:
+            if word == '*':
+                node.star = node = node.star or _Node()
+            elif word == '#':
+                node.hash = node = node.hash or _Node()
+            else:
+                node = node.children.setdefault(word, _Node())
+        node.queues.add(queue)
+
+    def _matched(self, states, routing_key):
+        queues = set()
+        for node, state in states:
+            if state != STAR_EMPTY:
+                queues |= node.queues
+        for regex, queue in self.expressions:
+            if regex.match(routing_key):
+                queues.add(queue)
+        return frozenset(queues)
+
+    def match(self, routing_key):
+        """ Queues bound with patterns matching 'routing_key' """
+        states = frozenset([(self.root, AT)])
+        for word in routing_key.split('.'):
+            states = _step(states, word)
+        return self._matched(states, routing_key)
+
+    def match_many(self, routing_keys):
+        """
+        Queues bound with patterns matching each of 'routing_keys', by
+        routing key. Keys are matched in order, in a single pass, with
+        the trie walked only once for the words of a prefix they share.
+        """
+        matched = {}
+        path = []
+        stack = [frozenset([(self.root, AT)])]
+        for routing_key in sorted(set(routing_keys)):
+            words = routing_key.split('.')
+            shared = 0
+            for shared, (word, prev) in enumerate(zip(words, path)):
+                if word != prev:
+                    break
+            else:
+                shared = min(len(words), len(path))
+            del stack[shared + 1:]
+            for word in words[shared:]:
+                stack.append(_step(stack[-1], word))
+            path = words
+            matched[routing_key] = self._matched(stack[-1], routing_key)
+        return matched
+
+
+class _DirectTable(object):
+
+    def __init__(self):
+        self.queues = defaultdict(set)
+
+    def add(self, routing_key, queue):
+        self.queues[routing_key].add(queue)
+
+    def match(self, routing_key):
+        return frozenset(self.queues.get(routing_key, ()))
+
+    def match_many(self, routing_keys):
+        return {key: self.match(key) for key in routing_keys}
+
+
+class _FanoutTable(_DirectTable):
+
+    def match(self, routing_key):
+        return frozenset(q for queues in self.queues.values() for q in queues)
+
+
+TABLE_TYPES = {
+    'topic': TopicTrie,
+    'direct': _DirectTable,
+    'fanout': _FanoutTable,
+}
+
+
+class RoutingTable(object):
+    """
+    Destination queues of messages, by exchange and routing key, as bound
+    by a set of kombu Queues (e.g. Config.task_queues), compiled so that
+    batches of routing keys or task names are resolved without declaring
+    anything on a broker or matching keys against each binding in turn.
+    Messages published to the broker's default exchange ('') are routed to
+    the queue named by their routing key. Keys matching no binding resolve
+    to an empty set, as kombu would consider them undeliverable.
+
+    route: Optional function returning the publishing options of a task
+        name (as Celery's router does), used to resolve task names.
+    """
+
+    def __init__(self, queues=(), route=None):
+        self.exchanges = {}
+        self.route = route
+        for queue in queues:
+            self.add_queue(queue)
+
+    @classmethod
+    def from_config(cls, conf):
+        """ Table of Config.task_queues, resolving names as it routes them """
+        def route(name):
+            return conf.task_routes(name, (), {}, {})
+        return cls(conf.task_queues, route)
+
+    @classmethod
+    def from_app(cls, app):
+        """ Table of an app's queues, resolving names with its router """
+        router = app.amqp.router
+
+        def route(name):
+            return router.route({}, name)
+        return cls(app.amqp.queues.values(), route)
+
+    def bind(self, exchange, routing_key, queue, exchange_type='topic'):
+        if exchange not in self.exchanges:
+            try:
+                self.exchanges[exchange] = TABLE_TYPES[exchange_type]()
+            except KeyError:
+                raise ValueError(
+                    "Unsupported type %r of exchange %r, expected one of %r"
+                    % (exchange_type, exchange, sorted(TABLE_TYPES)))
+        self.exchanges[exchange].add(routing_key, queue)
+
+    def add_queue(self, queue):
+        """ Add the bindings a queue is declared with """
+        exchange = queue.exchange
+        if exchange is not None and exchange.name:
+            self.bind(exchange.name, queue.routing_key, queue.name,
+                      exchange.type)
+        for binding in queue.bindings:
+            self.bind(binding.exchange.name, binding.routing_key, queue.name,
+                      binding.exchange.type)
+
+    def lookup(self, exchange, routing_key):
+        """ Queues receiving messages published with 'routing_key' """
+        return self.lookup_many(exchange, [routing_key])[routing_key]
+
+    def lookup_many(self, exchange, routing_keys):
+        """ Queues receiving messages published with each of 'routing_keys' """
+        if not exchange:
+            return {key: frozenset([key]) for key in routing_keys}
+        table = self.exchanges.get(exchange)
+        if table is None:
+            return {key: frozenset() for key in routing_keys}
+        return table.match_many(routing_keys)
+
+    def resolve(self, names):
+        """ Queues receiving the messages of each task of 'names' """
+        if self.route is None:
+            raise ValueError("Task names can't be resolved without a route")
+        destinations = {}
+        keys = defaultdict(set)
+        for name in names:
+            options = self.route(name)
+            exchange = options.get('exchange')
+            queue = options.get('queue')
+            if exchange is None and queue is not None:
+                exchange = getattr(queue, 'exchange', None)
+            exchange = getattr(exchange, 'name', exchange) or ''
+            routing_key = options.get('routing_key')
+            if routing_key is None:
+                routing_key = getattr(queue, 'routing_key', queue)
+            destinations[name] = (exchange, routing_key)
+            keys[exchange].add(routing_key)
+        matched = {
+            exchange: self.lookup_many(exchange, routing_keys)
+            for exchange, routing_keys in keys.items()
+        }
+        return {
+            name: matched[exchange][routing_key]
+            for name, (exchange, routing_key) in destinations.items()
+        }
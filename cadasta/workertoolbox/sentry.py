@@ -0,0 +1,112 @@
+import atexit
+import os
+import threading
+import time
+import traceback
+
+from kombu.five import Full, Queue
+from raven import Client
+from raven.transport.http import HTTPTransport
+
+from .utils import LRUCache
+
+
+class RateLimitedClient(Client):
+    """
+    Sentry client reporting events from a background thread, so that
+    capturing an event doesn't wait on the Sentry server.
+
+    Events are identified by a fingerprint of the task name, exception type
+    and location (or logger name and message template). At most
+    'rate_limit' events per fingerprint are reported every 'rate_period'
+    seconds. Events are held in a queue of up to 'queue_size' events while
+    awaiting sending. Events dropped by either limit are counted in
+    'dropped'.
+    """
+
+    def __init__(self, dsn=None, queue_size=100, rate_limit=10,
+                 rate_period=60, max_fingerprints=1000, **kwargs):
+        # Events are already sent from a background thread
+        kwargs.setdefault('transport', HTTPTransport)
+        super(RateLimitedClient, self).__init__(dsn, **kwargs)
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.dropped = {'rate_limited': 0, 'queue_full': 0}
+        self._windows = LRUCache(max_fingerprints)
+        self._queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def fingerprint(self, event_type, data=None, extra=None, **kwargs):
+        task = (extra or {}).get('task') or self.transaction.peek()
+        exc_info = kwargs.get('exc_info')
+        if exc_info and exc_info[0] is not None:
+            frames = traceback.extract_tb(exc_info[2])
+            location = tuple(frames[-1][:2]) if frames else None
+            return (getattr(task, 'name', task), exc_info[0].__name__,
+                    location)
+        return (getattr(task, 'name', task), (data or {}).get('logger'),
+                kwargs.get('message'))
+
+    def is_rate_limited(self, fingerprint):
+        now = time.time()
+        with self._lock:
+            window = self._windows.get(fingerprint)
+            if window is None or now - window[0] >= self.rate_period:
+                window = self._windows[fingerprint] = [now, 0]
+            window[1] += 1
+            return window[1] > self.rate_limit
+
+    def capture(self, event_type, data=None, date=None, time_spent=None,
+                extra=None, stack=None, tags=None, sample_rate=None,
+                **kwargs):
+        fingerprint = self.fingerprint(event_type, data, extra, **kwargs)
+        if self.is_rate_limited(fingerprint):
+            self.dropped['rate_limited'] += 1
+            return None
+        return super(RateLimitedClient, self).capture(
+            event_type, data, date, time_spent, extra, stack, tags,
+            sample_rate, **kwargs)
+
+    def send(self, auth_header=None, **data):
+        """ Queue an event to be encoded and sent by the sender thread """
+        try:
+            self._queue.put_nowait((auth_header, data))
+        except Full:
+            self.dropped['queue_full'] += 1
+            return
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        with self._lock:
+            thread = self._thread
+            if self._pid == os.getpid() and thread and thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._send_queued, name='RateLimitedClient')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _send_queued(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            auth_header, data = item
+            try:
+                super(RateLimitedClient, self).send(auth_header, **data)
+            except Exception:
+                self.error_logger.exception('Failed to send event to Sentry')
+
+    def close(self, timeout=10):
+        """ Send any queued events and stop the sender thread """
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._thread = None
+        self._queue.put(None)
+        thread.join(timeout)
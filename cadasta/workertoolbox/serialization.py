@@ -0,0 +1,140 @@
+import datetime
+import hashlib
+import json
+import uuid
+import zlib
+
+from kombu.serialization import register
+from kombu.utils.json import JSONEncoder, dumps, loads
+
+FAST_SERIALIZER = 'cadasta-json'
+OFFLOAD_SERIALIZER = 'cadasta-offload'
+OFFLOAD_CONTENT_TYPE = 'application/x-cadasta-offload'
+
+# Leading byte of an encoded payload, identifying how to decode the rest
+RAW = b'J'
+COMPRESSED = b'Z'
+POINTER = b'P'
+
+# kombu's SQS transport base64 encodes the payload within the message's
+# JSON envelope, then the envelope itself, so a payload grows by 16/9 on
+# its way to SQS. Payloads of up to 136 KB become at most 181.4 KB of the
+# envelope, leaving 10.6 KB for its headers and properties within the
+# 192 KB that encode to SQS's 256 KB limit.
+SQS_MAX_SIZE = 256 * 1024
+DEFAULT_MAX_SIZE = 136 * 1024
+
+
+_kombu_default = JSONEncoder().default
+
+
+def _default(obj, datetime=datetime.datetime, UUID=uuid.UUID):
+    """
+    Encode types json can't as kombu does, with fast paths for the most
+    common: datetimes (as ISO 8601 strings) and UUIDs (as strings).
+    """
+    cls = type(obj)
+    if cls is datetime:
+        value = obj.isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    if cls is UUID:
+        return str(obj)
+    return _kombu_default(obj)
+
+
+_encode = json.JSONEncoder(separators=(',', ':'), default=_default).encode
+
+
+def fast_dumps(obj):
+    """
+    Serialize to compact JSON with a single, reused encoder, rather than
+    kombu's json.dumps building an encoder per call.
+    """
+    return _encode(obj)
+
+
+def json_codec():
+    """
+    Return the 'dumps' and 'loads' functions of the fastest available JSON
+    implementation: orjson (3.3 or later, if installed), or else the
+    standard library's encoder and kombu's 'loads', which the standard
+    library's decoder can't outpace. Either encodes datetimes as kombu does.
+    """
+    try:
+        import orjson
+    except ImportError:
+        return fast_dumps, loads
+    # Datetimes are passed to _default, rather than ending in '+00:00'
+    option = getattr(orjson, 'OPT_PASSTHROUGH_DATETIME', None)
+    if option is None:
+        return fast_dumps, loads
+
+    def orjson_dumps(obj):
+        return orjson.dumps(obj, default=_default, option=option)
+
+    return orjson_dumps, orjson.loads
+
+
+def register_fast_serializer(name=FAST_SERIALIZER):
+    """
+    Register the fastest available JSON codec with kombu's serialization
+    registry. Messages remain plain JSON, so the codec also becomes the
+    decoder of all 'application/json' messages.
+    """
+    encoder, decoder = json_codec()
+    register(name, encoder, decoder, content_type='application/json',
+             content_encoding='utf-8')
+
+
+class OffloadingCodec(object):
+    """
+    Serializer keeping messages small enough for the broker (e.g. SQS's
+    256 KB limit, once encoded twice). Payloads are serialized with 'dumps',
+    then compressed with zlib if over 'compress_threshold' bytes. Payloads
+    still over 'max_size' bytes are written to 'blob_store', keyed by their
+    digest, and replaced by a pointer, which is only fetched once the
+    message is decoded by a consumer. Blobs aren't deleted on decoding, as
+    a message may be redelivered and identical payloads share a blob, so
+    are purged once expired (see PayloadPurge).
+    """
+
+    def __init__(self, blob_store, compress_threshold=16 * 1024,
+                 max_size=DEFAULT_MAX_SIZE, level=6, dumps=dumps, loads=loads):
+        self.blob_store = blob_store
+        self.compress_threshold = compress_threshold
+        self.max_size = max_size
+        self.level = level
+        self.dumps = dumps
+        self.loads = loads
+
+    def encode(self, obj):
+        data = self.dumps(obj)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if len(data) <= self.compress_threshold:
+            return RAW + data
+        data = COMPRESSED + zlib.compress(data, self.level)
+        if len(data) <= self.max_size:
+            return data
+        key = 'payload-' + hashlib.sha1(data).hexdigest()
+        self.blob_store.put(key, data)
+        return POINTER + key.encode('utf-8')
+
+    def decode(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        kind, data = data[:1], data[1:]
+        if kind == POINTER:
+            data = self.blob_store.get(data.decode('utf-8'))
+            kind, data = data[:1], data[1:]
+        if kind == COMPRESSED:
+            data = zlib.decompress(data)
+        elif kind != RAW:
+            raise ValueError("Unknown payload type %r" % kind)
+        return self.loads(data.decode('utf-8'))
+
+    def register(self, name=OFFLOAD_SERIALIZER,
+                 content_type=OFFLOAD_CONTENT_TYPE):
+        """ Register codec with kombu's serialization registry """
+        register(name, self.encode, self.decode, content_type=content_type,
+                 content_encoding='binary')
@@ -1,7 +1,117 @@
+import hashlib
+import json
 import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from kombu.transport import virtual
+
 logger = logging.getLogger(__name__)
 
 
+class DeclarationCache(object):
+    """
+    Record of queues known to be declared on the broker, stored as a JSON
+    file mapping a key derived from each queue's name, exchange and routing
+    key (plus a 'namespace', e.g. the transport and its options) to the time
+    it was declared. Entries older than 'ttl' seconds are ignored.
+    """
+
+    def __init__(self, path, ttl, namespace=''):
+        self.path = path
+        self.ttl = ttl
+        self.namespace = namespace
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def key(self, queue):
+        ident = json.dumps([
+            self.namespace, queue.name, queue.exchange.name,
+            queue.exchange.type, queue.routing_key,
+        ])
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def is_declared(self, queue):
+        declared_at = self.entries.get(self.key(queue))
+        return declared_at is not None and time.time() - declared_at < self.ttl
+
+    def mark_declared(self, queue):
+        self.entries[self.key(queue)] = time.time()
+
+    def save(self):
+        """ Atomically write cache, dropping expired entries """
+        now = time.time()
+        entries = {
+            k: v for k, v in self.entries.items() if now - v < self.ttl}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp_path, self.path)
+
+
+def _bind_queue(queue, channel):
+    """
+    Declare a queue's exchange and bindings, without declaring the queue
+    itself. Mirrors kombu.Queue.declare.
+    """
+    queue._create_exchange(channel=channel)
+    if queue.exchange and queue.exchange.name:
+        queue.queue_bind(channel=channel)
+    queue._create_bindings(channel=channel)
+
+
+def declare_queues(channel, queues, cache=None, concurrency=1):
+    """
+    Declare queues and their bindings on the provided channel. Queues that
+    the optional DeclarationCache reports as declared are only bound. On
+    virtual transports (e.g. SQS) the remaining queue declarations are
+    issued concurrently from a pool of 'concurrency' threads.
+    """
+    # Skip queues already declared by this connection (as maybe_declare does)
+    declared = channel.connection.client.declared_entities
+    queues = [
+        q for q in queues if not (q.no_declare or hash(q) in declared)]
+    pending = [q for q in queues if cache is None or not cache.is_declared(q)]
+
+    def declare(queue):
+        queue.queue_declare(channel=channel)
+
+    if concurrency > 1 and len(pending) > 1 and isinstance(
+            channel, virtual.Channel):
+        pool = ThreadPool(min(concurrency, len(pending)))
+        try:
+            pool.map(declare, pending)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for queue in pending:
+            declare(queue)
+
+    for queue in queues:
+        _bind_queue(queue, channel)
+        if queue.can_cache_declaration:
+            declared.add(hash(queue))
+
+    if cache is not None:
+        for queue in pending:
+            cache.mark_declared(queue)
+        cache.save()
+    logger.info(
+        "Declared %d queue(s), %d skipped as cached",
+        len(pending), len(queues) - len(pending))
+
+
 def limit_chord_unlock_tasks(app):
     """
     Set max_retries for chord.unlock tasks to avoid infinitely looping
@@ -13,19 +123,125 @@ def limit_chord_unlock_tasks(app):
         task.max_retries = retries
 
 
+def chord_unlock_countdown(retries, base, factor, ceiling):
+    """ Delay before the provided chord_unlock retry, in seconds """
+    return min(base * factor ** retries, ceiling)
+
+
+def chord_unlock_retries(duration, base, factor, ceiling):
+    """ Number of chord_unlock retries whose delays span 'duration' """
+    retries = elapsed = 0
+    while elapsed < duration:
+        elapsed += chord_unlock_countdown(retries, base, factor, ceiling)
+        retries += 1
+    return retries
+
+
+def backoff_chord_unlock_tasks(app):
+    """
+    With the 'backoff' CHORD_UNLOCK_STRATEGY, retry chord.unlock tasks with
+    exponentially increasing delays (of up to CHORD_UNLOCK_BACKOFF_MAX
+    seconds), rather than polling every second.
+    """
+    conf = app.conf
+    if getattr(conf, 'CHORD_UNLOCK_STRATEGY', 'poll') != 'backoff':
+        return
+    task = app.tasks['celery.chord_unlock']
+    retry = type(task).retry.__get__(task)
+
+    def retry_with_backoff(*args, **kwargs):
+        kwargs['countdown'] = chord_unlock_countdown(
+            task.request.retries, conf.CHORD_UNLOCK_BACKOFF_BASE,
+            conf.CHORD_UNLOCK_BACKOFF_FACTOR, conf.CHORD_UNLOCK_BACKOFF_MAX)
+        return retry(*args, **kwargs)
+
+    task.retry = retry_with_backoff
+
+
 def setup_exchanges(app):
     """
     Setup result exchange to route all tasks to platform queue.
     """
+    cache_file = getattr(app.conf, 'DECLARATION_CACHE_FILE', None)
+    concurrency = getattr(app.conf, 'DECLARATION_CONCURRENCY', 1)
     with app.producer_or_acquire() as P:
         # Ensure all queues are noticed and configured with their
         # appropriate exchange.
-        for q in app.amqp.queues.values():
-            P.maybe_declare(q)
+        if not cache_file and concurrency <= 1:
+            for q in app.amqp.queues.values():
+                P.maybe_declare(q)
+            return
+
+        cache = None
+        if cache_file:
+            cache = DeclarationCache(
+                cache_file,
+                ttl=getattr(app.conf, 'DECLARATION_CACHE_TTL', 60 * 60),
+                namespace=json.dumps([
+                    P.connection.transport_cls,
+                    app.conf.broker_transport_options,
+                ], sort_keys=True, default=str))
+        declare_queues(
+            P.channel, app.amqp.queues.values(), cache, concurrency)
+
+
+def schedule_result_purge(app):
+    """
+    With a RESULT_PURGE_INTERVAL, register a periodic task purging expired
+    results in batches, returning the task.
+    """
+    if not getattr(app.conf, 'RESULT_PURGE_INTERVAL', 0):
+        return None
+    # Imported here to keep SQLAlchemy's models out of other processes
+    from .maintenance import setup_result_maintenance
+    return setup_result_maintenance(app)
+
+
+def setup_queue_lanes(app):
+    """
+    Run a lane, with its own concurrency and prefetch count, for each of
+    QUEUE_LANES consumed by the worker.
+    """
+    if not getattr(app.conf, 'QUEUE_LANES', None):
+        return
+    # Imported here to keep worker bootsteps out of producers
+    from .lanes import LaneStep
+    app.steps['consumer'].add(LaneStep)
+
+
+def setup_task_heartbeat(app):
+    """
+    With a TASK_HEARTBEAT_INTERVAL, keep the messages and claims of active
+    tasks from expiring while they run.
+    """
+    if not getattr(app.conf, 'TASK_HEARTBEAT_INTERVAL', 0):
+        return
+    # Imported here to keep worker bootsteps out of producers
+    from .dedup import TaskHeartbeat
+    app.steps['consumer'].add(TaskHeartbeat)
+
+
+def setup_payload_purge(app):
+    """
+    With a PAYLOAD_STORE and PAYLOAD_TTL, purge expired offloaded payloads
+    from the store while the worker runs.
+    """
+    conf = app.conf
+    if not getattr(conf, 'PAYLOAD_STORE', '') or \
+            not getattr(conf, 'PAYLOAD_TTL', 0):
+        return
+    # Imported here to keep worker bootsteps out of producers
+    from .blobs import PayloadPurge
+    app.steps['worker'].add(PayloadPurge)
 
 
 SETUP_FUNCS = (
     limit_chord_unlock_tasks,
+    backoff_chord_unlock_tasks,
+    schedule_result_purge,
+    setup_queue_lanes,
+    setup_task_heartbeat,
+    setup_payload_purge,
     setup_exchanges,
 )
 
@@ -38,8 +254,11 @@ def setup_app(app, throw=True):
     a Python shell.
     """
     success = True
+    timings = OrderedDict()
     try:
         for func in SETUP_FUNCS:
+            name = getattr(func, '__name__', repr(func))
+            start = time.time()
             try:
                 func(app)
             except Exception:
@@ -49,5 +268,10 @@ def setup_app(app, throw=True):
                 else:
                     msg = "Failed to run setup function %r(app)"
                     logger.exception(msg, func.__name__)
+            finally:
+                timings[name] = time.time() - start
+                logger.debug(
+                    "Setup function %r(app) took %.3fs", name, timings[name])
     finally:
         setattr(app, 'is_set_up', success)
+        setattr(app, 'setup_timings', timings)
@@ -1,8 +1,109 @@
-from celery.signals import worker_init
-
-from .setup import setup_app
+from celery import current_app
+from celery.signals import worker_init, worker_process_shutdown, \
+    worker_shutdown, beat_init, before_task_publish, task_prerun, \
+    task_postrun, task_retry, task_failure, task_success
+from .setup import schedule_result_purge, setup_app
 
 
 @worker_init.connect
 def setup_app_signal_handler(sender, **kwargs):
     setup_app(sender.app, throw=False)
+
+
+@beat_init.connect
+def schedule_result_purge_signal_handler(sender, **kwargs):
+    """
+    Schedule the purge of expired results in beat processes, which don't
+    run setup_app, once their scheduler is set up
+    """
+    if schedule_result_purge(sender.app) is None:
+        return
+    from .maintenance import PURGE_SCHEDULE_ENTRY
+    schedule = sender.app.conf.beat_schedule
+    sender.scheduler.update_from_dict(
+        {PURGE_SCHEDULE_ENTRY: schedule[PURGE_SCHEDULE_ENTRY]})
+
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def close_result_backend_signal_handler(sender=None, **kwargs):
+    """
+    Flush results buffered by the result backend (if any) of the worker
+    shutting down or, in pool processes (sent without a worker), of the
+    current app.
+    """
+    app = getattr(sender, 'app', None) or current_app
+    close = getattr(app.backend, 'close', None)
+    if close is not None:
+        close()
+
+
+TASK_METRICS_SIGNALS = (
+    (worker_init, 'on_worker_init'),
+    (before_task_publish, 'on_before_task_publish'),
+    (task_prerun, 'on_task_prerun'),
+    (task_postrun, 'on_task_postrun'),
+    (task_retry, 'on_task_retry'),
+    (task_failure, 'on_task_failure'),
+)
+
+
+def connect_task_metrics(metrics):
+    """
+    Connect a TaskMetrics collector to the task signals, and to the
+    worker's initialisation to aggregate the metrics of its pool processes
+    """
+    for signal, handler in TASK_METRICS_SIGNALS:
+        signal.connect(
+            getattr(metrics, handler), weak=False,
+            dispatch_uid='cadasta.workertoolbox.metrics.' + handler)
+
+
+def disconnect_task_metrics():
+    """ Disconnect any TaskMetrics collector from the task signals """
+    for signal, handler in TASK_METRICS_SIGNALS:
+        signal.disconnect(
+            dispatch_uid='cadasta.workertoolbox.metrics.' + handler)
+
+
+TASK_PROFILER_SIGNALS = (
+    (task_prerun, 'on_task_prerun'),
+    (task_postrun, 'on_task_postrun'),
+)
+
+
+def connect_task_profiler(profiler):
+    """ Connect a TaskProfiler to the task signals """
+    for signal, handler in TASK_PROFILER_SIGNALS:
+        signal.connect(
+            getattr(profiler, handler), weak=False,
+            dispatch_uid='cadasta.workertoolbox.profiling.' + handler)
+
+
+def disconnect_task_profiler():
+    """ Disconnect any TaskProfiler from the task signals """
+    for signal, handler in TASK_PROFILER_SIGNALS:
+        signal.disconnect(
+            dispatch_uid='cadasta.workertoolbox.profiling.' + handler)
+
+
+FOLLOWUP_SIGNALS = (
+    (before_task_publish, 'on_before_task_publish'),
+    (task_success, 'on_task_success'),
+    (task_failure, 'on_task_failure'),
+)
+
+
+def connect_followups():
+    """ Apply followups passed by reference once they reach the last task """
+    from . import followups
+    for signal, handler in FOLLOWUP_SIGNALS:
+        signal.connect(
+            getattr(followups, handler), weak=False,
+            dispatch_uid='cadasta.workertoolbox.followups.' + handler)
+
+
+def disconnect_followups():
+    for signal, handler in FOLLOWUP_SIGNALS:
+        signal.disconnect(
+            dispatch_uid='cadasta.workertoolbox.followups.' + handler)
@@ -1,6 +1,56 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
 import unittest
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
 from mock import patch, MagicMock
 
+from celery import Celery, chord, group, states
+from celery import __version__ as celery_version
+from celery.app import trace
+from celery.backends.database import DatabaseBackend
+from celery.backends.database.session import ResultModelBase
+from celery.exceptions import TimeoutError
+from celery.five import reraise
+from celery.signals import before_task_publish
+from kombu import __version__ as kombu_version
+from sqlalchemy import create_engine
+
+from . import __version__
+from .autoscale import percentile
+from .results import iter_task_meta
+from .routing import RoutingTable
+from .utils import extract_followups
+
+WORKLOADS = ('fanout', 'chords', 'followups', 'mixed')
+
+
+@contextmanager
+def _tracing_tasks_of(app):
+    """
+    Point the worker optimizations of other apps' workers in this process
+    (e.g. of functional tests), which trace tasks from their registry, at
+    the registry of 'app', restoring them on exit. Celery only exposes them
+    as a private list, which tracing holds on to, so it's changed in place.
+    """
+    localized = list(trace._localized)
+    if not localized:
+        yield
+        return
+    trace._localized[0] = app._tasks
+    try:
+        yield
+    finally:
+        trace._localized[:] = localized
+
 
 def build_functional_tests(app, is_worker=True):
     """
@@ -20,6 +70,7 @@ def build_functional_tests(app, is_worker=True):
             if is_worker:
                 app.Worker()  # Init worker (sends signal)
             cls.channel = cls.app.connection().channel()
+            cls.routing_table = RoutingTable.from_app(app)
 
         def test_default_queue_name(self):
             """ Ensure default queue is correctly named """
@@ -37,51 +88,111 @@ def build_functional_tests(app, is_worker=True):
             exch_type = self.channel.typeof(def_exch).type
             self.assertEqual(exch_type, 'topic')
 
-        def test_default_exchange_routing(self):
-            """ Ensure default exchange routes tasks to multiple queues """
+        def lookup(self, routing_key):
+            """ Queues receiving messages published with 'routing_key' """
             exchange = self.app.conf.task_default_exchange
-            for q in self.app.conf.QUEUES:
-                queues = self.channel.typeof(exchange).lookup(
-                    table=self.channel.get_table(exchange),
-                    exchange=exchange, routing_key=q,
-                    default=self.app.conf.task_default_queue)
-                self.assertEqual(len(queues), 2)
-                self.assertTrue(q in queues)
-                self.assertTrue(self.app.conf.PLATFORM_QUEUE_NAME in queues)
+            return self.channel.typeof(exchange).lookup(
+                table=self.channel.get_table(exchange),
+                exchange=exchange, routing_key=routing_key,
+                default=self.app.conf.task_default_queue)
 
-        def test_celery_exchange_routing(self):
+        def is_mirrored(self, routing_key):
+            """ Whether PLATFORM_QUEUE_BINDINGS match 'routing_key' """
+            exchange = self.channel.typeof(
+                self.app.conf.task_default_exchange)
+            return any(
+                exchange._match(exchange.key_to_pattern(pattern), routing_key)
+                for pattern in self.app.conf.PLATFORM_QUEUE_BINDINGS)
+
+        def is_excluded(self, task_name):
+            """ Whether PLATFORM_EXCLUDED_TASKS match 'task_name' """
+            return any(
+                fnmatchcase(task_name, pattern)
+                for pattern in self.app.conf.PLATFORM_EXCLUDED_TASKS)
+
+        def assertRoutedTo(self, queues, routing_key):
             """
-            Ensure celery queue and platform queue are registered with default
-            exchange
+            Ensure messages with 'routing_key' reach 'queues', plus the
+            platform queue if its bindings match
             """
+            expected = set(queues)
+            if self.is_mirrored(routing_key):
+                expected.add(self.app.conf.PLATFORM_QUEUE_NAME)
+            self.assertEqual(set(self.lookup(routing_key)), expected)
+
+        def test_platform_queue_bindings(self):
+            """ Ensure platform queue is bound with PLATFORM_QUEUE_BINDINGS """
             exchange = self.app.conf.task_default_exchange
-            queues = self.channel.typeof(exchange).lookup(
-                table=self.channel.get_table(exchange),
-                exchange=exchange, routing_key='celery',
-                default=self.app.conf.task_default_queue)
+            bindings = set(
+                routing_key
+                for routing_key, _, queue in self.channel.get_table(exchange)
+                if queue == self.app.conf.PLATFORM_QUEUE_NAME)
+            self.assertEqual(
+                bindings, set(self.app.conf.PLATFORM_QUEUE_BINDINGS))
 
-            self.assertEqual(len(queues), 2)
-            self.assertTrue('celery' in queues)
-            self.assertTrue(self.app.conf.PLATFORM_QUEUE_NAME in queues)
+        def test_default_exchange_routing(self):
+            """
+            Ensure default exchange routes tasks to their queue and to the
+            platform queue, if bound
+            """
+            for q in self.app.conf.QUEUES:
+                self.assertRoutedTo([q], q)
+
+        def test_celery_exchange_routing(self):
+            """
+            Ensure celery queue and platform queue, if bound, are registered
+            with default exchange
+            """
+            self.assertRoutedTo(['celery'], 'celery')
 
         def test_celery_task_routing(self):
             """
-            Ensure celery tasks route to celery queue and platform queue
+            Ensure celery tasks route to celery queue and, unless excluded,
+            platform queue
             """
             options = self.app.amqp.router.route({}, 'celery.chord_unlock')
+            if self.is_excluded('celery.chord_unlock'):
+                self.assertEqual(options['queue'].name, 'celery')
+                self.assertEqual(options['exchange'], '')
+                return
             self.assertNotIn('queue', options)
             self.assertIn('exchange', options)
             self.assertIn('routing_key', options)
-            exchange = options['exchange'].name
-            routing_key = options['routing_key']
+            self.assertEqual(
+                options['exchange'].name,
+                self.app.conf.task_default_exchange)
+            self.assertRoutedTo(['celery'], options['routing_key'])
 
-            queues = self.channel.typeof(exchange).lookup(
-                table=self.channel.get_table(exchange),
-                exchange=exchange, routing_key=routing_key,
-                default=self.app.conf.task_default_queue)
-            self.assertEqual(len(queues), 2)
-            self.assertTrue('celery' in queues)
-            self.assertTrue(self.app.conf.PLATFORM_QUEUE_NAME in queues)
+        def test_platform_excluded_tasks(self):
+            """
+            Ensure tasks matching PLATFORM_EXCLUDED_TASKS are published
+            straight to their queue, bypassing the platform queue
+            """
+            queues = set(self.app.conf.QUEUES) | set(['celery'])
+            for name in self.app.tasks:
+                options = self.app.amqp.router.route({}, name)
+                routing_key = options['routing_key']
+                if self.is_excluded(name) and routing_key in queues:
+                    self.assertEqual(options['exchange'], '')
+                    self.assertEqual(options['queue'].name, routing_key)
+                else:
+                    self.assertEqual(
+                        options['exchange'].name,
+                        self.app.conf.task_default_exchange)
+
+        def test_routing_table(self):
+            """
+            Ensure the routing table compiled from the configured queues
+            resolves tasks to the queues the exchange routes them to
+            """
+            routes = self.routing_table.resolve(self.app.tasks)
+            for name, queues in routes.items():
+                options = self.app.amqp.router.route({}, name)
+                if options['exchange'] == '':
+                    expected = set([options['routing_key']])
+                else:
+                    expected = set(self.lookup(options['routing_key']))
+                self.assertEqual(queues, expected, name)
 
         def test_max_retries(self):
             """ Ensure that, by default, max_retries is set to an int """
@@ -90,3 +201,354 @@ def build_functional_tests(app, is_worker=True):
                 int)
 
     return TestConfigFunctional
+
+
+def _max_rss():
+    """ Process memory high-water mark (kilobytes on Linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _latency_summary(latencies):
+    latencies = sorted(latency * 1000 for latency in latencies)
+    return {
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+class BenchmarkSuite(object):
+    """
+    Synthetic workloads driven through a copy of a Celery app's
+    configuration (its queues, routing, platform queue bindings, chord
+    unlock strategy and result backend class), run by an in-process worker
+    against kombu's in-memory transport and a temporary SQLite result
+    database. Each task records when it completed, so that the end-to-end
+    latency of each unit of work (a task, a chord, a chain of followups) is
+    measured from when it was published.
+    """
+
+    def __init__(self, app, tasks=500, chords=20, width=10, chains=20,
+                 hops=5, task_ms=0, mix=None, seed=0, timeout=120,
+                 pool='solo', concurrency=1, poll_interval=0.02):
+        self.app = app
+        self.tasks = tasks
+        self.chords = chords
+        self.width = width
+        self.chains = chains
+        self.hops = hops
+        self.task_ms = task_ms
+        self.seed = seed
+        self.timeout = timeout
+        self.pool = pool
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.queues = list(app.conf.QUEUES) + ['celery']
+        self.mix = mix or {queue: 1 for queue in self.queues}
+        unknown = set(self.mix) - set(self.queues)
+        if unknown:
+            raise ValueError(
+                "Mix holds unknown queues: {}".format(sorted(unknown)))
+
+    def options(self):
+        return {
+            'tasks': self.tasks,
+            'chords': self.chords,
+            'width': self.width,
+            'chains': self.chains,
+            'hops': self.hops,
+            'task_ms': self.task_ms,
+            'mix': self.mix,
+            'seed': self.seed,
+            'pool': self.pool,
+            'concurrency': self.concurrency,
+        }
+
+    def build_app(self, directory):
+        """
+        Copy of the app's configuration, with the in-memory transport and
+        a SQLite database in place of its broker and result database
+        """
+        conf = self.app.conf
+        settings = {
+            key: value
+            for key, value in conf.table(censored=False).items()
+            # Drop the methods of the app's Config, but not its router
+            if getattr(value, '__name__', None) != key
+        }
+        # Keep the class of database backends (e.g. buffered)
+        scheme = 'db'
+        if isinstance(self.app.backend, DatabaseBackend):
+            scheme = conf.result_backend.partition('+')[0]
+        url = 'sqlite:///' + os.path.join(directory, 'results.db')
+        # Celery only creates its tables in the first database it connects to
+        engine = create_engine(url)
+        ResultModelBase.metadata.create_all(engine)
+        engine.dispose()
+        settings.update(
+            imports=(), broker_url='memory://', broker_transport='memory',
+            broker_transport_options={'polling_interval': 0.01},
+            result_backend=scheme + '+' + url,
+            DECLARATION_CACHE_FILE='')
+        app = Celery(self.app.main, set_as_current=False)
+        app.config_from_object(settings)
+
+        task_ms = self.task_ms
+
+        def work(delay=task_ms / 1000.0):
+            time.sleep(delay)
+            return time.time()
+
+        def collect(*results):
+            return time.time()
+
+        def hop(task, remaining, queue):
+            if remaining:
+                queue = (queue + 1) % len(self.queues)
+                self.hop_tasks[queue].apply_async(
+                    (remaining - 1, queue), **extract_followups(task))
+            return time.time()
+
+        self.work_tasks = [
+            app.task(name='{}.benchmark_work'.format(queue),
+                     shared=False)(work)
+            for queue in self.queues
+        ]
+        self.hop_tasks = [
+            app.task(name='{}.benchmark_hop'.format(queue), shared=False,
+                     bind=True)(hop)
+            for queue in self.queues
+        ]
+        self.collect_task = app.task(
+            name='celery.benchmark_collect', shared=False)(collect)
+        return app
+
+    def run(self, workloads=WORKLOADS):
+        """ Run 'workloads', returning a report of each """
+        # Imported here to keep the worker out of functional tests
+        import celery.contrib.testing.tasks  # NOQA: registers celery.ping
+        from celery.contrib.testing.worker import start_worker
+        from .setup import setup_app
+
+        directory = tempfile.mkdtemp()
+        app = self.bench_app = self.build_app(directory)
+        try:
+            setup_app(app)
+            report = {
+                'versions': {
+                    'python': platform.python_version(),
+                    'celery': celery_version,
+                    'kombu': kombu_version,
+                    'workertoolbox': __version__,
+                },
+                'topology': self.topology(),
+                'options': self.options(),
+                'workloads': {},
+            }
+            # Declared afresh and emptied, as kombu caches declarations
+            # per broker URL, and apps of this process share the in-memory
+            # transport's queues and bindings
+            with app.connection_for_write() as conn:
+                for queue in app.amqp.queues.values():
+                    queue = queue(conn.default_channel)
+                    queue.declare()
+                    queue.purge()
+            error = None
+            with _tracing_tasks_of(app), \
+                    start_worker(app, pool=self.pool,
+                                 concurrency=self.concurrency,
+                                 queues=self.queues, perform_ping_check=False,
+                                 loglevel='ERROR'):
+                # The worker isn't stopped should its block raise
+                try:
+                    for name in workloads:
+                        report['workloads'][name] = self.measure(
+                            getattr(self, 'publish_' + name))
+                except Exception:
+                    error = sys.exc_info()
+            if error is not None:
+                reraise(*error)
+            report['max_rss_kb'] = _max_rss()
+            return report
+        finally:
+            shutil.rmtree(directory)
+
+    def topology(self):
+        conf = self.bench_app.conf
+        return {
+            'queues': self.queues,
+            'exchange': conf.task_default_exchange,
+            'platform_queue': conf.PLATFORM_QUEUE_NAME,
+            'platform_bindings': list(conf.PLATFORM_QUEUE_BINDINGS),
+            'platform_excluded_tasks': list(conf.PLATFORM_EXCLUDED_TASKS),
+            'result_backend': type(self.bench_app.backend).__name__,
+            'chord_unlock_strategy': conf.CHORD_UNLOCK_STRATEGY,
+            'followups_by_reference': conf.FOLLOWUPS_BY_REFERENCE,
+        }
+
+    def measure(self, publish):
+        """
+        Publish a workload, then wait for its results. Reports the rate at
+        which its messages were published, how many messages were published
+        in all (including by tasks) and mirrored to the platform queue, the
+        end-to-end latency of its units of work, and the process's memory
+        high-water mark.
+        """
+        published = []
+
+        def count(sender=None, **kwargs):
+            published.append(sender)
+
+        before_task_publish.connect(count, weak=False)
+        try:
+            start = time.time()
+            tracked = publish()
+            publish_seconds = time.time() - start
+            sent = len(published)
+            metas = self.wait([result.id for _, result in tracked])
+            duration = time.time() - start
+        finally:
+            before_task_publish.disconnect(count)
+
+        latencies = []
+        failed = 0
+        for sent_at, result in tracked:
+            meta = metas[result.id]
+            if meta['status'] == states.SUCCESS:
+                latencies.append(meta['result'] - sent_at)
+            else:
+                failed += 1
+        platform_queue = self.bench_app.conf.PLATFORM_QUEUE_NAME
+        with self.bench_app.connection_for_write() as conn:
+            mirrored = self.bench_app.amqp.queues[platform_queue](
+                conn.default_channel).purge()
+        return {
+            'units': len(tracked),
+            'failed': failed,
+            'published': sent,
+            'publish_seconds': publish_seconds,
+            'publish_rate': (
+                sent / publish_seconds if publish_seconds else None),
+            'messages': len(published),
+            'mirrored': mirrored,
+            'duration': duration,
+            'throughput': len(tracked) / duration,
+            'latency_ms': _latency_summary(latencies),
+            'max_rss_kb': _max_rss(),
+        }
+
+    def wait(self, task_ids):
+        """ Poll the result backend until each of 'task_ids' is ready """
+        backend = self.bench_app.backend
+        metas = {}
+        pending = list(task_ids)
+        deadline = time.time() + self.timeout
+        while True:
+            still_pending = []
+            for task_id, meta in iter_task_meta(backend, pending):
+                if meta['status'] in states.READY_STATES:
+                    metas[task_id] = meta
+                else:
+                    still_pending.append(task_id)
+            pending = still_pending
+            if not pending:
+                return metas
+            if time.time() >= deadline:
+                raise TimeoutError(
+                    "{} of {} tasks incomplete after {}s".format(
+                        len(pending), len(task_ids), self.timeout))
+            time.sleep(self.poll_interval)
+
+    def publish_fanout(self):
+        """ A group of 'tasks', spread across the queues """
+        sent_at = time.time()
+        result = group(
+            self.work_tasks[i % len(self.work_tasks)].s()
+            for i in range(self.tasks)
+        ).apply_async()
+        return [(sent_at, child) for child in result.results]
+
+    def publish_chords(self):
+        """ 'chords' chords of 'width' tasks, spread across the queues """
+        tracked = []
+        for _ in range(self.chords):
+            sent_at = time.time()
+            header = [
+                self.work_tasks[i % len(self.work_tasks)].s()
+                for i in range(self.width)
+            ]
+            tracked.append((sent_at, chord(header)(self.collect_task.s())))
+        return tracked
+
+    def publish_followups(self):
+        """
+        'chains' tasks passing their followups on through
+        extract_followups for 'hops' hops, across the queues
+        """
+        tracked = []
+        for i in range(self.chains):
+            callback = self.collect_task.s()
+            result = callback.freeze()
+            queue = i % len(self.hop_tasks)
+            sent_at = time.time()
+            self.hop_tasks[queue].apply_async(
+                (self.hops, queue), link=callback)
+            tracked.append((sent_at, result))
+        return tracked
+
+    def publish_mixed(self):
+        """ 'tasks' tasks, each sent to a queue drawn from the 'mix' """
+        rand = random.Random(self.seed)
+        queues = sorted(self.mix)
+        weights = [self.mix[queue] for queue in queues]
+        total = float(sum(weights))
+        tracked = []
+        for _ in range(self.tasks):
+            point = rand.random() * total
+            for queue, weight in zip(queues, weights):
+                point -= weight
+                if point < 0:
+                    break
+            task = self.work_tasks[self.queues.index(queue)]
+            tracked.append((time.time(), task.delay()))
+        return tracked
+
+    def main(self, argv=None):
+        """ Run from the command line, writing the report as JSON """
+        parser = argparse.ArgumentParser(
+            description='Benchmark workloads through the configured '
+                        'topology')
+        parser.add_argument('--workloads', nargs='+', choices=WORKLOADS,
+                            default=list(WORKLOADS))
+        for option in ('tasks', 'chords', 'width', 'chains', 'hops'):
+            parser.add_argument('--' + option, type=int,
+                                default=getattr(self, option))
+        parser.add_argument('--task-ms', type=float, default=self.task_ms)
+        parser.add_argument('--output', default='-',
+                            help='File to write the report to')
+        args = parser.parse_args(argv)
+        for option in ('tasks', 'chords', 'width', 'chains', 'hops',
+                       'task_ms'):
+            setattr(self, option, getattr(args, option))
+        report = self.run(args.workloads)
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if args.output == '-':
+            print(output)
+        else:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        return report
+
+
+def build_benchmark_suite(app, **options):
+    """
+    Helper to produce a suite of benchmarks of provided configuration,
+    reporting publish rates, end-to-end latency percentiles and memory
+    high-water marks as JSON, so that releases can be compared.
+
+    app: A configured Celery app instance
+    options: Sizes of the workloads, see BenchmarkSuite
+    """
+    return BenchmarkSuite(app, **options)
@@ -0,0 +1,98 @@
+from kombu.five import Empty, string_t
+from kombu.transport import SQS
+from vine import ensure_promise, transform
+
+
+class SQSChannel(SQS.Channel):
+    """
+    SQS channel supporting a 'receive_batch_size' transport option, the
+    maximum number of messages requested per ReceiveMessage call, as well as
+    'visibility_timeout' and 'receive_batch_size' overrides per queue via
+    the 'queue_options' transport option, e.g.:
+
+        {'queue_options': {'export': {'visibility_timeout': 3600}}}
+
+    The visibility timeout is sent with every ReceiveMessage call, as well as
+    when creating a queue, so that it also applies to existing queues.
+    """
+
+    def _queue_option(self, queue, option):
+        options = self.transport_options.get('queue_options', {})
+        value = options.get(queue, {}).get(option)
+        if value is None:
+            value = self.transport_options.get(option)
+        return value
+
+    def _receive_batch_size(self, queue):
+        size = self._queue_option(queue, 'receive_batch_size')
+        return min(size or SQS.SQS_MAX_MESSAGES, SQS.SQS_MAX_MESSAGES)
+
+    def _visibility_timeout(self, queue):
+        return (self._queue_option(queue, 'visibility_timeout') or
+                self.default_visibility_timeout)
+
+    def _new_queue(self, queue, **kwargs):
+        """ Mirrors SQS.Channel._new_queue, with per-queue attributes """
+        if not isinstance(queue, string_t):
+            return queue
+        name = queue
+        queue = self.canonical_queue_name(queue)
+        if queue not in self._queue_cache:
+            self._update_queue_cache(queue)
+        try:
+            return self._queue_cache[queue]
+        except KeyError:
+            attributes = {
+                'VisibilityTimeout': str(self._visibility_timeout(name))}
+            if queue.endswith('.fifo'):
+                attributes['FifoQueue'] = 'true'
+            resp = self.sqs.create_queue(
+                QueueName=queue, Attributes=attributes)
+            self._queue_cache[queue] = resp['QueueUrl']
+            return resp['QueueUrl']
+
+    def _get_bulk(self, queue, max_if_unlimited=SQS.SQS_MAX_MESSAGES,
+                  callback=None):
+        """ Mirrors SQS.Channel._get_bulk, with a per-queue batch size """
+        max_count = self._get_message_estimate(
+            self._receive_batch_size(queue))
+        if max_count:
+            q_url = self._new_queue(queue)
+            resp = self.sqs.receive_message(
+                QueueUrl=q_url, MaxNumberOfMessages=max_count,
+                VisibilityTimeout=self._visibility_timeout(queue),
+                WaitTimeSeconds=self.wait_time_seconds)
+            if resp.get('Messages'):
+                for m in resp['Messages']:
+                    m['Body'] = SQS.AsyncMessage(body=m['Body']).decode()
+                for msg in self._messages_to_python(resp['Messages'], queue):
+                    self.connection._deliver(msg, queue)
+                return
+        raise Empty()
+
+    def _get_bulk_async(self, queue, max_if_unlimited=SQS.SQS_MAX_MESSAGES,
+                        callback=None):
+        """ Mirrors SQS.Channel._get_bulk_async, with per-queue batch size """
+        max_count = self._get_message_estimate(
+            self._receive_batch_size(queue))
+        if max_count:
+            return self._get_async(queue, max_count, callback=callback)
+        callback = ensure_promise(callback)
+        callback([])
+        return callback
+
+    def _get_async(self, queue, count=1, callback=None):
+        """ Mirrors SQS.Channel._get_async, with a per-queue visibility """
+        q = self._new_queue(queue)
+        qname = self.canonical_queue_name(queue)
+        return self.asynsqs.receive_message(
+            qname, number_messages=count,
+            visibility_timeout=self._visibility_timeout(queue),
+            wait_time_seconds=self.wait_time_seconds,
+            callback=transform(self._on_messages_ready, callback, q, queue))
+
+
+class SQSTransport(SQS.Transport):
+    """ SQS transport using SQSChannel """
+
+    Channel = SQSChannel
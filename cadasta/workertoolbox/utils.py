@@ -1,17 +1,82 @@
+import threading
+from collections import OrderedDict
+
 from celery.utils.log import ColorFormatter as ColorFormatterBase
 
 
 def extract_followups(task):
     """
     Retrieve callbacks and errbacks from provided task instance, disables
-    tasks callbacks.
+    tasks callbacks. With FOLLOWUPS_BY_REFERENCE, followups are instead
+    stored once and returned as a message header referencing them.
     """
     callbacks = task.request.callbacks
     errbacks = task.request.errbacks
     task.request.callbacks = None
-    return {'link': callbacks, 'link_error': errbacks}
+    if task.app.conf.get('FOLLOWUPS_BY_REFERENCE') is not True:
+        return {'link': callbacks, 'link_error': errbacks}
+    # Imported here, as followups depends on this module
+    from .followups import forward_followups
+    return forward_followups(task, callbacks, errbacks)
 
 
 class ColorFormatter(ColorFormatterBase):
     def __init__(self, fmt, use_color=True, *args, **kwargs):
         super(ColorFormatter, self).__init__(fmt, use_color)
+
+
+class LRUCache(object):
+    """
+    Mapping holding up to 'maxsize' of the most recently used items, counting
+    cache hits and misses. A 'maxsize' of 0 disables caching. Reads and
+    writes take a lock, as OrderedDict isn't thread-safe (on Python 2, it's
+    implemented in Python) and caches are shared by threads, e.g. publishing
+    tasks. Unlike kombu's LRUCache, the lock is only held for a single
+    lookup or insertion, and no other mapping methods are provided.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self, key, value):
+        if not self.maxsize:
+            return
+        with self._lock:
+            data = self._data
+            data[key] = value
+            if len(data) > self.maxsize:
+                data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            data = self._data
+            try:
+                value = data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            data[key] = value  # Mark as most recently used
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
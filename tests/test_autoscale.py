@@ -0,0 +1,213 @@
+import random
+import threading
+import unittest
+from mock import MagicMock, patch
+
+from celery import Celery
+from celery.worker import state
+from kombu import Queue
+
+from cadasta.workertoolbox.autoscale import (
+    DepthSampler, QueueDepthAutoscaler, ScalingPolicy, percentile, simulate)
+from cadasta.workertoolbox.conf import Config, QUEUE_DEPTH_AUTOSCALER
+from cadasta.workertoolbox.lanes import LaneRequest
+
+
+def spike_trace(seed=1):
+    """ Steady trickle of short tasks, with a burst of exports """
+    rand = random.Random(seed)
+    trace = [(t * 2.0, rand.uniform(0.5, 1.5)) for t in range(300)]
+    trace += [(100 + rand.uniform(0, 10), rand.uniform(20, 40))
+              for _ in range(40)]
+    return sorted(trace)
+
+
+class TestScalingPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = ScalingPolicy(1, 10, target_wait=10, cooldown=30)
+
+    def test_estimates_runtime(self):
+        self.policy.observe(0, active=4, completed=0)
+        self.assertIsNone(self.policy.runtime)
+        self.policy.observe(10, active=4, completed=20)
+        self.assertEqual(self.policy.runtime, 2.0)
+        self.policy.observe(10, active=4, completed=30)  # No time passed
+        self.policy.observe(20, active=4, completed=30)  # No completions
+        self.assertEqual(self.policy.runtime, 2.0)
+        self.policy.observe(30, active=4, completed=40)
+        self.assertAlmostEqual(self.policy.runtime, 0.3 * 4 + 0.7 * 2)
+
+    def test_desired(self):
+        self.assertEqual(self.policy.desired(depth=3, active=1), 4)
+        self.assertEqual(self.policy.desired(depth=50, active=1), 10)
+        self.policy.runtime = 2.0
+        self.assertEqual(self.policy.desired(depth=50, active=1), 10)
+        self.assertEqual(self.policy.desired(depth=12, active=1), 4)
+        self.assertEqual(self.policy.desired(depth=0, active=0), 1)
+
+    def test_hysteresis(self):
+        policy = self.policy
+        self.assertEqual(policy.decide(0, 1, 5, 0, 0), 5)
+        self.assertEqual(policy.decide(1, 5, None, 5, 0), 5)
+        # Not shrunk until fewer processes were needed for 30 seconds
+        self.assertEqual(policy.decide(10, 5, 0, 2, 10), 5)
+        self.assertEqual(policy.decide(20, 5, 0, 5, 12), 5)
+        self.assertEqual(policy.decide(30, 5, 0, 2, 20), 5)
+        self.assertEqual(policy.decide(59, 5, 0, 2, 30), 5)
+        self.assertEqual(policy.decide(60, 5, 0, 2, 40), 2)
+
+
+class TestQueueDepthAutoscaler(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            imports=(), broker_transport='memory',
+            AUTOSCALE_BY_QUEUE_DEPTH=True, AUTOSCALE_COOLDOWN=60))
+        self.queue = Queue('autoscale')
+        with self.app.connection() as conn:
+            queue = conn.SimpleQueue(self.queue.name)
+            queue.clear()
+            for i in range(5):
+                queue.put({'i': i})
+            queue.close()
+        self.pool = MagicMock(num_processes=1)
+        self.worker = MagicMock(app=self.app)
+        self.worker.consumer.app = self.app
+        self.worker.consumer.task_consumer.queues = [self.queue]
+        patcher = patch('cadasta.workertoolbox.autoscale.DepthSampler')
+        self.sampler = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scaler = QueueDepthAutoscaler(
+            self.pool, 4, 1, worker=self.worker)
+
+    def tearDown(self):
+        with self.app.connection() as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+
+    def test_selected_by_config(self):
+        self.assertEqual(self.app.conf.worker_autoscaler,
+                         QUEUE_DEPTH_AUTOSCALER)
+        self.assertEqual(self.scaler.policy.cooldown, 60)
+        self.assertEqual(self.scaler.policy.target_wait, 10.0)
+
+    @patch('cadasta.workertoolbox.lanes.total_count', [3])
+    @patch.object(state, 'all_total_count', [10])
+    def test_ignores_lane_requests(self):
+        lane_request = MagicMock(spec=LaneRequest)
+        with patch.object(state, 'reserved_requests',
+                          set(['a', 'b', lane_request])), \
+                patch.object(state, 'active_requests',
+                             set(['a', lane_request])):
+            self.assertEqual(self.scaler.active, 1)
+            self.assertEqual(self.scaler.completed, 6)
+            self.assertEqual(self.scaler.sample(), 5)
+            self.assertEqual(self.scaler.queue_depth(), 6)
+
+    @patch.object(state, 'reserved_requests', set(['a', 'b']))
+    @patch.object(state, 'active_requests', set(['a']))
+    def test_scales_to_queue_depth(self):
+        # Until sampled
+        self.assertIsNone(self.scaler.queue_depth())
+        self.sampler.assert_called_once_with(self.scaler.sample, 1.0)
+        self.sampler.return_value.start.assert_called_once_with()
+        self.scaler.sample()
+        self.assertEqual(self.scaler.queue_depth(), 6)
+        self.scaler.maybe_scale()
+        self.pool.grow.assert_called_once_with(3)
+        self.pool.maintain_pool.assert_called_once_with()
+        self.assertEqual(self.scaler.info()['depth'], 5)
+
+        # Scaled by the last sample
+        with self.app.connection() as conn:
+            conn.SimpleQueue(self.queue.name).clear()
+        self.pool.num_processes = 4
+        self.scaler.maybe_scale()
+        self.assertEqual(self.scaler.queue_depth(), 6)
+        self.scaler.sample()
+        self.assertEqual(self.scaler.queue_depth(), 1)
+        self.scaler.policy.cooldown = 0
+        self.scaler.maybe_scale()
+        self.pool.shrink.assert_called_once_with(2)
+
+    def test_unknown_depth(self):
+        self.worker.consumer.task_consumer = None
+        self.assertIsNone(self.scaler.sample())
+        self.assertIsNone(self.scaler.queue_depth())
+        self.assertFalse(self.scaler._maybe_scale())
+        self.assertFalse(self.pool.grow.called)
+
+    @patch('cadasta.workertoolbox.autoscale.logger')
+    def test_broker_errors(self, logger):
+        self.scaler.sample()
+        connection = self.scaler._connection
+        with patch.object(connection.default_channel, 'queue_declare',
+                          side_effect=IOError('Unreachable')):
+            self.assertIsNone(self.scaler.sample())
+        self.assertIsNone(self.scaler.queue_depth())
+        self.assertTrue(logger.warning.called)
+        self.assertIsNone(self.scaler._connection)
+
+    @patch('celery.worker.autoscale.Autoscaler.stop')
+    def test_stop(self, stop):
+        self.scaler.queue_depth()
+        self.scaler.stop()
+        self.sampler.return_value.stop.assert_called_once_with()
+        self.assertIsNone(self.scaler._sampler)
+        self.scaler.stop()
+        self.assertEqual(stop.call_count, 2)
+
+    def test_update(self):
+        self.scaler.update(max=8, min=2)
+        self.assertEqual(self.scaler.policy.max_concurrency, 8)
+        self.assertEqual(self.scaler.policy.min_concurrency, 2)
+
+
+class TestDepthSampler(unittest.TestCase):
+
+    def test_samples_periodically(self):
+        sampled = threading.Event()
+        sample = MagicMock(side_effect=lambda: sample.call_count > 1 and
+                           sampled.set())
+        sampler = DepthSampler(sample, 0.01)
+        sampler.start()
+        self.assertTrue(sampled.wait(5))
+        sampler.stop()
+        self.assertFalse(sampler.is_alive())
+
+
+class TestSimulation(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile([1, 2, 3, 4], 0.5), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 0.99), 4)
+        self.assertEqual(percentile([1, 2, 3, 4], 0), 1)
+
+    def test_fixed_concurrency(self):
+        report = simulate(None, [(0, 1), (0, 1), (0.5, 1)], concurrency=2)
+        self.assertEqual(report['tasks'], 3)
+        self.assertEqual(report['duration'], 2)
+        self.assertEqual(report['utilisation'], 0.75)
+        self.assertEqual(report['wait']['max'], 0.5)
+        self.assertEqual(report['max_concurrency'], 2)
+
+    def test_empty_trace(self):
+        report = simulate(None, [], concurrency=2)
+        self.assertEqual(report['utilisation'], 0.0)
+        self.assertIsNone(report['wait']['p50'])
+
+    def test_autoscaled_pool(self):
+        trace = spike_trace()
+        small = simulate(None, trace, concurrency=2)
+        large = simulate(None, trace, concurrency=20)
+        scaled = simulate(
+            ScalingPolicy(2, 20, target_wait=10, cooldown=30), trace)
+        # Waits close to those of the overprovisioned pool...
+        self.assertLess(scaled['wait']['p95'], small['wait']['p95'] / 2)
+        self.assertLess(scaled['wait']['p99'], 60)
+        # ...whose processes are idle most of the time
+        self.assertGreater(scaled['utilisation'], large['utilisation'] * 2)
+        self.assertGreater(scaled['max_concurrency'], 2)
+        self.assertLess(scaled['mean_concurrency'], 10)
@@ -0,0 +1,274 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from mock import MagicMock, patch
+
+from celery import Celery, states
+from celery.backends.database.models import Task
+from celery.exceptions import TimeoutError
+from celery.result import AsyncResult, GroupResult
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from cadasta.workertoolbox.backends import (
+    BufferedDatabaseBackend, ChordCounter, ChordCounterDatabaseBackend,
+    build_upsert, _after_fork_reset_backend)
+from cadasta.workertoolbox.conf import BUFFERED_RESULT_BACKEND, Config
+
+
+class TestBufferedDatabaseBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.tmpdir, 'results.db')
+        self.app = Celery()
+        self.backend = BufferedDatabaseBackend(
+            app=self.app, url=self.url, buffer_size=3, flush_interval=60)
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def db_rows(self):
+        with self.backend.engine.connect() as conn:
+            return {
+                row.task_id: row.status
+                for row in conn.execute(Task.__table__.select())
+            }
+
+    def test_app_selects_backend(self):
+        app = Celery()
+        app.config_from_object(Config(
+            RESULT_BACKEND_BUFFERED=True, RESULT_BUFFER_MAX_SIZE=7,
+            result_backend=BUFFERED_RESULT_BACKEND + '+' + self.url))
+        self.assertIsInstance(app.backend, BufferedDatabaseBackend)
+        self.assertEqual(app.backend.url, self.url)
+        self.assertEqual(app.backend.buffer_size, 7)
+        self.assertEqual(app.backend.pool_size, 5)
+
+    def test_buffers_started_and_success(self):
+        self.backend.store_result('a', None, states.STARTED)
+        self.backend.store_result('b', None, states.STARTED)
+        self.assertEqual(self.backend.pending, 2)
+        self.assertEqual(self.db_rows(), {})
+
+    def test_coalesces_states(self):
+        self.backend.store_result('a', None, states.STARTED)
+        self.backend.store_result('a', 42, states.SUCCESS)
+        self.assertEqual(self.backend.pending, 1)
+        self.assertEqual(self.backend.get_result('a'), 42)
+        self.assertEqual(self.backend.flush(), 1)
+        self.assertEqual(self.db_rows(), {'a': states.SUCCESS})
+
+    def test_flushes_when_full(self):
+        for task_id in 'abc':
+            self.backend.store_result(task_id, 1, states.SUCCESS)
+        self.assertEqual(self.backend.pending, 0)
+        self.assertEqual(
+            self.db_rows(),
+            {'a': states.SUCCESS, 'b': states.SUCCESS, 'c': states.SUCCESS})
+
+    def test_upserts_existing_rows(self):
+        self.backend.store_result('a', None, states.STARTED)
+        self.backend.flush()
+        self.backend.store_result('a', 'done', states.SUCCESS)
+        self.backend.flush()
+        self.assertEqual(self.db_rows(), {'a': states.SUCCESS})
+        self.assertEqual(self.backend.get_result('a'), 'done')
+
+    def test_flushes_on_interval(self):
+        self.backend.flush_interval = 0.01
+        self.backend.store_result('a', None, states.STARTED)
+        for _ in range(100):
+            if not self.backend.pending:
+                break
+            time.sleep(0.01)
+        with self.backend._flush_lock:  # Wait for the write to complete
+            self.assertEqual(self.db_rows(), {'a': states.STARTED})
+
+    def test_unbuffered_state_supersedes_buffer(self):
+        self.backend.store_result('a', None, states.STARTED)
+        self.backend.mark_as_failure('a', ValueError('Uh oh!'))
+        self.assertEqual(self.backend.pending, 0)
+        self.assertEqual(self.db_rows(), {'a': states.FAILURE})
+
+    def test_failed_flush_requeues(self):
+        self.backend.store_result('a', None, states.STARTED)
+        with patch('cadasta.workertoolbox.backends.build_upsert',
+                   side_effect=RuntimeError("Uh oh!")):
+            with self.assertRaises(RuntimeError):
+                self.backend.flush()
+        self.assertEqual(self.backend.pending, 1)
+
+    @patch('cadasta.workertoolbox.backends.logger')
+    def test_close_logs_failures(self, logger):
+        self.backend.store_result('a', None, states.STARTED)
+        with patch.object(self.backend, 'flush', side_effect=RuntimeError):
+            self.backend.close()
+        self.assertTrue(logger.exception.called)
+
+    def test_stores_after_close(self):
+        self.backend.close()
+        self.backend.store_result('a', None, states.STARTED)
+        self.assertEqual(self.backend.pending, 0)
+        self.assertEqual(self.db_rows(), {'a': states.STARTED})
+
+    def test_explicit_zero(self):
+        backend = BufferedDatabaseBackend(
+            app=self.app, url=self.url, buffer_size=0, flush_interval=0,
+            max_overflow=0)
+        self.assertEqual(
+            (backend.buffer_size, backend.flush_interval,
+             backend.max_overflow, backend.pool_size), (0, 0, 0, 5))
+        backend.store_result('a', None, states.STARTED)
+        self.assertEqual(backend.pending, 0)
+        self.assertIsNone(backend._flusher)
+        self.assertEqual(self.db_rows(), {'a': states.STARTED})
+        backend.flush_interval = 60
+        backend.store_result('b', None, states.STARTED)
+        self.assertEqual(backend.pending, 0)
+        backend.close()
+
+    def test_after_fork_reset(self):
+        self.backend.store_result('a', None, states.STARTED)
+        self.backend.engine
+        _after_fork_reset_backend(self.backend)
+        self.assertEqual(self.backend.pending, 0)
+        self.assertIsNone(self.backend._engine)
+
+    def test_reduce(self):
+        _, (cls, args, kwargs) = self.backend.__reduce__()
+        self.assertEqual(cls, BufferedDatabaseBackend)
+        self.assertEqual(kwargs['buffer_size'], 3)
+        self.assertEqual(kwargs['dburi'], self.url)
+
+
+@patch('celery.canvas.Signature.delay')
+class TestChordCounter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(self.tmpdir, 'results.db')
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            CHORD_UNLOCK_STRATEGY='counter',
+            RESULT_BUFFER_FLUSH_INTERVAL=60,
+            result_backend=BUFFERED_RESULT_BACKEND + '+' + url))
+        self.backend = self.app.backend
+        self.header = GroupResult('g', [
+            AsyncResult(task_id, app=self.app) for task_id in 'ab'])
+        self.body = self.app.signature('export.total')
+        self.body['chord_size'] = 2
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def complete(self, task_id, state=states.SUCCESS, result=1):
+        self.backend.store_result(task_id, result, state)
+        request = MagicMock(group='g', chord=self.body)
+        self.backend.on_chord_part_return(request, state, result)
+
+    def counters(self):
+        session = self.backend.ResultSession()
+        try:
+            return session.query(ChordCounter.remaining).all()
+        finally:
+            session.close()
+
+    def test_last_header_applies_body(self, delay):
+        self.backend.apply_chord(self.header, self.body)
+        self.complete('a')
+        self.assertFalse(delay.called)
+        self.assertEqual(self.counters(), [(1,)])
+        self.complete('b', result=2)
+        delay.assert_called_once_with([1, 2])
+        self.assertEqual(self.counters(), [])
+        self.assertIsNone(self.backend.restore_group('g', cache=False))
+
+    def test_producer_applies_body(self, delay):
+        self.complete('a')
+        self.complete('b')
+        self.assertFalse(delay.called)
+        self.backend.apply_chord(self.header, self.body)
+        delay.assert_called_once_with([1, 1])
+
+    def test_applied_once(self, delay):
+        self.complete('a')
+        self.complete('b')
+        self.backend.apply_chord(self.header, self.body)
+        self.backend._apply_chord_body('g', self.body)
+        self.assertEqual(delay.call_count, 1)
+
+    @patch('celery.backends.base.BaseBackend.chord_error_from_stack')
+    def test_failed_header(self, chord_error, delay):
+        self.backend.apply_chord(self.header, self.body)
+        self.complete('a', states.FAILURE, ValueError('Uh oh!'))
+        self.complete('b')
+        self.assertFalse(delay.called)
+        reason = chord_error.call_args[0][1]
+        self.assertIn('Dependency a raised', str(reason))
+
+    @patch('celery.result.GroupResult.join', side_effect=TimeoutError)
+    @patch('celery.backends.base.BaseBackend.chord_error_from_stack')
+    def test_join_timeout(self, chord_error, join, delay):
+        self.backend.apply_chord(self.header, self.body)
+        self.complete('a')
+        self.complete('b')
+        self.assertEqual(str(chord_error.call_args[0][1]), 'TimeoutError()')
+
+    @patch('celery.backends.base.BaseBackend.chord_error_from_stack')
+    def test_callback_error(self, chord_error, delay):
+        delay.side_effect = RuntimeError
+        self.backend.apply_chord(self.header, self.body)
+        self.complete('a')
+        self.complete('b')
+        self.assertIn('Callback error', str(chord_error.call_args[0][1]))
+
+    def test_concurrently_created_counter(self, delay):
+        error = IntegrityError('INSERT', {}, None)
+        with patch.object(self.backend, '_decrement_chord',
+                          side_effect=[error, 1]) as decrement:
+            self.complete('a')
+        self.assertEqual(decrement.call_count, 2)
+
+    def test_ignores_other_tasks(self, delay):
+        request = MagicMock(group=None)
+        self.backend.on_chord_part_return(request, states.SUCCESS, 1)
+        self.assertEqual(self.counters(), [])
+
+    def test_polling_strategies(self, delay):
+        self.app.conf.CHORD_UNLOCK_STRATEGY = 'poll'
+        with patch.object(self.backend, 'fallback_chord_unlock') as unlock:
+            self.backend.apply_chord(self.header, self.body)
+        self.assertTrue(unlock.called)
+        self.complete('a')
+        self.complete('b')
+        self.assertEqual(self.counters(), [])
+
+    def test_app_selects_backend(self, delay):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(CHORD_UNLOCK_STRATEGY='counter'))
+        self.assertIsInstance(app.backend, ChordCounterDatabaseBackend)
+
+
+class TestBuildUpsert(unittest.TestCase):
+    rows = [
+        {'task_id': 'a', 'status': 'SUCCESS', 'result': None,
+         'traceback': None, 'date_done': None},
+        {'task_id': 'b', 'status': 'SUCCESS', 'result': None,
+         'traceback': None, 'date_done': None},
+    ]
+
+    def test_postgresql(self):
+        stmt = build_upsert(Task.__table__, self.rows, 'postgresql')
+        sql = str(stmt.compile(dialect=postgresql.dialect()))
+        self.assertIn('ON CONFLICT (task_id) DO UPDATE', sql)
+        self.assertIn('status = excluded.status', sql)
+
+    def test_other_dialects(self):
+        stmt = build_upsert(Task.__table__, self.rows, 'sqlite')
+        sql = str(stmt.compile(dialect=sqlite.dialect()))
+        self.assertIn('INSERT OR REPLACE', sql)
@@ -0,0 +1,247 @@
+import os
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock, patch
+
+import celery.contrib.testing.tasks  # NOQA: registers celery.ping
+from celery import Celery, states
+from celery.concurrency.base import apply_target
+from celery.contrib.testing.worker import start_worker
+
+from cadasta.workertoolbox.batches import (
+    BatchBuffer, BatchRequest, BatchTask, batch_options)
+from cadasta.workertoolbox.conf import BUFFERED_RESULT_BACKEND, Config
+from cadasta.workertoolbox.setup import setup_exchanges
+
+
+class SoloPool(object):
+    """ Runs jobs inline, as the solo pool does """
+
+    def __init__(self):
+        self.jobs = []
+
+    def apply_async(self, target, args, accept_callback, callback,
+                    error_callback, **options):
+        self.jobs.append((args, options))
+        apply_target(target, args, {}, callback, accept_callback)
+
+
+def make_app(**kwargs):
+    options = dict(
+        imports=(), broker_transport='memory',
+        broker_transport_options={'polling_interval': 0.01},
+        result_backend='cache', cache_backend='memory')
+    options.update(kwargs)
+    app = Celery(set_as_current=False)
+    app.config_from_object(Config(**options))
+    return app
+
+
+def make_task(app, name='msg.send', **options):
+    @app.task(base=BatchTask, name=name, shared=False, **options)
+    def send(requests):
+        results = []
+        for request in requests:
+            value, = request.args
+            if value < 0:
+                results.append(ValueError(value))
+            else:
+                results.append(value * 2)
+        return results
+    return send
+
+
+def worker_request(id, args=(1,), callbacks=None):
+    request = MagicMock(
+        id=id, root_id=None, parent_id=None, reply_to=None,
+        correlation_id=None, hostname='worker', delivery_info={},
+        request_dict={'group': None})
+    request.name = 'msg.send'
+    request._payload = (args, {}, {'callbacks': callbacks})
+    request.revoked.return_value = False
+    return request
+
+
+class TestBatchOptions(unittest.TestCase):
+
+    def test_defaults(self):
+        app = make_app()
+        self.assertEqual(batch_options(make_task(app), app), (10, 0.1))
+        self.assertEqual(
+            batch_options(make_task(Celery(set_as_current=False)), app),
+            (10, 0.1))
+
+    def test_queue_options(self):
+        app = make_app(BATCH_MAX_SIZE=5, QUEUE_BATCH_OPTIONS={
+            'msg': {'max_size': 50, 'max_wait': 0.5}})
+        self.assertEqual(batch_options(make_task(app), app), (50, 0.5))
+        export = make_task(app, name='export.send')
+        self.assertEqual(batch_options(export, app), (5, 0.1))
+
+    def test_task_options(self):
+        app = make_app(QUEUE_BATCH_OPTIONS={'msg': {'max_size': 50}})
+        task = make_task(app, max_batch_size=3, max_batch_wait=1)
+        self.assertEqual(batch_options(task, app), (3, 1))
+
+    def test_default_router(self):
+        app = Celery(set_as_current=False)
+        app.conf.QUEUE_BATCH_OPTIONS = {'celery': {'max_size': 7}}
+        self.assertEqual(batch_options(make_task(app), app), (7, 0.1))
+
+
+class TestBatchBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.task = make_task(self.app)
+        self.consumer = MagicMock()
+        self.consumer.qos.value = 0
+        self.consumer.pool = self.pool = SoloPool()
+        self.buffer = BatchBuffer(
+            self.task, self.consumer, max_size=3, max_wait=0.1)
+
+    def test_flushes_when_full(self):
+        requests = [worker_request(str(i), (i,)) for i in range(4)]
+        for request in requests[:3]:
+            self.buffer.add(request)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(len(self.pool.jobs), 1)
+        (task, batch), _ = self.pool.jobs[0]
+        self.assertEqual([r.args for r in batch], [(0,), (1,), (2,)])
+        for request in requests[:3]:
+            request.acknowledge.assert_called_once_with()
+        self.assertEqual(self.task.AsyncResult('2').result, 4)
+
+        # Timer started by the first request of a batch, and cancelled
+        timer = self.consumer.timer.call_after
+        self.assertEqual(timer.call_count, 1)
+        timer.assert_called_with(0.1, self.buffer.flush)
+        timer.return_value.cancel.assert_called_once_with()
+
+        self.buffer.add(requests[3])
+        self.assertEqual(len(self.buffer), 1)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(len(self.pool.jobs), 2)
+
+    def test_flushes_at_prefetch_count(self):
+        self.consumer.qos.value = 2
+        self.buffer.add(worker_request('a'))
+        self.buffer.add(worker_request('b'))
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(len(self.pool.jobs), 1)
+
+    def test_skips_revoked_requests(self):
+        request = worker_request('a')
+        request.revoked.return_value = True
+        self.buffer.add(request)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(self.pool.jobs, [])
+
+    def test_acks_late(self):
+        task = make_task(self.app, name='msg.late', acks_late=True,
+                         time_limit=5)
+        request = worker_request('a')
+
+        def check_unacked(requests):
+            self.assertFalse(request.acknowledge.called)
+            return [None]
+
+        with patch.object(task, 'run', side_effect=check_unacked):
+            task.apply_batch([request], self.pool)
+        request.acknowledge.assert_called_once_with()
+        _, options = self.pool.jobs[0]
+        self.assertEqual(options['timeout'], 5)
+
+
+class TestBatchTask(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app()
+        self.task = make_task(self.app)
+
+    def test_results(self):
+        callback = self.app.signature('msg.notify')
+        requests = [
+            BatchRequest('a', 'msg.send', (1,), callbacks=[callback]),
+            BatchRequest('b', 'msg.send', (-1,)),
+        ]
+        with patch('celery.canvas.Signature.apply_async') as apply_async:
+            self.assertEqual(self.task.execute_batch(requests), 1)
+        apply_async.assert_called_once_with(
+            (2,), parent_id='a', root_id='a')
+        self.assertEqual(self.task.AsyncResult('a').result, 2)
+        failed = self.task.AsyncResult('b')
+        self.assertEqual(failed.state, states.FAILURE)
+        self.assertIsInstance(failed.result, ValueError)
+        self.assertEqual(repr(requests[1]), '<BatchRequest: msg.send[b]>')
+
+    @patch('cadasta.workertoolbox.batches.logger')
+    def test_failed_batch(self, logger):
+        requests = [BatchRequest(i, 'msg.send', (1,)) for i in 'ab']
+        with patch.object(self.task, 'run', return_value=[1]):
+            self.assertEqual(self.task.execute_batch(requests), 2)
+        self.assertTrue(logger.exception.called)
+        result = self.task.AsyncResult('b')
+        self.assertEqual(result.state, states.FAILURE)
+        self.assertIn('returned 1 result', result.traceback)
+
+    def test_ignore_result(self):
+        task = make_task(self.app, name='msg.ignored', ignore_result=True)
+        task.execute_batch([BatchRequest('a', 'msg.ignored', (1,))])
+        self.assertEqual(task.AsyncResult('a').state, states.PENDING)
+
+    def test_called_directly(self):
+        self.assertEqual(self.task(2), 4)
+        with self.assertRaises(ValueError):
+            self.task(-1)
+        self.assertEqual(self.task.apply((3,)).result, 6)
+
+
+class TestBatchWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(self.tmpdir, 'results.db')
+        self.app = make_app(
+            result_backend=BUFFERED_RESULT_BACKEND + '+' + url,
+            RESULT_BUFFER_MAX_SIZE=1, QUEUE_BATCH_OPTIONS={
+                'msg': {'max_size': 4, 'max_wait': 0.05}})
+        self.task = make_task(self.app)
+        self.batches = []
+        execute_batch = self.task.execute_batch
+
+        def record(requests):
+            self.batches.append(len(requests))
+            return execute_batch(requests)
+
+        self.task.execute_batch = record
+        setup_exchanges(self.app)
+        with self.app.connection() as conn:
+            for queue in ('msg', 'celery'):
+                conn.SimpleQueue(queue).clear()
+
+    def tearDown(self):
+        self.app.backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def run_batches(self, values):
+        with start_worker(self.app, pool='solo', queues=['msg', 'celery'],
+                          perform_ping_check=False, loglevel='ERROR'):
+            results = [self.task.delay(value) for value in values]
+            return [
+                r.get(timeout=10, interval=0.01, propagate=False)
+                for r in results
+            ]
+
+    def test_executes_batches(self):
+        results = self.run_batches([1, 2, 3, 4, 5, -6])
+        self.assertEqual(results[:5], [2, 4, 6, 8, 10])
+        self.assertIsInstance(results[5], ValueError)
+        self.assertEqual(sum(self.batches), 6)
+        self.assertLess(len(self.batches), 6)
+
+    def test_protocol_1(self):
+        self.app.conf.task_protocol = 1
+        self.assertEqual(self.run_batches([1, 2]), [2, 4])
@@ -0,0 +1,158 @@
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from mock import MagicMock, patch
+
+from celery import Celery
+
+from cadasta.workertoolbox.blobs import (
+    BlobPurger, BlobStore, FileSystemBlobStore, PayloadPurge,
+    blob_store_from_url)
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.setup import setup_payload_purge
+
+
+class DictBlobStore(BlobStore):
+    """ Blob store without a 'purge' method """
+
+    def __init__(self):
+        self.blobs = {}
+
+    def put(self, key, data):
+        self.blobs[key] = data
+
+    def get(self, key):
+        return self.blobs[key]
+
+    def delete(self, key):
+        self.blobs.pop(key, None)
+
+
+class TestFileSystemBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'blobs')
+        self.store = FileSystemBlobStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get_delete(self):
+        self.store.put('a-1.b', b'data')
+        self.assertEqual(self.store.get('a-1.b'), b'data')
+        self.assertEqual(os.listdir(self.path), ['a-1.b'])
+        self.store.delete('a-1.b')
+        with self.assertRaises(KeyError):
+            self.store.get('a-1.b')
+        self.store.delete('a-1.b')  # No-op once deleted
+
+    def test_existing_directory(self):
+        self.store.put('a', b'data')
+        self.assertEqual(FileSystemBlobStore(self.path).get('a'), b'data')
+
+    def test_purge(self):
+        self.store.put('old', b'data')
+        self.store.put('new', b'data')
+        old = time.time() - 120
+        os.utime(os.path.join(self.path, 'old'), (old, old))
+        self.assertEqual(self.store.purge(60), 1)
+        self.assertEqual(os.listdir(self.path), ['new'])
+        self.assertEqual(self.store.purge(60), 0)
+
+    def test_purge_errors(self):
+        self.store.put('a', b'data')
+        # Deleted meanwhile
+        with patch('os.path.getmtime',
+                   side_effect=OSError(errno.ENOENT, 'No such file')):
+            self.assertEqual(self.store.purge(0), 0)
+        with patch('os.path.getmtime',
+                   side_effect=OSError(errno.EACCES, 'Permission denied')):
+            with self.assertRaises(OSError):
+                self.store.purge(0)
+
+    def test_invalid_key(self):
+        with self.assertRaises(ValueError):
+            self.store.get('../a')
+
+    def test_errors(self):
+        error = OSError(errno.EACCES, 'Permission denied')
+        with patch('os.makedirs', side_effect=error):
+            with self.assertRaises(OSError):
+                FileSystemBlobStore(self.path)
+        with patch('os.remove', side_effect=error):
+            with self.assertRaises(OSError):
+                self.store.delete('a')
+        with patch('cadasta.workertoolbox.blobs.open', create=True,
+                   side_effect=IOError(errno.EACCES, 'Permission denied')):
+            with self.assertRaises(IOError):
+                self.store.get('a')
+
+    def test_from_url(self):
+        store = blob_store_from_url('file://' + self.path)
+        self.assertIsInstance(store, FileSystemBlobStore)
+        self.assertEqual(store.path, self.path)
+        store = blob_store_from_url(__name__ + ':DictBlobStore')
+        self.assertIs(type(store), DictBlobStore)
+
+    def test_interface(self):
+        with self.assertRaises(TypeError):
+            BlobStore()
+        store = DictBlobStore()
+        store.put('a', b'data')
+        self.assertEqual(store.purge(0), 0)
+        self.assertEqual(store.get('a'), b'data')
+
+
+class TestPayloadPurge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            imports=(), PAYLOAD_STORE='file://' + self.tmpdir,
+            PAYLOAD_TTL=60))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('cadasta.workertoolbox.blobs.logger')
+    def test_purger(self, logger):
+        store = MagicMock()
+        store.purge.side_effect = [2, 0, IOError('Unreachable')]
+        purger = BlobPurger(store, 60, 0)
+        for _ in range(3):
+            purger.body()
+        store.purge.assert_called_with(60)
+        self.assertEqual(logger.info.call_count, 1)
+        self.assertEqual(logger.warning.call_count, 1)
+
+    def test_purges_while_running(self):
+        purged = threading.Event()
+        store = self.app.conf.PAYLOAD_CODEC.blob_store
+        worker = MagicMock(app=self.app)
+        step = PayloadPurge(worker)
+        self.assertIs(step.blob_store, store)
+        with patch.object(store, 'purge', side_effect=lambda max_age:
+                          purged.set()) as purge:
+            step.start(worker)
+            self.assertEqual(step.purger.interval, 6.0)
+            self.assertTrue(purged.wait(5))
+            step.stop(worker)
+        purge.assert_called_with(60)
+        self.assertIsNone(step.purger)
+        step.stop(worker)
+
+    def test_setup(self):
+        setup_payload_purge(self.app)
+        self.assertIn(PayloadPurge, self.app.steps['worker'])
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            imports=(), PAYLOAD_STORE='file://' + self.tmpdir,
+            PAYLOAD_TTL=0))
+        setup_payload_purge(app)
+        self.assertNotIn(PayloadPurge, app.steps['worker'])
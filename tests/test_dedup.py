@@ -0,0 +1,372 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from mock import MagicMock, patch
+
+import celery.contrib.testing.tasks  # NOQA: registers celery.ping
+from celery import Celery
+from celery.contrib.testing.worker import start_worker
+from celery.exceptions import Reject
+from celery.utils.nodenames import gethostname
+from celery.worker import state
+from celery.worker.request import Request
+
+from cadasta.workertoolbox.conf import BUFFERED_RESULT_BACKEND, Config
+from cadasta.workertoolbox.dedup import (
+    ClaimStore, DatabaseClaimStore, DedupTask, Deduplicator, MemoryClaimStore,
+    TaskHeartbeat, _after_fork_dispose_engine, claim_store_from_url,
+    extend_visibility, get_deduplicator)
+
+NOW = datetime(2018, 6, 1)
+
+
+def later(seconds):
+    return NOW + timedelta(seconds=seconds)
+
+
+class ClaimStoreTests(object):
+
+    def test_claims(self):
+        store = self.store
+        self.assertTrue(store.claim('a', 'w1', NOW, later(60)))
+        self.assertFalse(store.claim('a', 'w2', NOW, later(60)))
+        self.assertTrue(store.claim('b', 'w2', NOW, later(60)))
+        # Expired claims are taken over
+        self.assertFalse(store.claim('a', 'w2', later(60), later(120)))
+        self.assertTrue(store.claim('a', 'w2', later(61), later(120)))
+        self.assertEqual(store.purge(later(121)), 2)
+        self.assertTrue(store.claim('a', 'w1', later(121), later(180)))
+
+    def test_extend(self):
+        self.store.claim('a', 'w1', NOW, later(60))
+        self.store.claim('b', 'w1', NOW, later(60))
+        self.store.claim('c', 'w2', NOW, later(60))
+        self.store.finish('b', 'w1', later(30))
+        self.assertEqual(
+            self.store.extend(['a', 'b', 'c', 'd'], 'w1', later(120)), 1)
+        self.assertFalse(self.store.claim('a', 'w2', later(90), later(150)))
+        self.assertTrue(self.store.claim('b', 'w2', later(90), later(150)))
+
+    def test_finish_and_release(self):
+        self.store.claim('a', 'w1', NOW, later(60))
+        self.store.finish('a', 'w2', later(3600))  # Not the owner
+        self.store.release('a', 'w2')
+        self.assertTrue(self.store.claim('a', 'w2', later(61), later(120)))
+        self.store.finish('a', 'w2', later(3600))
+        self.assertFalse(self.store.claim('a', 'w1', later(600), later(660)))
+        self.store.release('a', 'w2')
+        self.assertTrue(self.store.claim('a', 'w1', later(600), later(660)))
+        self.store.release('missing', 'w1')
+        self.store.finish('missing', 'w1', later(60))
+
+    def test_status(self):
+        self.store.claim('a', 'w1', NOW, later(60))
+        self.assertEqual(self.store.status('a'), 'running')
+        self.store.finish('a', 'w1', later(3600))
+        self.assertEqual(self.store.status('a'), 'done')
+        self.assertIsNone(self.store.status('b'))
+
+
+class TestClaimStore(unittest.TestCase):
+
+    def test_interface(self):
+        store = ClaimStore()
+        for method, args in (
+                ('claim', ('a', 'w1', NOW, later(60))),
+                ('extend', (['a'], 'w1', later(60))),
+                ('finish', ('a', 'w1', later(60))),
+                ('release', ('a', 'w1')),
+                ('purge', (NOW,)),
+                ('status', ('a',))):
+            with self.assertRaises(NotImplementedError):
+                getattr(store, method)(*args)
+
+
+class TestMemoryClaimStore(ClaimStoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryClaimStore()
+
+
+class TestDatabaseClaimStore(ClaimStoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = DatabaseClaimStore(
+            'sqlite:///' + os.path.join(self.tmpdir, 'claims.db'))
+
+    def tearDown(self):
+        self.store.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_after_fork(self):
+        self.store.claim('a', 'w1', NOW, later(60))
+        with patch.object(self.store.engine, 'dispose') as dispose:
+            _after_fork_dispose_engine(self.store)
+        dispose.assert_called_once_with()
+
+
+class TestClaimStoreFromUrl(unittest.TestCase):
+
+    def test_memory(self):
+        self.assertIsInstance(claim_store_from_url('memory'), MemoryClaimStore)
+
+    def test_database(self):
+        store = claim_store_from_url('sqlite://')
+        self.assertEqual(str(store.engine.url), 'sqlite://')
+
+    def test_result_database(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            imports=(), result_backend=BUFFERED_RESULT_BACKEND + '+sqlite://'))
+        store = claim_store_from_url('', app.backend)
+        self.assertEqual(str(store.engine.url), 'sqlite://')
+        app.backend.close()
+
+    def test_other_backends(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(imports=(), result_backend='rpc://'))
+        with self.assertRaises(ValueError):
+            claim_store_from_url('', app.backend)
+
+
+class TestDeduplicator(unittest.TestCase):
+
+    def test_counters(self):
+        deduplicator = Deduplicator(MemoryClaimStore(), claim_ttl=10)
+        self.assertTrue(deduplicator.claim('a', 'w1'))
+        self.assertFalse(deduplicator.claim('a', 'w2'))
+        self.assertFalse(deduplicator.is_done('a'))
+        self.assertEqual(deduplicator.extend(['a'], 'w1'), 1)
+        deduplicator.finish('a', 'w1')
+        self.assertTrue(deduplicator.is_done('a'))
+        self.assertTrue(deduplicator.claim('b', 'w1'))
+        deduplicator.release('b', 'w1')
+        self.assertEqual(deduplicator.purge(), 0)
+        self.assertEqual(deduplicator.stats(), {
+            'claimed': 2, 'duplicates': 1, 'deferred': 1, 'finished': 1,
+            'released': 1, 'extended': 1, 'errors': 0,
+        })
+
+    @patch('cadasta.workertoolbox.dedup.logger')
+    def test_store_errors(self, logger):
+        store = MagicMock()
+        store.claim.side_effect = store.finish.side_effect = \
+            store.release.side_effect = store.status.side_effect = \
+            IOError('Unreachable')
+        deduplicator = Deduplicator(store)
+        # Executed regardless
+        self.assertTrue(deduplicator.claim('a', 'w1'))
+        deduplicator.finish('a', 'w1')
+        deduplicator.release('a', 'w1')
+        # Deferred
+        self.assertFalse(deduplicator.is_done('a'))
+        self.assertEqual(deduplicator.stats()['errors'], 4)
+        self.assertEqual(logger.warning.call_count, 4)
+
+    def test_app_deduplicator(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            imports=(), DEDUP_STORE='memory', DEDUP_CLAIM_TTL=5))
+        deduplicator = get_deduplicator(app)
+        self.assertIs(get_deduplicator(app), deduplicator)
+        self.assertIsInstance(deduplicator.store, MemoryClaimStore)
+        self.assertEqual(deduplicator.claim_ttl, 5)
+        self.assertEqual(deduplicator.done_ttl, 60 * 60 * 24)
+
+
+class TestDedupTask(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(self.tmpdir, 'results.db')
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            imports=(), broker_transport='memory',
+            broker_transport_options={'polling_interval': 0.01},
+            result_backend=BUFFERED_RESULT_BACKEND + '+' + url,
+            RESULT_BUFFER_MAX_SIZE=1, DEDUP_STORE='memory',
+            TASK_HEARTBEAT_INTERVAL=0.05))
+        self.calls = []
+
+        @self.app.task(base=DedupTask, name='export.run', shared=False,
+                       bind=True)
+        def run(task, n, reject=False, delay=0):
+            self.calls.append(n)
+            if reject:
+                raise Reject(requeue=False)
+            if n < 0:
+                raise ValueError(n)
+            time.sleep(delay)
+            return n
+
+        self.run = run
+        with self.app.connection() as conn:
+            for queue in ('export', 'celery'):
+                conn.SimpleQueue(queue).clear()
+
+    def tearDown(self):
+        self.app.backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def worker(self):
+        return start_worker(
+            self.app, pool='solo', queues=['export', 'celery'],
+            perform_ping_check=False, loglevel='ERROR')
+
+    def test_skips_duplicates(self):
+        with self.worker() as worker:
+            steps = [s for s in worker.consumer.steps
+                     if isinstance(s, TaskHeartbeat)]
+            self.assertEqual(len(steps), 1)
+            first = self.run.apply_async((1,), task_id='dup', countdown=0)
+            self.run.apply_async((2,), task_id='dup')
+            self.assertEqual(first.get(timeout=5), 1)
+            # Rejected messages may be delivered again
+            self.run.apply_async((3, True), task_id='rejected')
+            self.assertEqual(self.run.apply_async(
+                (3,), task_id='rejected').get(timeout=5), 3)
+            with self.assertRaises(ValueError):
+                self.run.delay(-1).get(timeout=5, propagate=True)
+            self.assertEqual(self.run.delay(4, delay=0.3).get(timeout=5), 4)
+        self.assertEqual(self.calls, [1, 3, 3, -1, 4])
+        stats = get_deduplicator(self.app).stats()
+        self.assertEqual(stats['duplicates'], 1)
+        self.assertEqual(stats['released'], 1)
+        self.assertEqual(stats['finished'], 4)
+        self.assertGreater(stats['extended'], 0)
+
+    def test_defers_running_duplicates(self):
+        deduplicator = get_deduplicator(self.app)
+        deduplicator.claim('running', 'elsewhere')
+        with patch.object(Request, 'reject', autospec=True,
+                          side_effect=Request.reject) as reject, \
+                self.worker():
+            self.run.apply_async((1,), task_id='running')
+            self.assertEqual(self.run.delay(2).get(timeout=5), 2)
+        self.assertEqual(self.calls, [2])
+        self.assertEqual(reject.call_count, 1)
+        self.assertEqual(reject.call_args[0][0].id, 'running')
+        self.assertEqual(reject.call_args[1], {'requeue': False})
+        self.assertEqual(deduplicator.stats()['deferred'], 1)
+
+    def test_eager(self):
+        self.assertEqual(self.run.apply((1,), task_id='a').get(), 1)
+        self.assertEqual(self.run(2), 2)
+        self.assertIsNone(getattr(self.app, '_deduplicator', None))
+
+
+def sqs_channel(failed=()):
+    channel = MagicMock()
+    channel._queue_option.return_value = 3600
+    channel.sqs.change_message_visibility_batch.return_value = {
+        'Successful': [], 'Failed': list(failed)}
+    return channel
+
+
+def sqs_message(routing_key='export', channel=None, receipt='receipt'):
+    message = MagicMock(channel=channel or sqs_channel())
+    message.delivery_info = {
+        'routing_key': routing_key, 'sqs_queue': 'https://sqs/export',
+        'sqs_message': {'ReceiptHandle': receipt},
+    }
+    return message
+
+
+class TestTaskHeartbeat(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            imports=(), DEDUP_STORE='memory', TASK_HEARTBEAT_INTERVAL=10))
+        self.consumer = MagicMock(app=self.app, hostname='w1@host')
+        self.step = TaskHeartbeat(self.consumer)
+
+    def dedup_task(self):
+        @self.app.task(base=DedupTask, name='export.dedup', shared=False)
+        def dedup():
+            pass
+        return dedup
+
+    def test_extend_visibility(self):
+        channel = sqs_channel()
+        messages = [sqs_message(channel=channel, receipt=str(i))
+                    for i in range(12)]
+        self.assertEqual(extend_visibility(messages), 12)
+        channel._queue_option.assert_called_with(
+            'export', 'visibility_timeout')
+        batches = channel.sqs.change_message_visibility_batch.call_args_list
+        self.assertEqual([len(c[1]['Entries']) for c in batches], [10, 2])
+        self.assertEqual(batches[1][1], {
+            'QueueUrl': 'https://sqs/export', 'Entries': [
+                {'Id': '10', 'ReceiptHandle': '10', 'VisibilityTimeout': 3600},
+                {'Id': '11', 'ReceiptHandle': '11', 'VisibilityTimeout': 3600},
+            ]})
+
+        # Channels without per-queue options
+        channel = MagicMock(
+            spec=['sqs', 'visibility_timeout'], visibility_timeout=20)
+        channel.sqs.change_message_visibility_batch.return_value = {}
+        self.assertEqual(extend_visibility([sqs_message(channel=channel)]), 1)
+        self.assertEqual(
+            channel.sqs.change_message_visibility_batch.call_args[1]
+            ['Entries'][0]['VisibilityTimeout'], 20)
+
+        self.assertEqual(extend_visibility([MagicMock(delivery_info={})]), 0)
+
+    @patch('cadasta.workertoolbox.dedup.logger')
+    def test_extend_visibility_failures(self, logger):
+        channel = sqs_channel(failed=[{'Id': '0', 'Code': 'ReceiptHandle'}])
+        messages = [sqs_message(channel=channel), sqs_message(channel=channel)]
+        self.assertEqual(extend_visibility(messages), 1)
+        self.assertEqual(logger.warning.call_count, 1)
+
+    def test_start_stop(self):
+        self.step.start(self.consumer)
+        self.assertEqual(
+            [c[0][0] for c in self.consumer.timer.call_repeatedly.call_args_list],
+            [10, 60])
+        timer = self.consumer.timer.call_repeatedly.return_value
+        self.step.stop(self.consumer)
+        self.assertEqual(timer.cancel.call_count, 2)
+        self.assertEqual(self.step.timers, [])
+
+    def test_beat(self):
+        dedup_task = self.dedup_task()
+        deduplicator = get_deduplicator(self.app)
+        deduplicator.claim('a', gethostname())
+        requests = [
+            MagicMock(id='a', task=dedup_task, message=sqs_message()),
+            MagicMock(id='b', task=MagicMock(), message=sqs_message()),
+        ]
+        with patch.object(state, 'active_requests', set(requests)):
+            self.step.beat(self.consumer)
+        self.assertEqual(deduplicator.stats()['extended'], 1)
+        for request in requests:
+            self.assertTrue(request.message.channel.sqs
+                            .change_message_visibility_batch.called)
+        self.step.purge(self.consumer)
+
+    @patch('cadasta.workertoolbox.dedup.logger')
+    def test_errors(self, logger):
+        dedup_task = self.dedup_task()
+        deduplicator = get_deduplicator(self.app)
+        deduplicator.store = MagicMock()
+        deduplicator.store.extend.side_effect = \
+            deduplicator.store.purge.side_effect = IOError('Unreachable')
+        request = MagicMock(id='a', task=dedup_task, message=sqs_message())
+        request.message.channel.sqs.change_message_visibility_batch \
+            .side_effect = IOError('Unreachable')
+        with patch.object(state, 'active_requests', set([request])):
+            self.step.beat(self.consumer)
+        self.step.purge(self.consumer)
+        self.assertEqual(logger.warning.call_count, 3)
+
+    def test_without_dedup_tasks(self):
+        with patch.object(state, 'active_requests', set()):
+            self.step.beat(self.consumer)
+        self.step.purge(self.consumer)
+        self.assertIsNone(getattr(self.app, '_deduplicator', None))
@@ -0,0 +1,239 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from mock import MagicMock, patch
+
+import celery.contrib.testing.tasks  # NOQA: registers celery.ping
+from celery import Celery
+from celery.contrib.testing.worker import start_worker
+
+from cadasta.workertoolbox.blobs import FileSystemBlobStore
+from cadasta.workertoolbox.conf import BUFFERED_RESULT_BACKEND, Config
+from cadasta.workertoolbox.followups import (
+    FOLLOWUPS_HEADER, FollowupStore, get_followup_store,
+    on_before_task_publish, on_task_failure)
+from cadasta.workertoolbox.signals import (
+    connect_followups, disconnect_followups)
+from cadasta.workertoolbox.utils import extract_followups
+
+
+class TestFollowupsByReference(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = self.make_app()
+        self.calls = []
+
+        @self.app.task(bind=True, name='export.hop', shared=False)
+        def hop(task, n):
+            self.calls.append(('hop', n, task.request.callbacks))
+            if n == 'fail':
+                raise ValueError(n)
+            if n:
+                hop.apply_async((n - 1,), **extract_followups(task))
+            return n
+
+        @self.app.task(name='export.done', shared=False)
+        def done(result):
+            self.calls.append(('done', result))
+
+        @self.app.task(name='export.failed', shared=False)
+        def failed(task_id):
+            self.calls.append(('failed', task_id))
+
+        self.hop, self.done, self.failed = hop, done, failed
+
+    def tearDown(self):
+        disconnect_followups()
+        self.app.backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def result_backend(self):
+        return BUFFERED_RESULT_BACKEND + '+sqlite:///' + os.path.join(
+            self.tmpdir, 'results.db')
+
+    def make_app(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            FOLLOWUPS_BY_REFERENCE=True, task_always_eager=True,
+            result_backend=self.result_backend()))
+        return app
+
+    def test_forwards_reference(self):
+        self.hop.apply_async(
+            (3,), link=self.done.s(), link_error=self.failed.s())
+        self.assertEqual(self.calls, [
+            ('hop', 3, [self.done.s()]),
+            ('hop', 2, None),
+            ('hop', 1, None),
+            ('hop', 0, None),
+            ('done', 0),
+        ])
+        # Applied followups are deleted
+        self.assertEqual(len(get_followup_store(self.app)._cache), 0)
+
+    def test_deletes_applied_followups(self):
+        blobs = os.path.join(self.tmpdir, 'blobs')
+        self.app.conf.FOLLOWUP_STORE = 'file://' + blobs
+        listed = []
+
+        @self.app.task(name='export.listed', shared=False)
+        def list_blobs(result):
+            listed.append(os.listdir(blobs))
+
+        # Passed on unchanged, then merged with another callback
+        key = self.save()
+        self.hop.apply(
+            (2,), headers={FOLLOWUPS_HEADER: key},
+            link=list_blobs.s())
+        self.assertEqual(self.calls[-1], ('done', 0))
+        self.assertEqual(len(listed[0]), 2)  # Still in use when applied
+        self.assertEqual(os.listdir(blobs), [])
+
+        result = self.hop.apply(
+            ('fail',), headers={FOLLOWUPS_HEADER: self.save()})
+        self.assertEqual(self.calls[-1], ('failed', result.id))
+        self.assertEqual(os.listdir(blobs), [])
+
+    def test_applies_errbacks(self):
+        result = self.hop.apply(
+            ('fail',), headers={FOLLOWUPS_HEADER: self.save()})
+        self.assertEqual(self.calls[-1], ('failed', result.id))
+
+    def test_merges_inline_followups(self):
+        key = self.save()
+        self.hop.apply(
+            (1,), link=self.done.s(), headers={FOLLOWUPS_HEADER: key})
+        self.assertEqual(self.calls[-2:], [('done', 0), ('done', 0)])
+
+    def test_no_followups(self):
+        self.hop.apply((1,))
+        self.assertEqual(self.calls, [('hop', 1, None), ('hop', 0, None)])
+
+    def test_no_errbacks(self):
+        key = get_followup_store(self.app).save(
+            {'link': [], 'link_error': []})
+        self.hop.apply(('fail',), headers={FOLLOWUPS_HEADER: key})
+        self.assertEqual(len(self.calls), 1)
+
+    def test_ignores_other_failures(self):
+        sender = MagicMock(request=MagicMock(headers=None, spec=['headers']))
+        on_task_failure(sender=sender)
+        self.assertFalse(sender.backend._call_task_errbacks.called)
+
+    def test_inline_by_default(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config())
+        task = MagicMock(app=app, request=MagicMock(
+            callbacks=['a'], errbacks=['b']))
+        self.assertEqual(
+            extract_followups(task), {'link': ['a'], 'link_error': ['b']})
+
+    def save(self):
+        return get_followup_store(self.app).save({
+            'link': [self.done.s()], 'link_error': [self.failed.s()]})
+
+
+class TestRetries(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            imports=(), broker_transport='memory',
+            broker_transport_options={'polling_interval': 0.01},
+            result_backend='cache', cache_backend='memory',
+            FOLLOWUPS_BY_REFERENCE=True,
+            FOLLOWUP_STORE='file://' + self.tmpdir))
+        connect_followups()
+
+    def tearDown(self):
+        disconnect_followups()
+        shutil.rmtree(self.tmpdir)
+
+    def test_retried_task(self):
+        done = threading.Event()
+        attempts = []
+
+        @self.app.task(bind=True, name='export.flaky', shared=False)
+        def flaky(task):
+            attempts.append(task.request.retries)
+            if not task.request.retries:
+                raise task.retry(countdown=0)
+            return 'ok'
+
+        @self.app.task(name='export.done', shared=False)
+        def on_done(result):
+            done.set()
+            return result
+
+        key = get_followup_store(self.app).save(
+            {'link': [on_done.s()], 'link_error': []})
+        with start_worker(self.app, pool='solo', queues=['export'],
+                          perform_ping_check=False, loglevel='ERROR'):
+            flaky.apply_async(
+                queue='export', headers={FOLLOWUPS_HEADER: key})
+            self.assertTrue(done.wait(10))
+        self.assertEqual(attempts, [0, 1])
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_other_messages(self):
+        headers = {'id': '2'}
+        task = MagicMock(request=MagicMock(
+            id='1', spec=['id', FOLLOWUPS_HEADER],
+            **{FOLLOWUPS_HEADER: 'key'}))
+        with patch('cadasta.workertoolbox.followups.current_task', task):
+            on_before_task_publish(headers=headers)
+            on_before_task_publish(body={'id': '2'}, headers={})
+            self.assertEqual(headers, {'id': '2'})
+            headers = {}
+            on_before_task_publish(body={'id': '1'}, headers=headers)
+            self.assertEqual(headers, {FOLLOWUPS_HEADER: 'key'})
+            on_before_task_publish(body={'id': '1'}, headers=headers)
+        on_before_task_publish(headers=None)
+        with patch('cadasta.workertoolbox.followups.current_task', None):
+            on_before_task_publish(headers={'id': '1'})
+
+
+class TestFollowupStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            result_backend=BUFFERED_RESULT_BACKEND + '+sqlite:///' +
+            os.path.join(self.tmpdir, 'results.db')))
+        self.followups = {'link': [{'task': 'export.done'}], 'link_error': []}
+
+    def tearDown(self):
+        self.app.backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_result_backend(self):
+        key = FollowupStore(self.app).save(self.followups)
+        store = FollowupStore(self.app)
+        self.assertEqual(store.load(key), self.followups)
+        self.assertEqual(store.load(key), self.followups)
+        self.assertEqual(store._cache.info()['hits'], 1)
+        with self.assertRaises(KeyError):
+            store.load('followups-missing')
+        store.delete(key)
+        self.assertEqual(len(store._cache), 0)
+        with self.assertRaises(KeyError):
+            store.load(key)
+
+    def test_blob_store(self):
+        blobs = FileSystemBlobStore(self.tmpdir)
+        key = FollowupStore(self.app, blobs).save(self.followups)
+        self.assertEqual(
+            FollowupStore(self.app, blobs).load(key), self.followups)
+
+    def test_configured(self):
+        self.app.conf.FOLLOWUP_STORE = 'file://' + self.tmpdir
+        self.app.conf.FOLLOWUP_CACHE_SIZE = 4
+        store = get_followup_store(self.app)
+        self.assertIs(get_followup_store(self.app), store)
+        self.assertEqual(store.blob_store.path, self.tmpdir)
+        self.assertEqual(store._cache.maxsize, 4)
@@ -1,13 +1,39 @@
+import json
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
 from celery import Celery, signals
+from celery.app import trace
+from celery.exceptions import TimeoutError
+from celery.five import StringIO
+from kombu.serialization import prepare_accept_content
 
-from cadasta.workertoolbox.conf import Config
-from cadasta.workertoolbox.tests import build_functional_tests
+from cadasta.workertoolbox import __version__
+from cadasta.workertoolbox.conf import BUFFERED_RESULT_BACKEND, Config
+from cadasta.workertoolbox.tests import (
+    WORKLOADS, BenchmarkSuite, build_benchmark_suite, build_functional_tests)
 
 
 app = Celery()
 conf = Config(imports=tuple())
 app.config_from_object(conf)
 
+# Kombu shares connections (and so their declared queues) between apps
+# using the same broker, and memory transports share their exchanges
+filtered_app = Celery(set_as_current=False)
+filtered_app.config_from_object(Config(
+    imports=tuple(), broker_transport='memory',
+    task_default_exchange='filtered_exchange',
+    PLATFORM_QUEUE_BINDINGS=('export', 'msg'),
+    PLATFORM_EXCLUDED_TASKS=('celery.chord_unlock', 'export.quiet')))
+
+
+@filtered_app.task(name='export.quiet', shared=False)
+def quiet_export():
+    pass
+
 
 class FunctionalTests(build_functional_tests(app)):
 
@@ -26,3 +52,117 @@ class FunctionalTests(build_functional_tests(app)):
 
         signals.worker_init.send(sender=sender)
         self.assertEqual(my_app.tasks['celery.chord_unlock'].max_retries, 1234)
+
+
+class FilteredPlatformQueueTests(build_functional_tests(filtered_app)):
+
+    def test_chord_unlock_not_mirrored(self):
+        """ Ensure excluded tasks don't reach the platform queue """
+        options = self.app.amqp.router.route({}, 'celery.chord_unlock')
+        self.assertEqual(self.channel._lookup(
+            options['exchange'], options['routing_key']), ['celery'])
+        self.assertEqual(set(self.lookup('celery')), set(['celery']))
+        self.assertEqual(
+            set(self.lookup('export')), set(['export', 'platform.fifo']))
+
+
+class BenchmarkSuiteTests(unittest.TestCase):
+
+    def test_run(self):
+        suite = build_benchmark_suite(
+            filtered_app, tasks=6, chords=2, width=3, chains=2, hops=2)
+        report = suite.run()
+        json.dumps(report)
+        self.assertEqual(report['versions']['workertoolbox'], __version__)
+        self.assertEqual(report['topology']['platform_bindings'],
+                         ['export', 'msg'])
+        self.assertEqual(report['topology']['queues'],
+                         ['msg', 'export', 'celery'])
+        workloads = report['workloads']
+        self.assertEqual(set(workloads), set(WORKLOADS))
+        for name, units in (('fanout', 6), ('chords', 2),
+                            ('followups', 2), ('mixed', 6)):
+            workload = workloads[name]
+            self.assertEqual(workload['units'], units)
+            self.assertEqual(workload['failed'], 0)
+            self.assertGreater(workload['latency_ms']['p50'], 0)
+            self.assertLessEqual(workload['latency_ms']['p99'],
+                                 workload['latency_ms']['max'])
+            self.assertGreater(workload['max_rss_kb'], 0)
+        # Tasks of the celery queue aren't mirrored to the platform queue
+        self.assertEqual(workloads['fanout']['published'], 6)
+        self.assertEqual(workloads['fanout']['mirrored'], 4)
+        # Each chain's hops and callback are published by the worker
+        self.assertEqual(workloads['followups']['published'], 2)
+        self.assertEqual(workloads['followups']['messages'], 8)
+
+    def test_main(self):
+        suite = build_benchmark_suite(app)
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as f:
+            report = suite.main([
+                '--workloads', 'fanout', '--tasks', '2', '--output', f.name])
+            self.assertEqual(json.load(f), report)
+        self.assertEqual(suite.tasks, 2)
+        self.assertEqual(report['workloads']['fanout']['units'], 2)
+        self.assertEqual(report['topology']['result_backend'],
+                         'DatabaseBackend')
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            suite.main(['--workloads', 'mixed', '--tasks', '1'])
+        self.assertIn('"mixed"', stdout.getvalue())
+
+    def test_failed_tasks(self):
+        # A negative runtime fails each task
+        suite = build_benchmark_suite(app, tasks=2, task_ms=-1)
+        workload = suite.run(['fanout'])['workloads']['fanout']
+        self.assertEqual(workload['failed'], 2)
+        self.assertIsNone(workload['latency_ms']['p50'])
+
+    def test_worker_optimizations(self):
+        # As set up by app.Worker(), e.g. for functional tests. Tracing
+        # holds on to the list, so it is changed in place.
+        previous = list(trace._localized)
+        localized = [
+            app._tasks, prepare_accept_content(app.conf.accept_content),
+            'host']
+        trace._localized[:] = localized
+        try:
+            suite = build_benchmark_suite(app, tasks=1)
+            report = suite.run(['fanout'])
+            self.assertEqual(trace._localized, localized)
+            # Restored should the run fail
+            suite = build_benchmark_suite(app, tasks=2, timeout=0)
+            with self.assertRaises(TimeoutError):
+                suite.run(['fanout'])
+            self.assertEqual(trace._localized, localized)
+        finally:
+            trace._localized[:] = previous
+        self.assertEqual(report['workloads']['fanout']['failed'], 0)
+
+    def test_timeout(self):
+        suite = build_benchmark_suite(app, tasks=2, timeout=0)
+        with self.assertRaises(TimeoutError):
+            suite.run(['fanout'])
+
+    def test_result_backend_class(self):
+        buffered_app = Celery(set_as_current=False)
+        buffered_app.config_from_object(Config(
+            imports=tuple(), RESULT_BACKEND_BUFFERED=True))
+        rpc_app = Celery(set_as_current=False)
+        rpc_app.config_from_object(Config(
+            imports=tuple(), result_backend='rpc://'))
+        directory = tempfile.mkdtemp()
+        try:
+            bench_app = BenchmarkSuite(buffered_app).build_app(directory)
+            self.assertEqual(
+                bench_app.conf.result_backend.partition('+')[0],
+                BUFFERED_RESULT_BACKEND)
+            bench_app = BenchmarkSuite(rpc_app).build_app(directory)
+            self.assertEqual(
+                bench_app.conf.result_backend.partition('+')[0], 'db')
+            self.assertEqual(bench_app.conf.broker_transport, 'memory')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_unknown_mix(self):
+        with self.assertRaises(ValueError):
+            build_benchmark_suite(app, mix={'msg': 1, 'unknown': 1})
@@ -0,0 +1,139 @@
+import threading
+import unittest
+from mock import ANY, MagicMock, patch
+
+import celery.contrib.testing.tasks  # NOQA: registers celery.ping
+from celery import Celery
+from celery.contrib.testing.worker import start_worker
+from celery.worker import state
+
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.lanes import (
+    Lane, LaneRequest, LaneStep, lane_options)
+
+
+class TestLaneOptions(unittest.TestCase):
+
+    def test_options(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            imports=(), worker_prefetch_multiplier=2, QUEUE_LANES={
+                'msg': {'concurrency': 4, 'prefetch': 1},
+                'export': {'concurrency': 3},
+                'celery': {},
+            }))
+        self.assertEqual(lane_options(app), {
+            'msg': {'concurrency': 4, 'prefetch': 1},
+            'export': {'concurrency': 3, 'prefetch': 6},
+            'celery': {'concurrency': 1, 'prefetch': 2},
+        })
+        self.assertEqual(lane_options(Celery(set_as_current=False)), {})
+
+    def test_failed_execution(self):
+        request = MagicMock()
+        request.execute.side_effect = RuntimeError('Oops')
+        with patch('cadasta.workertoolbox.lanes.logger') as logger:
+            Lane.execute(request)
+        self.assertTrue(logger.exception.called)
+        request.reject.assert_called_once_with()
+        self.assertNotIn(request, state.active_requests)
+
+
+class TestLanes(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            imports=(), broker_transport='memory',
+            broker_transport_options={'polling_interval': 0.01},
+            result_backend='cache', cache_backend='memory',
+            QUEUE_LANES={
+                'msg': {'concurrency': 2},
+                'export': {'concurrency': 1, 'prefetch': 1},
+            }))
+        self.sent = threading.Event()
+
+        @self.app.task(name='export.wait', shared=False)
+        def wait():
+            # Only completes if msg tasks are executed meanwhile
+            return self.sent.wait(5)
+
+        @self.app.task(name='msg.send', shared=False)
+        def send():
+            self.sent.set()
+            return 'sent'
+
+        self.wait, self.send = wait, send
+        with self.app.connection() as conn:
+            for queue in ('msg', 'export', 'celery'):
+                conn.SimpleQueue(queue).clear()
+
+    def worker(self, queues=('msg', 'export', 'celery')):
+        return start_worker(
+            self.app, pool='solo', queues=list(queues),
+            perform_ping_check=False, loglevel='ERROR')
+
+    def queue_size(self, name):
+        with self.app.connection() as conn:
+            return conn.SimpleQueue(name).qsize()
+
+    def run_tasks(self):
+        waited = self.wait.delay()
+        sent = self.send.delay()
+        self.assertEqual(sent.get(timeout=5), 'sent')
+        self.assertTrue(waited.get(timeout=10))
+
+    def test_lanes_execute_concurrently(self):
+        with self.worker() as worker:
+            steps = [s for s in worker.consumer.steps
+                     if isinstance(s, LaneStep)]
+            self.assertEqual(
+                [repr(lane) for lane in steps[0].lanes],
+                ['<Lane: export concurrency=1 prefetch=1>',
+                 '<Lane: msg concurrency=2 prefetch=8>'])
+            self.assertNotIn('msg', self.app.amqp.queues.consume_from)
+            self.run_tasks()
+        # Messages were acknowledged
+        self.assertEqual(self.queue_size('msg'), 0)
+        self.assertEqual(self.queue_size('export'), 0)
+
+    def test_worker_state(self):
+        active = []
+
+        @self.app.task(bind=True, name='msg.active', shared=False)
+        def active_requests(task):
+            active.extend(
+                (type(request), request.id)
+                for request in state.active_requests)
+            return task.request.id
+
+        with patch('cadasta.workertoolbox.lanes.logger') as logger:
+            self.app.conf.task_soft_time_limit = 60
+            with self.worker():
+                task_id = active_requests.delay().get(timeout=5)
+        self.assertEqual(active, [(LaneRequest, task_id)])
+        self.assertNotIn(task_id, state.requests)
+        self.assertEqual(len(state.active_requests), 0)
+        self.assertEqual(len(state.reserved_requests), 0)
+        logger.warning.assert_called_with(
+            "Time limits aren't enforced by %r", ANY)
+
+    def test_protocol_1(self):
+        self.app.conf.task_protocol = 1
+        with self.worker():
+            self.run_tasks()
+
+    def test_unconsumed_queues(self):
+        with self.worker(queues=['export', 'celery']) as worker:
+            steps = [s for s in worker.consumer.steps
+                     if isinstance(s, LaneStep)]
+            self.assertEqual(
+                [lane.queue.name for lane in steps[0].lanes], ['export'])
+
+    @patch('cadasta.workertoolbox.lanes.logger')
+    def test_unregistered_tasks(self, logger):
+        with self.worker():
+            self.app.send_task('msg.unknown')
+            self.send.delay().get(timeout=5)
+        self.assertTrue(logger.error.called)
+        self.assertEqual(self.queue_size('msg'), 0)
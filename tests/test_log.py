@@ -0,0 +1,126 @@
+import logging
+import multiprocessing
+import os
+import unittest
+from mock import patch, MagicMock
+
+from kombu.five import Queue
+
+from cadasta.workertoolbox import log
+from cadasta.workertoolbox.conf import Config
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_logger(name):
+    logger = logging.getLogger('test_log.' + name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = RecordingHandler()
+    logger.handlers = [handler]
+    return logger, handler
+
+
+def log_from_child(logger):
+    logger.info('from %s', 'child')
+
+
+class TestQueueHandler(unittest.TestCase):
+
+    def test_prepare(self):
+        queue = Queue()
+        logger = logging.getLogger('test_log.prepare')
+        logger.propagate = False
+        logger.handlers = [log.QueueHandler(queue)]
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.error('failed %s', 'task', exc_info=True)
+        record = queue.get_nowait()
+        self.assertEqual(record.msg, 'failed task')
+        self.assertIsNone(record.args)
+        self.assertIsNone(record.exc_info)
+        self.assertIn('ValueError: boom', record.exc_text)
+
+    def test_dropped_when_full(self):
+        handler = log.QueueHandler(Queue(1))
+        record = logging.makeLogRecord({'msg': 'foo'})
+        handler.emit(record)
+        handler.emit(record)
+        self.assertEqual(handler.dropped, 1)
+
+    def test_error(self):
+        queue = MagicMock()
+        queue.put_nowait.side_effect = RuntimeError
+        handler = log.QueueHandler(queue)
+        with patch.object(handler, 'handleError') as handle_error:
+            handler.emit(logging.makeLogRecord({'msg': 'foo'}))
+        self.assertTrue(handle_error.called)
+
+
+class TestQueueListener(unittest.TestCase):
+
+    def test_batches(self):
+        queue = Queue()
+        debug, info = RecordingHandler(), RecordingHandler(logging.INFO)
+        listener = log.QueueListener(queue, [debug, info], batch_size=2)
+        for level in (logging.DEBUG, logging.INFO, logging.INFO):
+            queue.put(logging.makeLogRecord({'levelno': level}))
+        self.assertEqual(len(listener._batch()), 2)
+        self.assertEqual(len(listener._batch()), 1)
+
+        listener.start()
+        queue.put(logging.makeLogRecord({'levelno': logging.DEBUG}))
+        queue.put(logging.makeLogRecord({'levelno': logging.INFO}))
+        listener.stop()
+        self.assertEqual(len(debug.records), 2)
+        self.assertEqual(len(info.records), 1)
+
+    def test_stop_not_started(self):
+        listener = log.QueueListener(MagicMock(), [])
+        listener.stop()
+        self.assertFalse(listener.queue.put.called)
+
+    def test_stop_in_child(self):
+        listener = log.QueueListener(Queue(), [])
+        listener.start()
+        self.addCleanup(listener.stop)
+        with patch('cadasta.workertoolbox.log.os.getpid', return_value=-1):
+            listener.stop()
+        self.assertTrue(listener._thread.is_alive())
+
+
+class TestSetupQueueLogging(unittest.TestCase):
+
+    def test_forked_processes(self):
+        logger, handler = make_logger('forked')
+        listener = log.setup_queue_logging(logger)
+        self.assertIsInstance(logger.handlers[0], log.QueueHandler)
+
+        child = multiprocessing.Process(target=log_from_child, args=(logger,))
+        child.start()
+        child.join()
+        logger.info('from parent')
+        listener.stop()
+
+        self.assertEqual(
+            sorted(r.getMessage() for r in handler.records),
+            ['from child', 'from parent'])
+        self.assertNotEqual(
+            set(r.process for r in handler.records), set([os.getpid()]))
+
+    @patch('cadasta.workertoolbox.log.setup_queue_logging')
+    def test_config(self, setup_queue_logging):
+        conf = Config(QUEUE_LOGGING=True, LOG_QUEUE_SIZE=5)
+        conf.setup_file_logging(
+            {'version': 1, 'disable_existing_loggers': False})
+        setup_queue_logging.assert_called_once_with(queue_size=5)
+        self.assertEqual(conf._log_listener, setup_queue_logging.return_value)
@@ -0,0 +1,216 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from mock import MagicMock, patch
+
+import sqlalchemy as sa
+from celery import Celery, beat, states
+from celery.backends.database.models import Task, TaskSet
+from celery.signals import beat_init
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateIndex
+
+from cadasta.workertoolbox import maintenance
+from cadasta.workertoolbox import signals  # NOQA: connects beat_init
+from cadasta.workertoolbox.conf import BUFFERED_RESULT_BACKEND, Config
+from cadasta.workertoolbox.setup import schedule_result_purge
+
+NOW = datetime(2018, 6, 1)
+
+
+class PurgeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.tmpdir, 'results.db')
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            imports=(), broker_transport='memory', RESULT_PURGE_INTERVAL=600,
+            result_backend=BUFFERED_RESULT_BACKEND + '+' + self.url))
+        self.backend = self.app.backend
+        self.engine = self.backend.engine
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def add_tasks(self, state, age, count=1, now=NOW):
+        with self.engine.begin() as conn:
+            conn.execute(Task.__table__.insert(), [{
+                'task_id': '{}-{}-{}'.format(state, age, i),
+                'status': state,
+                'date_done': now - timedelta(seconds=age),
+            } for i in range(count)])
+
+    def add_groups(self, age, count=1):
+        with self.engine.begin() as conn:
+            conn.execute(TaskSet.__table__.insert(), [{
+                'taskset_id': 'group-{}-{}'.format(age, i),
+                'date_done': NOW - timedelta(seconds=age),
+            } for i in range(count)])
+
+    def count(self, table, *criteria):
+        query = sa.select([sa.func.count()]).select_from(table.__table__)
+        for where in criteria:
+            query = query.where(where)
+        with self.engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+
+class TestPurgeExpiredResults(PurgeTestCase):
+
+    def test_purges_expired_rows(self):
+        self.add_tasks(states.SUCCESS, 7200, 5)
+        self.add_tasks(states.SUCCESS, 60, 2)
+        self.add_groups(7200, 3)
+        self.add_groups(60)
+        report = maintenance.purge_expired_results(
+            self.backend, timedelta(hours=1), batch_size=2, now=NOW)
+        self.assertEqual(report['tasks'], 5)
+        self.assertEqual(report['groups'], 3)
+        self.assertGreaterEqual(report['seconds'], 0)
+        self.assertEqual(self.count(Task), 2)
+        self.assertEqual(self.count(TaskSet), 1)
+
+    def test_expiry_policy(self):
+        self.add_tasks(states.SUCCESS, 7200, 2)
+        self.add_tasks(states.FAILURE, 7200, 2)
+        self.add_tasks(states.FAILURE, 86400 * 8)
+        self.add_tasks(states.REVOKED, 86400 * 30)
+        report = maintenance.purge_expired_results(
+            self.backend, 3600, batch_size=10, now=NOW, policy={
+                states.FAILURE: timedelta(days=7), states.REVOKED: None})
+        self.assertEqual(report['tasks'], 3)
+        self.assertEqual(
+            self.count(Task, Task.status == states.FAILURE), 2)
+        self.assertEqual(
+            self.count(Task, Task.status == states.REVOKED), 1)
+
+    def test_expiry_policy_only(self):
+        self.add_tasks(states.SUCCESS, 7200)
+        self.add_tasks(states.FAILURE, 7200)
+        self.add_groups(7200)
+        report = maintenance.purge_expired_results(
+            self.backend, None, policy={states.FAILURE: 60}, now=NOW)
+        self.assertEqual(report['tasks'], 1)
+        self.assertEqual(report['groups'], 0)
+        self.assertEqual(self.count(Task), 1)
+
+    def test_batches_commit_separately(self):
+        self.add_tasks(states.SUCCESS, 7200, 5)
+        session = self.backend.ResultSession()
+        with patch.object(self.backend, 'ResultSession',
+                          return_value=session):
+            with patch.object(session, 'commit',
+                              wraps=session.commit) as commit:
+                maintenance.purge_expired_results(
+                    self.backend, 3600, batch_size=2, now=NOW)
+        # 3 batches of tasks (2, 2, 1) and 1 of groups
+        self.assertEqual(commit.call_count, 4)
+
+
+class TestResultIndexes(PurgeTestCase):
+
+    def index_names(self):
+        return (
+            maintenance._index_names(self.engine, 'celery_taskmeta') |
+            maintenance._index_names(self.engine, 'celery_tasksetmeta'))
+
+    def test_creates_missing_indexes(self):
+        maintenance.ensure_result_indexes(self.backend)
+        names = [index.name for index in maintenance.RESULT_INDEXES]
+        self.assertTrue(set(names) <= self.index_names())
+
+        maintenance.RESULT_INDEXES[0].drop(self.engine)
+        self.assertEqual(
+            maintenance.ensure_result_indexes(self.backend), names[:1])
+        self.assertEqual(maintenance.ensure_result_indexes(self.backend), [])
+
+    def test_concurrently_created_index(self):
+        index = maintenance.RESULT_INDEXES[0]
+        index.drop(self.engine)
+        error = OperationalError('CREATE INDEX', {}, Exception('exists'))
+
+        def create_concurrently(conn):
+            index.create(self.engine)
+            raise error
+
+        with patch('cadasta.workertoolbox.maintenance._concurrent_index') \
+                as concurrent_index:
+            concurrent_index.return_value.create.side_effect = \
+                create_concurrently
+            self.assertEqual(
+                maintenance.ensure_result_indexes(self.backend), [])
+            index.drop(self.engine)
+            concurrent_index.return_value.create.side_effect = error
+            with self.assertRaises(OperationalError):
+                maintenance.ensure_result_indexes(self.backend)
+
+    def test_created_concurrently(self):
+        index = maintenance.RESULT_INDEXES[1]
+        dialect = postgresql.dialect()
+        self.assertEqual(
+            str(CreateIndex(maintenance._concurrent_index(index))
+                .compile(dialect=dialect)),
+            'CREATE INDEX CONCURRENTLY ix_celery_taskmeta_date_done '
+            'ON celery_taskmeta (date_done)')
+        # Indexes created along with the tables are left as they are
+        self.assertNotIn(
+            'CONCURRENTLY', str(CreateIndex(index).compile(dialect=dialect)))
+
+
+class TestResultMaintenance(PurgeTestCase):
+
+    def test_disabled_by_default(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(imports=()))
+        self.assertEqual(app.conf.RESULT_PURGE_INTERVAL, 0)
+        schedule_result_purge(app)
+        self.assertNotIn(maintenance.PURGE_TASK_NAME, app.tasks)
+
+    def test_registers_periodic_task(self):
+        schedule_result_purge(self.app)
+        entry = self.app.conf.beat_schedule['celery.backend_cleanup']
+        self.assertEqual(entry['task'], maintenance.PURGE_TASK_NAME)
+        self.assertEqual(entry['schedule'], 600)
+        # Routed to the default 'celery' queue
+        self.assertEqual(
+            self.app.amqp.router.route(
+                {}, maintenance.PURGE_TASK_NAME)['routing_key'], 'celery')
+        schedule_result_purge(self.app)  # Registered once
+
+        self.add_tasks(states.SUCCESS, 86400 * 2, now=datetime.utcnow())
+        self.add_tasks(states.SUCCESS, 0, now=datetime.utcnow())
+        self.app.conf.RESULT_EXPIRY_POLICY = {states.FAILURE: None}
+        result = self.app.tasks[maintenance.PURGE_TASK_NAME].apply()
+        self.assertEqual(result.result['tasks'], 1)
+        self.assertEqual(self.count(Task), 1)
+
+    def test_schedules_in_beat(self):
+        service = beat.Service(self.app, scheduler_cls=beat.Scheduler)
+        self.assertEqual(
+            service.scheduler.schedule['celery.backend_cleanup'].task,
+            'celery.backend_cleanup')
+        beat_init.send(sender=service)
+        entry = service.scheduler.schedule['celery.backend_cleanup']
+        self.assertEqual(entry.task, maintenance.PURGE_TASK_NAME)
+        self.assertEqual(entry.schedule.run_every.total_seconds(), 600)
+
+        # Disabled
+        self.app.conf.RESULT_PURGE_INTERVAL = 0
+        service = MagicMock(app=self.app)
+        beat_init.send(sender=service)
+        self.assertFalse(service.scheduler.update_from_dict.called)
+
+    @patch('cadasta.workertoolbox.maintenance.logger')
+    def test_ignores_other_backends(self, logger):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            imports=(), RESULT_PURGE_INTERVAL=600, result_backend='cache',
+            cache_backend='memory'))
+        self.assertIsNone(maintenance.setup_result_maintenance(app))
+        self.assertNotIn(maintenance.PURGE_TASK_NAME, app.tasks)
+        self.assertTrue(logger.warning.called)
@@ -0,0 +1,257 @@
+import os
+import socket
+import time
+import unittest
+from mock import patch, MagicMock
+
+import celery.contrib.testing.tasks  # NOQA: registers celery.ping
+from celery import Celery
+from celery.contrib.testing.worker import start_worker
+
+from cadasta.workertoolbox import metrics
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.signals import disconnect_task_metrics
+
+
+def make_task(name='export.task', routing_key='export', **request):
+    task = MagicMock()
+    task.name = name
+    task.request = MagicMock(
+        spec=['delivery_info'] + list(request),
+        delivery_info={'routing_key': routing_key}, **request)
+    return task
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        hist = metrics.Histogram(buckets=(1, 2, 3))
+        for value in (0.5, 1, 1.5, 10):
+            hist.observe(value)
+        self.assertEqual(hist.counts, [2, 1, 0, 1])
+        self.assertEqual(hist.count, 4)
+        self.assertEqual(hist.sum, 13)
+
+    def test_quantile(self):
+        hist = metrics.Histogram(buckets=(1, 2, 3))
+        self.assertIsNone(hist.quantile(0.5))
+        for value in (0.5, 1.5, 1.5, 2.5):
+            hist.observe(value)
+        self.assertEqual(hist.quantile(0.5), 2)
+        self.assertEqual(hist.quantile(1), 3)
+        hist.observe(10)
+        self.assertEqual(hist.quantile(1), float('inf'))
+
+    def test_snapshot(self):
+        hist = metrics.Histogram(buckets=(1, 2))
+        hist.observe(1.5)
+        snapshot = hist.snapshot()
+        self.assertEqual(
+            snapshot['buckets'], [(1, 0), (2, 1), (float('inf'), 1)])
+        self.assertEqual(snapshot['p99'], 2)
+
+
+class TestTaskMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.TaskMetrics(queues=['export'])
+
+    def test_publish(self):
+        headers = {}
+        self.metrics.on_before_task_publish(
+            sender='export.task', routing_key='export', headers=headers)
+        self.metrics.on_before_task_publish(
+            sender='foo.task', routing_key='foo')
+        self.assertIn(metrics.PUBLISH_HEADER, headers)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['queue']['export']['published'], 1)
+        self.assertEqual(snapshot['queue'][metrics.OTHER]['published'], 1)
+        self.assertEqual(snapshot['task']['foo.task']['published'], 1)
+
+    def test_run(self):
+        task = make_task(published_at=time.time() - 0.2)
+        self.metrics.on_task_prerun(task_id='1', task=task)
+        self.metrics.on_task_postrun(task_id='1', task=task, state='SUCCESS')
+        snapshot = self.metrics.snapshot()
+        for series in (snapshot['queue']['export'],
+                       snapshot['task']['export.task']):
+            self.assertEqual(series['succeeded'], 1)
+            self.assertEqual(series['wait']['count'], 1)
+            self.assertGreaterEqual(series['wait']['sum'], 0.2)
+            self.assertEqual(series['runtime']['count'], 1)
+        self.assertEqual(self.metrics._started, {})
+
+    def test_run_without_publish_header(self):
+        task = make_task()
+        self.metrics.on_task_prerun(task_id='1', task=task)
+        self.metrics.on_task_postrun(task_id='2', task=task, state='FAILURE')
+        series = self.metrics.snapshot()['queue']['export']
+        self.assertEqual(series['wait']['count'], 0)
+        self.assertEqual(series['runtime']['count'], 0)
+        self.assertEqual(series['succeeded'], 0)
+
+    def test_retry_and_failure(self):
+        task = make_task()
+        self.metrics.on_task_retry(sender=task, request=task.request)
+        self.metrics.on_task_failure(sender=task)
+        series = self.metrics.snapshot()['task']['export.task']
+        self.assertEqual(series['retried'], 1)
+        self.assertEqual(series['failed'], 1)
+
+    @patch('cadasta.workertoolbox.metrics.MAX_TASK_NAMES', 1)
+    def test_task_name_limit(self):
+        for name in ('a.task', 'b.task', 'c.task'):
+            self.metrics.on_before_task_publish(sender=name)
+        self.assertEqual(
+            sorted(self.metrics.tasks), [metrics.OTHER, 'a.task'])
+        self.assertEqual(
+            self.metrics.tasks[metrics.OTHER].counters['published'], 2)
+
+
+class TestListen(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.TaskMetrics(queues=['export'])
+        self.addCleanup(self.metrics.stop)
+
+    def run_task(self, task_id):
+        task = make_task(published_at=time.time())
+        self.metrics.on_task_prerun(task_id=task_id, task=task)
+        self.metrics.on_task_postrun(
+            task_id=task_id, task=task, state='SUCCESS')
+
+    def test_aggregates_forked_processes(self):
+        listener = self.metrics.listen()
+        self.assertIs(self.metrics.listen(), listener)
+        self.assertTrue(listener.is_alive())
+        with patch('os.getpid', return_value=os.getpid() + 1):
+            self.run_task('1')
+            self.assertEqual(self.metrics._started, {})
+            # Observations are dropped while the queue is full
+            queue = self.metrics._queue
+            with patch.object(queue, 'put_nowait', side_effect=metrics.Full):
+                self.run_task('2')
+        self.assertEqual(self.metrics.dropped, 3)
+        self.metrics.stop()
+        self.assertFalse(listener.is_alive())
+        series = self.metrics.snapshot()['queue']['export']
+        self.assertEqual(series['wait']['count'], 1)
+        self.assertEqual(series['runtime']['count'], 1)
+        self.assertEqual(series['succeeded'], 1)
+
+        # Observations of the listening process are applied at once
+        self.metrics.stop()
+        self.metrics.listen()
+        self.run_task('3')
+        self.assertEqual(
+            self.metrics.snapshot()['queue']['export']['succeeded'], 2)
+
+
+class TestExporters(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.TaskMetrics(queues=['export'])
+        task = make_task(published_at=time.time())
+        self.metrics.on_task_prerun(task_id='1', task=task)
+        self.metrics.on_task_postrun(task_id='1', task=task, state='SUCCESS')
+
+    def test_prometheus_text(self):
+        text = metrics.prometheus_text(self.metrics.snapshot())
+        self.assertIn('# TYPE cadasta_task_wait_seconds histogram\n', text)
+        self.assertIn(
+            'cadasta_task_runtime_seconds_bucket{queue="export",le="+Inf"} 1',
+            text)
+        self.assertIn(
+            'cadasta_task_runtime_seconds_count{task="export.task"} 1', text)
+        self.assertIn(
+            'cadasta_task_succeeded_total{task="export.task"} 1', text)
+
+    def test_statsd_lines(self):
+        lines = metrics.statsd_lines(self.metrics.snapshot())
+        self.assertIn('cadasta.tasks.task.export_task.succeeded:1|g', lines)
+        self.assertIn('cadasta.tasks.queue.export.runtime.p50:5|g', lines)
+        self.assertNotIn('cadasta.tasks.queue.__other__.wait.p50', lines)
+
+    def test_statsd_exporter(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+
+        exporter = metrics.StatsdExporter(
+            self.metrics, *server.getsockname())
+        self.addCleanup(exporter.close)
+        with patch.object(metrics.StatsdExporter, 'MAX_DATAGRAM', 200):
+            sent = exporter.export()
+
+        received = [server.recv(65535).decode('utf-8') for i in range(sent)]
+        self.assertGreater(sent, 1)
+        self.assertTrue(all(len(d) <= 200 for d in received))
+        self.assertEqual(
+            '\n'.join(received).split('\n'),
+            metrics.statsd_lines(self.metrics.snapshot()))
+
+
+class TestSetupTaskMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        disconnect_task_metrics()
+
+    def test_signals(self):
+        conf = Config(
+            imports=(), broker_url='memory://', broker_transport='memory',
+            QUEUES=('export',), SETUP_TASK_METRICS=True)
+        task_metrics = conf.TASK_METRICS
+        self.assertEqual(
+            sorted(task_metrics.queues), [metrics.OTHER, 'celery', 'export'])
+
+        app = Celery(set_as_current=False)
+        app.config_from_object(conf)
+
+        @app.task(name='export.add')
+        def add(x, y):
+            return x + y
+
+        with app.connection() as conn:
+            add.apply_async((1, 2), connection=conn)
+        add.apply((1, 2))
+
+        snapshot = task_metrics.snapshot()
+        self.assertEqual(snapshot['queue']['export']['published'], 1)
+        self.assertEqual(snapshot['task']['export.add']['published'], 1)
+        self.assertEqual(snapshot['task']['export.add']['succeeded'], 1)
+
+    def test_prefork_worker(self):
+        conf = Config(
+            imports=(), broker_url='memory://', broker_transport='memory',
+            result_backend='cache+memory://', QUEUES=('export',),
+            SETUP_TASK_METRICS=True, METRICS_QUEUE_SIZE=100)
+        task_metrics = conf.TASK_METRICS
+        self.assertEqual(task_metrics.queue_size, 100)
+        app = Celery(set_as_current=False)
+        app.config_from_object(conf)
+
+        @app.task(name='export.pid')
+        def pid():
+            return os.getpid()
+
+        with start_worker(app, pool='prefork', concurrency=2,
+                          queues=['export'], perform_ping_check=False,
+                          loglevel='ERROR'):
+            for _ in range(4):
+                pid.apply_async(queue='export', routing_key='export')
+            # Tasks run in pool processes, and are counted by this one
+            for _ in range(300):
+                series = task_metrics.snapshot()['task']['export.pid']
+                if series['succeeded'] == 4:
+                    break
+                time.sleep(0.1)
+        self.addCleanup(task_metrics.stop)
+        self.assertEqual(series['published'], 4)
+        self.assertEqual(series['succeeded'], 4)
+        self.assertEqual(series['wait']['count'], 4)
+        self.assertEqual(series['runtime']['count'], 4)
+
+    def test_disabled(self):
+        conf = Config(imports=())
+        self.assertFalse(hasattr(conf, 'TASK_METRICS'))
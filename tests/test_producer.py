@@ -0,0 +1,157 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock, patch
+
+from celery import Celery
+from celery.result import AsyncResult
+from sqlalchemy.pool import NullPool
+
+from cadasta.workertoolbox.conf import BUFFERED_RESULT_BACKEND, Config
+from cadasta.workertoolbox.producer import (
+    setup_producer, _after_fork_reset_pools, _engine_pool_stats,
+    _register_after_fork)
+
+
+def publish_from_child(app, results):
+    """ Publish a task and store its result from a forked child """
+    producer_pools = app.producer_pools
+    try:
+        result = app.send_task('export.project', args=(os.getpid(),))
+        app.backend.store_result(result.id, os.getpid(), 'SUCCESS')
+        results.put((result.id, producer_pools.stats()))
+    except Exception as e:
+        results.put((None, repr(e)))
+
+
+class TestProducerPools(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.tmpdir, 'results.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_app(self, result_backend=None, **kw):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            imports=(), broker_transport='memory', DECLARATION_CACHE_FILE='',
+            DECLARATION_CONCURRENCY=1, broker_pool_limit=4,
+            result_backend=result_backend or 'db+' + self.url, **kw))
+        return app
+
+    def test_setup_producer(self):
+        app = self.make_app(PRODUCER_WARM_CONNECTIONS=2)
+        producer_pools = setup_producer(app)
+        self.assertIs(app.producer_pools, producer_pools)
+        self.assertTrue(app.is_set_up)
+        stats = producer_pools.stats()
+        self.assertEqual(stats['pid'], os.getpid())
+        self.assertEqual(stats['warmed'], 2)
+        self.assertEqual(stats['broker'], {
+            'limit': 4, 'in_use': 0, 'utilisation': 0})
+        self.assertEqual(stats['producers']['in_use'], 0)
+        self.assertEqual(stats['result_backend'], {
+            'size': 5, 'idle': 2, 'in_use': 0, 'overflow': 0,
+            'max_overflow': 10, 'utilisation': 0})
+
+        with app.producer_or_acquire():
+            stats = producer_pools.stats()
+            self.assertEqual(stats['producers']['in_use'], 1)
+            self.assertEqual(stats['broker']['utilisation'], 0.25)
+
+        # Results are read through the pooled engine
+        result = app.send_task('export.project')
+        app.backend.store_result(result.id, 1, 'SUCCESS')
+        self.assertEqual(AsyncResult(result.id, app=app).get(), 1)
+        engine = producer_pools.engine
+        self.assertIs(engine, producer_pools.engine)
+        with engine.connect():
+            self.assertEqual(
+                producer_pools.stats()['result_backend']['in_use'], 1)
+
+    def test_unbounded_result_database_pool(self):
+        app = self.make_app(RESULT_DB_POOL_SIZE=0)
+        producer_pools = setup_producer(app, warm=False)
+        engine = producer_pools.engine
+        with engine.connect():
+            stats = producer_pools.stats()['result_backend']
+        self.assertEqual(stats['size'], 0)
+        self.assertEqual(stats['in_use'], 1)
+        self.assertIsNone(stats['utilisation'])
+        self.assertIsNone(_engine_pool_stats(NullPool(MagicMock())))
+
+    def test_warm_without_result_database(self):
+        app = self.make_app(result_backend='rpc://')
+        producer_pools = setup_producer(app, warm=False)
+        self.assertEqual(producer_pools.stats()['warmed'], 0)
+        self.assertEqual(producer_pools.warm(10), 4)  # At most the limit
+        self.assertIsNone(producer_pools.stats()['result_backend'])
+
+    def test_buffered_backend(self):
+        app = self.make_app(
+            result_backend=BUFFERED_RESULT_BACKEND + '+' + self.url)
+        producer_pools = setup_producer(app)
+        self.assertIs(producer_pools.engine, app.backend.engine)
+        self.assertEqual(producer_pools.stats()['result_backend']['idle'], 1)
+        engine = app.backend.engine
+        producer_pools.reset()
+        self.assertIsNot(app.backend.engine, engine)
+        app.backend.close()
+
+    def test_reset(self):
+        app = self.make_app()
+        producer_pools = setup_producer(app)
+        pool, engine = app.pool, producer_pools.engine
+        after_fork = MagicMock()
+        app.on_after_fork.connect(after_fork, weak=False)
+        _after_fork_reset_pools(producer_pools)
+        self.assertIsNot(app.pool, pool)
+        self.assertIsNot(producer_pools.engine, engine)
+        self.assertEqual(producer_pools.stats()['warmed'], 0)
+        after_fork.assert_called_once_with(
+            signal=app.on_after_fork, sender=app)
+
+    def test_register_at_fork(self):
+        obj, called = type('Pools', (object,), {})(), []
+        with patch('os.register_at_fork', create=True) as register_at_fork:
+            _register_after_fork(obj, lambda obj: called.append(id(obj)))
+        after_in_child = register_at_fork.call_args[1]['after_in_child']
+        after_in_child()
+        self.assertEqual(called, [id(obj)])
+        # Objects aren't kept alive for children
+        del obj
+        after_in_child()
+        self.assertEqual(len(called), 1)
+
+    def test_forked_children(self):
+        app = self.make_app()
+        producer_pools = setup_producer(app)
+        results = multiprocessing.Queue()
+        children = [
+            multiprocessing.Process(
+                target=publish_from_child, args=(app, results))
+            for _ in range(4)
+        ]
+        for child in children:
+            child.start()
+        published = [results.get(timeout=30) for _ in children]
+        for child in children:
+            child.join(30)
+            self.assertEqual(child.exitcode, 0)
+
+        pids = set(child.pid for child in children)
+        for task_id, stats in published:
+            self.assertIsNotNone(task_id, stats)
+            # Each child opened its own pools, and returned its connections
+            self.assertIn(stats['pid'], pids)
+            self.assertEqual(stats['warmed'], 0)
+            self.assertEqual(stats['broker']['in_use'], 0)
+            self.assertEqual(stats['result_backend']['in_use'], 0)
+            self.assertEqual(stats['result_backend']['idle'], 1)
+            self.assertEqual(
+                AsyncResult(task_id, app=app).get(), stats['pid'])
+        self.assertEqual(producer_pools.stats()['pid'], os.getpid())
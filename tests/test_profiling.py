@@ -0,0 +1,242 @@
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from mock import MagicMock, patch
+
+from celery import Celery
+
+from cadasta.workertoolbox.conf import PROFILE_CLOCKS, Config
+from cadasta.workertoolbox.profiling import (
+    DEFAULT_DIRECTORY, ProfileRing, StackSampler, TaskProfiler)
+from cadasta.workertoolbox.signals import disconnect_task_profiler
+
+
+def busy(seconds):
+    """ Spin for 'seconds' of CPU time """
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(range(100))
+
+
+class TestStackSampler(unittest.TestCase):
+
+    def test_sample(self):
+        sampler = StackSampler(interval=0.001)
+        previous = signal.getsignal(signal.SIGPROF)
+        self.assertTrue(sampler.start())
+        busy(0.1)
+        samples = sampler.stop()
+        self.assertGreater(samples, 0)
+        self.assertEqual(signal.getsignal(signal.SIGPROF), previous)
+        lines = sampler.collapsed().splitlines()
+        self.assertEqual(sum(int(l.rsplit(' ', 1)[1]) for l in lines), samples)
+        self.assertTrue(any(
+            'test_profiling.py:test_sample;' in l and ':busy' in l
+            for l in lines))
+        # Stopping again takes no more samples
+        self.assertEqual(sampler.stop(), samples)
+
+    def test_wall_clock(self):
+        sampler = StackSampler(interval=0.001, clock='wall')
+        self.assertTrue(sampler.start())
+        time.sleep(0.05)
+        self.assertGreater(sampler.stop(), 0)
+        self.assertIn(':test_wall_clock', sampler.collapsed())
+
+    def test_system_calls_restarted(self):
+        sampler = StackSampler(interval=0.001, clock=PROFILE_CLOCKS[-1])
+        with patch('signal.siginterrupt',
+                   wraps=signal.siginterrupt) as siginterrupt:
+            self.assertTrue(sampler.start())
+        siginterrupt.assert_called_once_with(
+            getattr(signal, sampler.signal), False)
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        sender = threading.Timer(0.1, server.send, (b'x',))
+        sender.start()
+        started = time.time()
+        self.assertEqual(client.recv(1), b'x')
+        elapsed = time.time() - started
+        sampler.stop()
+        sender.join()
+        self.assertGreaterEqual(elapsed, 0.09)
+
+    def test_not_main_thread(self):
+        sampler = StackSampler()
+        started = []
+        thread = threading.Thread(
+            target=lambda: started.append(sampler.start()))
+        thread.start()
+        thread.join()
+        self.assertEqual(started, [False])
+        self.assertEqual(sampler.stop(), 0)
+
+    def test_no_interval_timers(self):
+        sampler = StackSampler()
+        with patch('cadasta.workertoolbox.profiling.signal', object()):
+            self.assertFalse(sampler.start())
+
+
+class TestProfileRing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, 'profiles')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_write(self):
+        ring = ProfileRing(self.directory)
+        path = ring.write('export.project', 'abc-123', 'a;b 1\n')
+        self.assertEqual(os.path.dirname(path), self.directory)
+        name = os.path.basename(path)
+        self.assertTrue(name.startswith('export.project.'))
+        self.assertTrue(name.endswith('.abc-123.collapsed'))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'a;b 1\n')
+        self.assertEqual(ring.profiles(), [(path, 6)])
+        self.assertEqual(
+            ProfileRing(max_files=1).directory, DEFAULT_DIRECTORY)
+
+    def test_max_files(self):
+        ring = ProfileRing(self.directory, max_files=2)
+        paths = []
+        for i in range(4):
+            paths.append(ring.write('export/project', str(i), 'a 1\n'))
+            os.utime(paths[-1], (i, i))
+        self.assertEqual([p for p, _ in ring.profiles()], paths[2:])
+        self.assertIn('export_project', paths[0])
+
+    def test_max_bytes(self):
+        ring = ProfileRing(self.directory, max_bytes=10)
+        first = ring.write('msg.send', None, 'a 1\n')
+        os.utime(first, (0, 0))
+        second = ring.write('msg.send', None, 'abcd 1\n')
+        self.assertEqual(ring.profiles(), [(second, 7)])
+        # Other files of the directory aren't removed
+        with open(os.path.join(self.directory, 'notes'), 'w') as f:
+            f.write('x' * 20)
+        self.assertEqual(ring.prune(), 0)
+
+    @patch('os.remove', side_effect=OSError)
+    @patch('os.makedirs', side_effect=OSError)
+    def test_shared_directory(self, makedirs, remove):
+        os.mkdir(self.directory)
+        with patch('os.path.isdir', return_value=False):
+            ring = ProfileRing(self.directory, max_files=0)
+            ring.write('msg.send', '1', 'a 1\n')
+        self.assertEqual(len(ring.profiles()), 1)
+        with patch('os.stat', side_effect=OSError):
+            self.assertEqual(ring.profiles(), [])
+
+
+class TestTaskProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = MagicMock(write=MagicMock(return_value='path'))
+        self.task = MagicMock()
+        self.task.name = 'export.project'
+
+    def run_task(self, profiler, seconds=0.05, task_id='1'):
+        profiler.on_task_prerun(task_id=task_id, task=self.task)
+        busy(seconds)
+        profiler.on_task_postrun(task_id=task_id, task=self.task)
+
+    def test_sampled(self):
+        profiler = TaskProfiler(self.ring, sample_rate=1.0, interval=0.001)
+        self.run_task(profiler)
+        self.assertEqual(profiler.written, 1)
+        task_name, task_id, content = self.ring.write.call_args[0]
+        self.assertEqual((task_name, task_id), ('export.project', '1'))
+        self.assertIn(':busy', content)
+        self.assertFalse(profiler.sampler.running)
+
+    def test_not_sampled(self):
+        profiler = TaskProfiler(self.ring, sample_rate=0.0)
+        self.run_task(profiler)
+        self.assertFalse(profiler.sampler.running)
+        self.assertFalse(self.ring.write.called)
+
+    def test_slow_threshold(self):
+        profiler = TaskProfiler(
+            self.ring, slow_threshold=0.05, interval=0.001)
+        self.run_task(profiler, 0.001)
+        self.assertFalse(self.ring.write.called)
+        self.run_task(profiler, 0.06)
+        self.assertEqual(profiler.written, 1)
+
+    def test_one_task_at_a_time(self):
+        profiler = TaskProfiler(self.ring, sample_rate=1.0, interval=0.001)
+        profiler.on_task_prerun(task_id='1', task=self.task)
+        profiler.on_task_prerun(task_id='2', task=self.task)
+        busy(0.05)
+        profiler.on_task_postrun(task_id='2', task=self.task)
+        self.assertTrue(profiler.sampler.running)
+        profiler.on_task_postrun(task_id='1', task=self.task)
+        self.assertEqual(self.ring.write.call_args[0][1], '1')
+
+    def test_no_samples(self):
+        profiler = TaskProfiler(self.ring, sample_rate=1.0, interval=10)
+        self.run_task(profiler, 0)
+        self.assertFalse(self.ring.write.called)
+
+    def test_write_failure(self):
+        self.ring.write.side_effect = OSError
+        profiler = TaskProfiler(self.ring, sample_rate=1.0, interval=0.001)
+        with patch('cadasta.workertoolbox.profiling.logger') as logger:
+            self.run_task(profiler)
+        self.assertTrue(logger.exception.called)
+        self.assertEqual(profiler.written, 0)
+
+
+class TestSetupTaskProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        disconnect_task_profiler()
+        shutil.rmtree(self.tmpdir)
+
+    def test_signals(self):
+        conf = Config(
+            imports=(), broker_url='memory://', broker_transport='memory',
+            SETUP_TASK_PROFILING=True, PROFILE_SAMPLE_RATE=1.0,
+            PROFILE_INTERVAL=0.001, PROFILE_DIR=self.tmpdir,
+            PROFILE_MAX_FILES=2)
+        profiler = conf.TASK_PROFILER
+        self.assertEqual(profiler.ring.directory, self.tmpdir)
+        self.assertEqual(profiler.ring.max_files, 2)
+        self.assertEqual(profiler.ring.max_bytes, 10 * 1024 * 1024)
+
+        app = Celery(set_as_current=False)
+        app.config_from_object(conf)
+
+        @app.task(name='export.busy')
+        def busy_task():
+            busy(0.05)
+
+        for _ in range(3):
+            busy_task.apply()
+        self.assertEqual(profiler.written, 3)
+        profiles = profiler.ring.profiles()
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(
+            os.path.basename(path).startswith('export.busy.')
+            for path, _ in profiles))
+
+    def test_disabled(self):
+        conf = Config(imports=())
+        self.assertFalse(hasattr(conf, 'TASK_PROFILER'))
+        self.assertEqual(conf.PROFILE_DIR, '')
+
+    def test_unknown_clock(self):
+        with self.assertRaises(ValueError):
+            Config(imports=(), PROFILE_CLOCK='gpu')
@@ -0,0 +1,117 @@
+import unittest
+from mock import patch, MagicMock
+
+from celery import Celery
+
+from cadasta.workertoolbox import publish
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.setup import setup_exchanges
+
+
+def make_app(**kwargs):
+    app = Celery(set_as_current=False)
+    app.config_from_object(Config(imports=(), **kwargs))
+    return app
+
+
+class TestPublishManyMemory(unittest.TestCase):
+
+    def setUp(self):
+        self.app = make_app(
+            broker_url='memory://', broker_transport='memory',
+            QUEUES=('pub-export', 'pub-msg'))
+        setup_exchanges(self.app)
+        self.conn = self.app.connection()
+        self.channel = self.conn.default_channel
+        for q in self.app.amqp.queues:
+            self.channel.queue_purge(q)
+
+    def tearDown(self):
+        self.conn.release()
+
+    def test_publish_many(self):
+        sigs = [
+            self.app.signature('pub-export.task', args=(i,)) for i in range(3)
+        ] + [
+            self.app.signature('pub-msg.task', kwargs={'i': i})
+            for i in range(2)
+        ]
+        sigs.insert(1, sigs.pop())
+        ids = [s.freeze().id for s in sigs]
+
+        results = publish.publish_many(self.app, sigs)
+
+        self.assertEqual([r.id for r in results], ids)
+        self.assertEqual(self.channel._size('pub-export'), 3)
+        self.assertEqual(self.channel._size('pub-msg'), 2)
+        self.assertEqual(self.channel._size('platform.fifo'), 5)
+
+    def test_batched_sends_other_transport(self):
+        with publish.batched_sends(self.channel) as batcher:
+            self.assertIsNone(batcher)
+
+
+class TestPublishManySQS(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('kombu.transport.SQS.Channel.sqs', MagicMock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = make_app()
+        setup_exchanges(self.app)
+        self.conn = self.app.connection()
+        self.sqs = self.conn.default_channel.sqs
+        self.sqs.reset_mock()
+        self.sqs.send_message_batch.return_value = {}
+
+    def tearDown(self):
+        self.conn.release()
+
+    def sent(self):
+        return [
+            len(c[1]['Entries'])
+            for c in self.sqs.send_message_batch.call_args_list
+        ]
+
+    def test_publish_many_batches(self):
+        sigs = [
+            self.app.signature('export.task', args=(i,)) for i in range(25)
+        ]
+        publish.publish_many(self.app, sigs)
+        # Each message goes to the 'export' and 'platform.fifo' queues
+        self.assertEqual(sorted(self.sent()), [5, 5, 10, 10, 10, 10])
+        self.assertFalse(self.sqs.send_message.called)
+
+    def test_fifo_entries(self):
+        channel = self.conn.default_channel
+        with publish.batched_sends(channel):
+            channel._put('platform.fifo', {'body': 'a', 'properties': {}})
+            channel._put('platform.fifo', {
+                'body': 'b',
+                'properties': {
+                    'MessageGroupId': 'foo', 'MessageDeduplicationId': 'bar'
+                }
+            })
+        entries = self.sqs.send_message_batch.call_args[1]['Entries']
+        self.assertEqual(entries[0]['Id'], '0')
+        self.assertEqual(entries[0]['MessageGroupId'], 'default')
+        self.assertEqual(entries[1]['MessageGroupId'], 'foo')
+        self.assertEqual(entries[1]['MessageDeduplicationId'], 'bar')
+
+    def test_split_by_size(self):
+        channel = self.conn.default_channel
+        with patch('cadasta.workertoolbox.publish.SQS_MAX_BATCH_BYTES', 100):
+            with publish.batched_sends(channel) as batcher:
+                for i in range(3):
+                    channel._put('msg', {'body': 'x' * 40, 'properties': {}})
+        self.assertEqual(self.sent(), [1, 1, 1])
+        self.assertEqual(batcher.requests, 3)
+
+    def test_failed_entries_resent(self):
+        self.sqs.send_message_batch.return_value = {'Failed': [{'Id': '1'}]}
+        channel = self.conn.default_channel
+        with publish.batched_sends(channel):
+            channel._put('msg', {'body': 'a', 'properties': {}})
+            channel._put('msg', {'body': 'b', 'properties': {}})
+        self.assertEqual(self.sqs.send_message.call_count, 1)
+        self.assertNotIn('_put', channel.__dict__)
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from celery import Celery, states
+from celery.result import GroupResult
+from sqlalchemy import event
+
+from cadasta.workertoolbox.conf import BUFFERED_RESULT_BACKEND, Config
+from cadasta.workertoolbox.results import iter_results, iter_task_meta
+
+
+class TestIterTaskMeta(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(self.tmpdir, 'results.db')
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            imports=(), broker_transport='memory', RESULT_FETCH_CHUNK_SIZE=4,
+            RESULT_BUFFER_MAX_SIZE=1000,
+            result_backend=BUFFERED_RESULT_BACKEND + '+' + url))
+        self.backend = self.app.backend
+        for i in range(7):
+            self.backend.store_result('task-{}'.format(i), i, states.SUCCESS)
+        self.backend.store_result(
+            'task-failed', ValueError('Oops'), states.FAILURE)
+        self.backend.flush()
+        self.selects = []
+        event.listen(self.backend.engine, 'before_cursor_execute',
+                     self.on_execute)
+
+    def tearDown(self):
+        event.remove(self.backend.engine, 'before_cursor_execute',
+                     self.on_execute)
+        self.backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def on_execute(self, conn, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            self.selects.append(statement)
+
+    def test_chunked_queries(self):
+        task_ids = ['task-{}'.format(i) for i in range(7)]
+        task_ids += ['task-failed', 'missing', 'task-0']
+        results = list(iter_task_meta(self.backend, task_ids, chunk_size=3))
+        self.assertEqual([task_id for task_id, _ in results], task_ids)
+        self.assertEqual(len(self.selects), 4)
+        self.assertEqual(
+            [meta['result'] for _, meta in results[:7]], list(range(7)))
+        failed, missing, repeated = [meta for _, meta in results[7:]]
+        self.assertEqual(failed['status'], states.FAILURE)
+        self.assertIsInstance(failed['result'], ValueError)
+        self.assertEqual(missing['status'], states.PENDING)
+        self.assertIsNone(missing['result'])
+        self.assertEqual(repeated, results[0][1])
+        self.assertIsNot(repeated, results[0][1])
+
+    def test_streamed(self):
+        results = iter_task_meta(
+            self.backend, ('task-{}'.format(i) for i in range(7)))
+        self.assertEqual(next(results)[1]['result'], 0)
+        self.assertEqual(len(self.selects), 1)
+        # The session is closed once the generator is
+        results.close()
+        self.assertEqual(len(list(results)), 0)
+
+    def test_buffered_results(self):
+        self.backend.store_result('task-0', 'again', states.SUCCESS)
+        self.backend.store_result('task-new', 'new', states.SUCCESS)
+        self.assertEqual(self.backend.pending, 2)
+        results = dict(iter_task_meta(
+            self.backend, ['task-0', 'task-1', 'task-new']))
+        self.assertEqual(results['task-0']['result'], 'again')
+        self.assertEqual(results['task-1']['result'], 1)
+        self.assertEqual(results['task-new']['result'], 'new')
+
+    def test_group_results(self):
+        group = GroupResult('group', [
+            self.app.AsyncResult(task_id)
+            for task_id in ('task-failed', 'task-3', 'missing')
+        ], app=self.app)
+        results = list(iter_results(group))
+        self.assertEqual(results[1], ('task-3', states.SUCCESS, 3))
+        self.assertEqual(results[2], ('missing', states.PENDING, None))
+        self.assertIsInstance(results[0][2], ValueError)
+
+    def test_other_backends(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            imports=(), result_backend='cache', cache_backend='memory'))
+        app.backend.store_result('task-0', 'done', states.SUCCESS)
+        results = list(iter_task_meta(app.backend, ['task-0', 'missing']))
+        self.assertEqual(results[0][1]['result'], 'done')
+        self.assertEqual(results[1][1]['status'], states.PENDING)
@@ -0,0 +1,126 @@
+import random
+import unittest
+
+from celery import Celery
+from kombu import Exchange, Queue, binding
+from kombu.transport.virtual.exchange import TopicExchange
+
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.routing import RoutingTable, TopicTrie
+
+
+class TestTopicTrie(unittest.TestCase):
+
+    def trie(self, *patterns):
+        trie = TopicTrie()
+        for pattern in patterns:
+            trie.add(pattern, pattern)
+        return trie
+
+    def test_wildcards(self):
+        trie = self.trie('export', 'export.*', 'export.#', '#', '*.done',
+                         'msg.#.sent')
+        self.assertEqual(trie.match('export'), set(['export', '#']))
+        self.assertEqual(trie.match('export.zip'),
+                         set(['export.*', 'export.#', '#']))
+        self.assertEqual(trie.match('export.'), set(['export.#', '#']))
+        self.assertEqual(trie.match('msg.sent'), set(['#']))
+        self.assertEqual(trie.match('msg.sms.email.sent'),
+                         set(['msg.#.sent', '#']))
+        # As with kombu, '*' may match several words
+        self.assertEqual(trie.match('export.zip.done'),
+                         set(['export.*', 'export.#', '*.done', '#']))
+        self.assertEqual(trie.match(''), set(['#']))
+
+    def test_mixed_words(self):
+        trie = self.trie('export.zip*', 'a#.b')
+        self.assertEqual(trie.match('export.zippp'), set(['export.zip*']))
+        self.assertEqual(trie.match('export.zap'), set())
+        with self.assertRaises(ValueError):
+            trie.add('*export', 'q')
+
+    def test_matches_like_kombu(self):
+        exchange = TopicExchange(None)
+        rand = random.Random(0)
+        words = ['a', 'b', '', 'ab', '*', '#']
+        for _ in range(300):
+            trie = TopicTrie()
+            table = []
+            for i in range(rand.randint(1, 6)):
+                pattern = '.'.join(
+                    rand.choice(words) for _ in range(rand.randint(1, 4)))
+                trie.add(pattern, i)
+                table.append(exchange.prepare_bind(i, 'x', pattern, None))
+            keys = [
+                '.'.join(rand.choice(['a', 'b', '', 'c'])
+                         for _ in range(rand.randint(1, 5)))
+                for _ in range(20)
+            ]
+            matched = trie.match_many(keys)
+            for key in keys:
+                expected = exchange.lookup(table, 'x', key, None)
+                self.assertEqual(trie.match(key), expected)
+                self.assertEqual(matched[key], expected)
+
+
+class TestRoutingTable(unittest.TestCase):
+
+    def test_config(self):
+        conf = Config(
+            imports=(), PLATFORM_QUEUE_BINDINGS=('export', 'msg.*'),
+            PLATFORM_EXCLUDED_TASKS=('export.quiet',))
+        table = RoutingTable.from_config(conf)
+        self.assertEqual(table.resolve([
+            'export.project', 'export.quiet', 'msg.sms', 'celery.chord_unlock',
+            'unknown.task',
+        ]), {
+            'export.project': set(['export', 'platform.fifo']),
+            'export.quiet': set(['export']),
+            'msg.sms': set(['msg']),
+            'celery.chord_unlock': set(['celery']),
+            'unknown.task': set(),
+        })
+        self.assertEqual(
+            table.lookup('task_exchange', 'msg.sms'), set(['platform.fifo']))
+        self.assertEqual(table.lookup('', 'export'), set(['export']))
+        self.assertEqual(table.lookup('unknown', 'export'), set())
+
+    def test_app(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            imports=(), PLATFORM_EXCLUDED_TASKS=('celery.*',)))
+        names = ['export.project', 'msg.sms', 'celery.chord_unlock']
+        self.assertEqual(
+            RoutingTable.from_app(app).resolve(names),
+            RoutingTable.from_config(app.conf).resolve(names))
+        self.assertEqual(
+            RoutingTable.from_app(app).resolve(['celery.chord_unlock']),
+            {'celery.chord_unlock': set(['celery'])})
+
+    def test_exchange_types(self):
+        direct = Exchange('direct', 'direct')
+        fanout = Exchange('fanout', 'fanout')
+        table = RoutingTable([
+            Queue('a', direct, routing_key='a'),
+            Queue('b', direct, routing_key='a'),
+            Queue('c', fanout),
+            Queue('d', bindings=[binding(fanout), binding(direct, 'd')]),
+        ])
+        self.assertEqual(table.lookup('direct', 'a'), set(['a', 'b']))
+        self.assertEqual(table.lookup('direct', 'd'), set(['d']))
+        self.assertEqual(table.lookup('direct', 'e'), set())
+        self.assertEqual(table.lookup('fanout', 'e'), set(['c', 'd']))
+        with self.assertRaises(ValueError):
+            table.bind('headers', '', 'e', 'headers')
+
+    def test_resolve_options(self):
+        routes = {
+            'a.task': {'queue': Queue('a', Exchange('x'), routing_key='a')},
+            'b.task': {'queue': 'b'},
+        }
+        table = RoutingTable(
+            [Queue('a', Exchange('x'), routing_key='a')], routes.get)
+        self.assertEqual(table.resolve(routes), {
+            'a.task': set(['a']), 'b.task': set(['b'])})
+        with self.assertRaises(ValueError):
+            RoutingTable().resolve(['a.task'])
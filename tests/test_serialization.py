@@ -0,0 +1,232 @@
+import base64
+import datetime
+import decimal
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import uuid
+from mock import MagicMock, patch
+
+from celery import Celery
+from kombu.serialization import dumps, loads
+from kombu.transport import memory
+from kombu.utils.json import dumps as kombu_dumps, loads as kombu_loads
+
+from cadasta.workertoolbox.blobs import FileSystemBlobStore
+from cadasta.workertoolbox.conf import Config
+from cadasta.workertoolbox.serialization import (
+    FAST_SERIALIZER, OffloadingCodec, OFFLOAD_CONTENT_TYPE,
+    OFFLOAD_SERIALIZER, SQS_MAX_SIZE, fast_dumps, json_codec,
+    register_fast_serializer)
+from cadasta.workertoolbox.setup import setup_exchanges
+
+
+def geometry(points):
+    rand = random.Random(points)
+    return {'type': 'Polygon', 'coordinates': [
+        [round(rand.uniform(-180, 180), 6), round(rand.uniform(-90, 90), 6)]
+        for _ in range(points)
+    ]}
+
+
+class UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+PAYLOAD = {
+    'created': datetime.datetime(2018, 1, 2, 3, 4, 5, tzinfo=UTC()),
+    'modified': datetime.datetime(2018, 1, 2, 3, 4, 5, 6),
+    'date': datetime.date(2018, 1, 2),
+    'id': uuid.UUID(int=1),
+    'area': decimal.Decimal('1.5'),
+    'name': u'Parcel \u00e9',
+    'tags': ['a', 'b'],
+}
+
+
+class TestFastSerializer(unittest.TestCase):
+
+    def test_compatible_with_kombu(self):
+        self.assertEqual(
+            json.loads(fast_dumps(PAYLOAD)), json.loads(kombu_dumps(PAYLOAD)))
+        self.assertEqual(
+            json.loads(fast_dumps(PAYLOAD))['created'],
+            '2018-01-02T03:04:05Z')
+        self.assertNotIn(' ', fast_dumps(PAYLOAD['tags']))
+
+    def test_json_codec(self):
+        with patch.dict('sys.modules', {'orjson': None}):
+            self.assertEqual(json_codec(), (fast_dumps, kombu_loads))
+        # Without passing datetimes through, as before orjson 3.3
+        orjson = MagicMock(spec=['dumps', 'loads'])
+        with patch.dict('sys.modules', {'orjson': orjson}):
+            self.assertEqual(json_codec(), (fast_dumps, kombu_loads))
+        orjson = MagicMock()
+        with patch.dict('sys.modules', {'orjson': orjson}):
+            encoder, decoder = json_codec()
+        self.assertIs(decoder, orjson.loads)
+        self.assertEqual(encoder(PAYLOAD), orjson.dumps.return_value)
+        options = orjson.dumps.call_args[1]
+        self.assertIs(
+            options['option'], orjson.OPT_PASSTHROUGH_DATETIME)
+        default = options['default']
+        self.assertEqual(default(PAYLOAD['area']), '1.5')
+        self.assertEqual(default(PAYLOAD['created']), '2018-01-02T03:04:05Z')
+
+    def test_register(self):
+        register_fast_serializer()
+        content_type, encoding, data = dumps(
+            PAYLOAD, serializer=FAST_SERIALIZER)
+        self.assertEqual(content_type, 'application/json')
+        self.assertEqual(
+            loads(data, content_type, encoding), json.loads(data))
+
+
+class TestOffloadingCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = FileSystemBlobStore(self.tmpdir)
+        self.codec = OffloadingCodec(
+            self.store, compress_threshold=100, max_size=10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_small_payloads(self):
+        data = self.codec.encode({'a': 1})
+        self.assertEqual(data, b'J{"a": 1}')
+        self.assertEqual(self.codec.decode(data), {'a': 1})
+        self.assertEqual(self.codec.decode(u'J{"a": 1}'), {'a': 1})
+
+    def test_compressed_payloads(self):
+        payload = {'name': 'x' * 1000}
+        data = self.codec.encode(payload)
+        self.assertEqual(data[:1], b'Z')
+        self.assertLess(len(data), 100)
+        self.assertEqual(self.codec.decode(data), payload)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_offloaded_payloads(self):
+        payload = geometry(2000)
+        data = self.codec.encode(payload)
+        self.assertEqual(data[:1], b'P')
+        self.assertEqual(os.listdir(self.tmpdir), [data[1:].decode()])
+        self.assertEqual(self.codec.decode(data), payload)
+        # Identical payloads share a blob
+        self.assertEqual(self.codec.encode(payload), data)
+
+    def test_unknown_payloads(self):
+        with self.assertRaises(ValueError):
+            self.codec.decode(b'X{}')
+
+    def test_custom_serializer(self):
+        codec = OffloadingCodec(
+            self.store, dumps=lambda obj: repr(obj).encode('utf-8'),
+            loads=lambda data: data)
+        self.assertEqual(codec.decode(codec.encode([1])), '[1]')
+
+    def test_register(self):
+        self.codec.register()
+        content_type, encoding, data = dumps(
+            geometry(2000), serializer=OFFLOAD_SERIALIZER)
+        self.assertEqual(content_type, OFFLOAD_CONTENT_TYPE)
+        self.assertEqual(encoding, 'binary')
+        self.assertEqual(
+            loads(data, content_type, encoding), geometry(2000))
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_disabled_by_default(self):
+        conf = Config()
+        self.assertFalse(hasattr(conf, 'task_serializer'))
+
+    def test_fast_profile(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            broker_transport='memory', SERIALIZER_PROFILE='fast'))
+        self.assertEqual(app.conf.task_serializer, FAST_SERIALIZER)
+        self.assertEqual(app.conf.result_serializer, FAST_SERIALIZER)
+        setup_exchanges(app)
+        with app.connection() as conn:
+            queue = conn.SimpleQueue('msg', no_ack=True)
+            queue.clear()
+            app.send_task('msg.send', args=(PAYLOAD,))
+            message = queue.get(timeout=1)
+            queue.close()
+        self.assertEqual(message.content_type, 'application/json')
+        # Readable by the platform's JSON consumers
+        self.assertEqual(
+            json.loads(message.body)[0][0]['id'], str(uuid.UUID(int=1)))
+
+    def test_fast_offloading(self):
+        conf = Config(
+            SERIALIZER_PROFILE='fast', PAYLOAD_STORE='file://' + self.tmpdir)
+        self.assertEqual(conf.task_serializer, OFFLOAD_SERIALIZER)
+        self.assertEqual(conf.result_serializer, FAST_SERIALIZER)
+        codec = conf.setup_payload_offloading()
+        self.assertEqual(codec.dumps, json_codec()[0])
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            Config(SERIALIZER_PROFILE='fastest')
+
+    def test_offloads_task_payloads(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            broker_transport='memory', PAYLOAD_STORE='file://' + self.tmpdir,
+            PAYLOAD_MAX_SIZE=1000))
+        self.assertEqual(app.conf.task_serializer, OFFLOAD_SERIALIZER)
+        setup_exchanges(app)
+        with app.connection() as conn:
+            queue = conn.SimpleQueue('export', no_ack=True)
+            queue.clear()
+            app.send_task('export.project', args=(geometry(2000),))
+            self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+            message = queue.get(timeout=1)
+            self.assertEqual(message.content_type, OFFLOAD_CONTENT_TYPE)
+            self.assertLess(len(message.body), 1000)
+            args, kwargs, embed = message.decode()
+            self.assertEqual(args, [geometry(2000)])
+            queue.close()
+
+    def test_fits_sqs_once_encoded(self):
+        app = Celery(set_as_current=False)
+        app.config_from_object(Config(
+            broker_transport='memory', PAYLOAD_STORE='file://' + self.tmpdir))
+        setup_exchanges(app)
+        # Incompressible, just under PAYLOAD_MAX_SIZE once compressed
+        rand = random.Random(0)
+        payload = base64.b64encode(bytearray(
+            rand.getrandbits(8)
+            for _ in range(app.conf.PAYLOAD_MAX_SIZE * 97 // 100))).decode()
+        messages = []
+        put = memory.Channel._put
+
+        def _put(channel, queue, message, **kwargs):
+            messages.append(message)
+            return put(channel, queue, message, **kwargs)
+
+        with patch.object(memory.Channel, '_put', _put):
+            app.send_task('export.project', args=(payload,))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+        body = base64.b64decode(messages[0]['body'])
+        self.assertGreater(len(body), app.conf.PAYLOAD_MAX_SIZE * 97 // 100)
+        self.assertLessEqual(len(body), app.conf.PAYLOAD_MAX_SIZE)
+        # As sent by kombu's SQS transport, with Celery's headers
+        message_body = base64.b64encode(kombu_dumps(messages[0]).encode())
+        self.assertLess(len(message_body), SQS_MAX_SIZE)
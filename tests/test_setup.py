@@ -1,9 +1,14 @@
+import os
+import shutil
+import tempfile
 import unittest
 from mock import MagicMock, patch
 
 from celery import Celery
+from kombu import Exchange, Queue
 
 from cadasta.workertoolbox import setup
+from cadasta.workertoolbox.conf import Config
 
 
 def mock_setup_func(success=True):
@@ -58,3 +63,169 @@ class TestSetup(unittest.TestCase):
 
         self.assertFalse(logger.exception.called)
         self.assertTrue(app.is_set_up)
+
+    @patch('cadasta.workertoolbox.setup.SETUP_FUNCS',
+           (mock_setup_func(True), mock_setup_func(False)))
+    @patch('cadasta.workertoolbox.setup.logger')
+    def test_timings(self, logger):
+        app = Celery()
+        setup.setup_app(app, throw=False)
+
+        from cadasta.workertoolbox.setup import SETUP_FUNCS
+        self.assertEqual(
+            list(app.setup_timings),
+            [repr(SETUP_FUNCS[0]), 'SetupFuncB'])
+        for duration in app.setup_timings.values():
+            self.assertTrue(duration >= 0)
+        self.assertEqual(logger.debug.call_count, 2)
+
+
+class TestChordUnlockBackoff(unittest.TestCase):
+
+    def test_countdown(self):
+        self.assertEqual(
+            [setup.chord_unlock_countdown(i, 1, 2, 60) for i in range(8)],
+            [1, 2, 4, 8, 16, 32, 60, 60])
+
+    def test_retries(self):
+        self.assertEqual(setup.chord_unlock_retries(0, 1, 2, 60), 0)
+        self.assertEqual(setup.chord_unlock_retries(7, 1, 2, 60), 3)
+        self.assertEqual(setup.chord_unlock_retries(183, 1, 2, 60), 8)
+
+    @patch('celery.app.task.Task.retry', autospec=True)
+    def test_backoff(self, retry):
+        app = Celery()
+        app.config_from_object(Config(
+            CHORD_UNLOCK_STRATEGY='backoff', CHORD_UNLOCK_BACKOFF_MAX=5))
+        setup.backoff_chord_unlock_tasks(app)
+        setup.backoff_chord_unlock_tasks(app)
+        task = app.tasks['celery.chord_unlock']
+        for retries, countdown in ((0, 1), (2, 4), (3, 5)):
+            task.push_request(retries=retries)
+            task.retry(countdown=1, max_retries=10)
+            task.pop_request()
+            retry.assert_called_with(
+                task, countdown=countdown, max_retries=10)
+
+    def test_polling(self):
+        app = Celery()
+        app.config_from_object(Config())
+        setup.backoff_chord_unlock_tasks(app)
+        self.assertNotIn('retry', vars(app.tasks['celery.chord_unlock']))
+
+
+class TestDeclarationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'declared.json')
+        self.exchange = Exchange('task_exchange', 'topic')
+
+    def test_missing_or_invalid_file(self):
+        self.assertEqual(setup.DeclarationCache(self.path, 60).entries, {})
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.assertEqual(setup.DeclarationCache(self.path, 60).entries, {})
+
+    def test_persists(self):
+        queue = Queue('foo', self.exchange, routing_key='foo')
+        cache = setup.DeclarationCache(self.path, 60)
+        self.assertFalse(cache.is_declared(queue))
+        cache.mark_declared(queue)
+        cache.save()
+
+        cache = setup.DeclarationCache(self.path, 60)
+        self.assertTrue(cache.is_declared(queue))
+        self.assertFalse(cache.is_declared(
+            Queue('foo', self.exchange, routing_key='bar')))
+        self.assertFalse(
+            setup.DeclarationCache(self.path, 60, 'other').is_declared(queue))
+
+    def test_expires(self):
+        queue = Queue('foo', self.exchange, routing_key='foo')
+        cache = setup.DeclarationCache(self.path, 60)
+        cache.mark_declared(queue)
+        cache.entries[cache.key(queue)] -= 61
+        self.assertFalse(cache.is_declared(queue))
+        cache.save()
+        self.assertEqual(setup.DeclarationCache(self.path, 60).entries, {})
+
+
+class TestDeclareQueues(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.app = Celery(set_as_current=False)
+        self.app.config_from_object(Config(
+            imports=(), broker_url='memory://', broker_transport='memory',
+            DECLARATION_CACHE_FILE=os.path.join(self.tmpdir, 'cache.json')))
+        self.conn = self.app.connection()
+        self.addCleanup(self.conn.release)
+        self.channel = self.conn.default_channel
+        self.queues = list(self.app.amqp.queues.values())
+
+    def declared(self, **kwargs):
+        with patch.object(self.channel, 'queue_declare',
+                          wraps=self.channel.queue_declare) as declare, \
+                patch.object(self.channel, 'queue_bind') as bind:
+            setup.declare_queues(self.channel, self.queues, **kwargs)
+        self.assertEqual(bind.call_count, len(self.queues))
+        return sorted(c[1]['queue'] for c in declare.call_args_list)
+
+    def test_declare_concurrently(self):
+        self.assertEqual(
+            self.declared(concurrency=4), sorted(self.app.amqp.queues))
+
+    def test_declare_serially(self):
+        channel = MagicMock()
+        setup.declare_queues(channel, self.queues, concurrency=4)
+        self.assertEqual(
+            channel.queue_declare.call_count, len(self.queues))
+
+    def test_skip_cached(self):
+        path = self.app.conf.DECLARATION_CACHE_FILE
+        cache = setup.DeclarationCache(path, 60)
+        self.assertEqual(len(self.declared(cache=cache)), len(self.queues))
+        self.conn.declared_entities.clear()
+        cache = setup.DeclarationCache(path, 60)
+        self.assertEqual(self.declared(cache=cache), [])
+
+    def test_skip_declared_by_connection(self):
+        self.declared()
+        with patch.object(self.channel, 'queue_declare') as declare:
+            setup.declare_queues(self.channel, self.queues)
+        self.assertFalse(declare.called)
+
+    def test_skip_no_declare(self):
+        queue = Queue('foo', Exchange('foo'), no_declare=True)
+        channel = MagicMock()
+        setup.declare_queues(channel, [queue])
+        self.assertFalse(channel.queue_declare.called)
+
+    @patch('cadasta.workertoolbox.setup.declare_queues')
+    def test_setup_exchanges(self, declare_queues):
+        setup.setup_exchanges(self.app)
+        channel, queues, cache, concurrency = declare_queues.call_args[0]
+        self.assertEqual(set(queues), set(self.queues))
+        self.assertEqual(cache.path, self.app.conf.DECLARATION_CACHE_FILE)
+        self.assertEqual(cache.ttl, 60 * 60)
+        self.assertEqual(concurrency, 1)
+
+    @patch('cadasta.workertoolbox.setup.declare_queues')
+    def test_setup_exchanges_no_cache(self, declare_queues):
+        self.app.conf.DECLARATION_CACHE_FILE = ''
+        self.app.conf.DECLARATION_CONCURRENCY = 8
+        setup.setup_exchanges(self.app)
+        channel, queues, cache, concurrency = declare_queues.call_args[0]
+        self.assertIsNone(cache)
+        self.assertEqual(concurrency, 8)
+
+    def test_setup_exchanges_serial(self):
+        # Queues are declared serially by default
+        self.app.conf.DECLARATION_CACHE_FILE = ''
+        self.assertEqual(self.app.conf.DECLARATION_CONCURRENCY, 1)
+        with patch('kombu.messaging.Producer.maybe_declare') as maybe_declare:
+            setup.setup_exchanges(self.app)
+        self.assertEqual(maybe_declare.call_count, len(self.queues))
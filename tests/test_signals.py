@@ -0,0 +1,24 @@
+import unittest
+from mock import patch, MagicMock
+
+from cadasta.workertoolbox import signals
+
+
+class TestSignals(unittest.TestCase):
+
+    @patch('cadasta.workertoolbox.signals.current_app')
+    def test_close_result_backend(self, current_app):
+        signals.close_result_backend_signal_handler(sender=None)
+        current_app.backend.close.assert_called_once_with()
+
+    @patch('cadasta.workertoolbox.signals.current_app')
+    def test_close_worker_result_backend(self, current_app):
+        worker = MagicMock()
+        signals.close_result_backend_signal_handler(sender=worker)
+        worker.app.backend.close.assert_called_once_with()
+        self.assertFalse(current_app.backend.close.called)
+
+    @patch('cadasta.workertoolbox.signals.current_app',
+           MagicMock(backend=object()))
+    def test_close_result_backend_unsupported(self):
+        signals.close_result_backend_signal_handler(sender=None)
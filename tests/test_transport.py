@@ -0,0 +1,110 @@
+import unittest
+from mock import patch, MagicMock
+
+from kombu import Connection
+from kombu.five import Empty
+
+from cadasta.workertoolbox.transport import SQSTransport
+
+
+class TestSQSChannel(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('kombu.transport.SQS.Channel.sqs', MagicMock())
+        self.sqs = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sqs.list_queues.return_value = {}
+        self.sqs.create_queue.side_effect = lambda QueueName, **kw: {
+            'QueueUrl': 'https://sqs/' + QueueName}
+        self.conn = Connection(transport=SQSTransport, transport_options={
+            'queue_name_prefix': 'test-transport-',
+            'visibility_timeout': 30,
+            'receive_batch_size': 5,
+            'queue_options': {
+                'export': {'visibility_timeout': 3600,
+                           'receive_batch_size': 1},
+            },
+        })
+        self.addCleanup(self.conn.release)
+        self.channel = self.conn.default_channel
+        self.addCleanup(self.channel._queue_cache.clear)
+
+    def created(self, name):
+        self.channel._new_queue(name)
+        return self.sqs.create_queue.call_args[1]['Attributes']
+
+    def test_visibility_timeout(self):
+        self.assertEqual(self.created('export'), {'VisibilityTimeout': '3600'})
+        self.assertEqual(self.created('msg'), {'VisibilityTimeout': '30'})
+        self.assertEqual(
+            self.created('platform.fifo'),
+            {'VisibilityTimeout': '30', 'FifoQueue': 'true'})
+
+    def test_queue_cached(self):
+        self.channel._new_queue('msg')
+        self.assertEqual(self.channel._new_queue('msg'), 'https://sqs/' +
+                         'test-transport-msg')
+        self.assertEqual(self.sqs.create_queue.call_count, 1)
+        url = object()
+        self.assertIs(self.channel._new_queue(url), url)
+
+    def test_default_visibility_timeout(self):
+        del self.conn.transport_options['visibility_timeout']
+        self.assertEqual(self.created('msg'), {
+            'VisibilityTimeout': str(self.channel.default_visibility_timeout)})
+
+    def test_receive_batch_size(self):
+        self.assertEqual(self.channel._receive_batch_size('export'), 1)
+        self.assertEqual(self.channel._receive_batch_size('msg'), 5)
+        self.conn.transport_options['receive_batch_size'] = 50
+        self.assertEqual(self.channel._receive_batch_size('msg'), 10)
+
+    def test_get_bulk(self):
+        self.sqs.receive_message.return_value = {'Messages': []}
+        with self.assertRaises(Empty):
+            self.channel._get_bulk('msg')
+        kwargs = self.sqs.receive_message.call_args[1]
+        self.assertEqual(kwargs['MaxNumberOfMessages'], 5)
+        self.assertEqual(kwargs['VisibilityTimeout'], 30)
+
+    def test_existing_queue(self):
+        self.sqs.list_queues.return_value = {
+            'QueueUrls': ['https://sqs/test-transport-export']}
+        self.sqs.receive_message.return_value = {}
+        with self.assertRaises(Empty):
+            self.channel._get_bulk('export')
+        self.assertFalse(self.sqs.create_queue.called)
+        self.assertEqual(
+            self.sqs.receive_message.call_args[1]['VisibilityTimeout'], 3600)
+        with patch.object(self.channel, '_asynsqs') as asynsqs:
+            self.channel._get_async('export', 1, callback=MagicMock())
+        args, kwargs = asynsqs.receive_message.call_args
+        self.assertEqual(args, ('test-transport-export',))
+        self.assertEqual(kwargs['number_messages'], 1)
+        self.assertEqual(kwargs['visibility_timeout'], 3600)
+
+    def test_get_bulk_delivers(self):
+        self.sqs.receive_message.return_value = {
+            'Messages': [{'Body': 'foo'}]}
+        with patch.object(self.channel, '_messages_to_python') as to_python, \
+                patch.object(self.conn.transport, '_deliver') as deliver:
+            to_python.return_value = ['msg1']
+            self.channel._get_bulk('export')
+        self.assertEqual(
+            self.sqs.receive_message.call_args[1]['MaxNumberOfMessages'], 1)
+        deliver.assert_called_once_with('msg1', 'export')
+
+    def test_get_bulk_qos_exhausted(self):
+        with patch.object(self.channel, '_get_message_estimate',
+                          return_value=0):
+            with self.assertRaises(Empty):
+                self.channel._get_bulk('msg')
+            callback = MagicMock()
+            self.channel._get_bulk_async('msg', callback=callback)
+        callback.assert_called_once_with([])
+        self.assertFalse(self.sqs.receive_message.called)
+
+    def test_get_bulk_async(self):
+        with patch.object(self.channel, '_get_async') as get_async:
+            self.channel._get_bulk_async('export', callback='cb')
+        get_async.assert_called_once_with('export', 1, callback='cb')
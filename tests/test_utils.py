@@ -1,3 +1,4 @@
+import threading
 import unittest
 from mock import MagicMock
 
@@ -27,3 +28,53 @@ class TestUtils(unittest.TestCase):
 
     def test_colorformatter(self):
         assert utils.ColorFormatter("%(message)s")
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get(self):
+        cache = utils.LRUCache(2)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertEqual(cache.info(), {
+            'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 2})
+
+    def test_evicts_least_recently_used(self):
+        cache = utils.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_disabled(self):
+        cache = utils.LRUCache(0)
+        cache['a'] = 1
+        self.assertEqual(len(cache), 0)
+
+    def test_threads(self):
+        cache = utils.LRUCache(8)
+
+        def use(offset):
+            for i in range(2000):
+                cache[(offset + i) % 16] = i
+                cache.get((offset + i * 3) % 16)
+
+        threads = [
+            threading.Thread(target=use, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = cache.info()
+        self.assertEqual(info['size'], 8)
+        self.assertEqual(info['hits'] + info['misses'], 8 * 2000)
+
+    def test_clear(self):
+        cache = utils.LRUCache(1)
+        cache['a'] = 1
+        cache.clear()
+        self.assertEqual(len(cache), 0)